@@ -0,0 +1,67 @@
+# Generated by Django 4.2 on 2026-10-17 10:00
+
+import django.contrib.gis.db.models.fields
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geodata', '0005_alter_malhaferroviaria_table'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cidade',
+            name='geom',
+            field=django.contrib.gis.db.models.fields.MultiPolygonField(spatial_index=False, srid=4326),
+        ),
+        migrations.AddIndex(
+            model_name='cidade',
+            index=django.contrib.postgres.indexes.GistIndex(fields=['geom'], include=('id',), name='cidade_geom_id_gist'),
+        ),
+        migrations.AlterField(
+            model_name='linhatransmissao',
+            name='geom',
+            field=django.contrib.gis.db.models.fields.MultiLineStringField(spatial_index=False, srid=4326),
+        ),
+        migrations.AddIndex(
+            model_name='linhatransmissao',
+            index=django.contrib.postgres.indexes.GistIndex(fields=['geom'], include=('id',), name='lt_geom_id_gist'),
+        ),
+        migrations.AlterField(
+            model_name='limitefederal',
+            name='geom',
+            field=django.contrib.gis.db.models.fields.MultiPolygonField(spatial_index=False, srid=4326),
+        ),
+        migrations.AddIndex(
+            model_name='limitefederal',
+            index=django.contrib.postgres.indexes.GistIndex(fields=['geom'], include=('id',), name='limfed_geom_id_gist'),
+        ),
+        migrations.AlterField(
+            model_name='area',
+            name='geom',
+            field=django.contrib.gis.db.models.fields.MultiPolygonField(spatial_index=False, srid=4326),
+        ),
+        migrations.AddIndex(
+            model_name='area',
+            index=django.contrib.postgres.indexes.GistIndex(fields=['geom'], include=('id',), name='area_geom_id_gist'),
+        ),
+        # malha ferroviária é managed=False (tabela criada fora das
+        # migrações): o índice vai por SQL e só se a tabela existir
+        migrations.RunSQL(
+            sql="""
+                DO $$
+                BEGIN
+                    IF to_regclass('geodata_malha_ferroviaria') IS NOT NULL THEN
+                        CREATE INDEX IF NOT EXISTS "malha_geom_id_gist"
+                        ON "geodata_malha_ferroviaria" USING gist ("geom")
+                        INCLUDE ("id");
+                    END IF;
+                END
+                $$;
+            """,
+            reverse_sql='DROP INDEX IF EXISTS "malha_geom_id_gist";',
+        ),
+    ]
@@ -1,18 +1,31 @@
 from django.contrib.gis.db import models
+from django.contrib.postgres.indexes import GistIndex
 
 
 class Cidade(models.Model):
     name = models.CharField(max_length=255, null=True,
                             blank=True, db_index=True)
     source = models.CharField(max_length=128, null=True, blank=True)
-    geom = models.MultiPolygonField(srid=4326, spatial_index=True)
+    geom = models.MultiPolygonField(srid=4326, spatial_index=False)
+
+    class Meta:
+        indexes = [
+            # GiST em geom cobrindo id (INCLUDE): o filtro espacial do export
+            # devolve os ids direto do índice, sem ir ao heap
+            GistIndex(fields=["geom"], include=["id"], name="cidade_geom_id_gist"),
+        ]
 
 
 class LinhaTransmissao(models.Model):
     name = models.CharField(max_length=255, null=True,
                             blank=True, db_index=True)
     source = models.CharField(max_length=128, null=True, blank=True)
-    geom = models.MultiLineStringField(srid=4326, spatial_index=True)
+    geom = models.MultiLineStringField(srid=4326, spatial_index=False)
+
+    class Meta:
+        indexes = [
+            GistIndex(fields=["geom"], include=["id"], name="lt_geom_id_gist"),
+        ]
 
 
 class MalhaFerroviaria(models.Model):
@@ -30,7 +43,12 @@ class LimiteFederal(models.Model):
     name = models.CharField(max_length=255, null=True,
                             blank=True, db_index=True)
     source = models.CharField(max_length=128, null=True, blank=True)
-    geom = models.MultiPolygonField(srid=4326, spatial_index=True)
+    geom = models.MultiPolygonField(srid=4326, spatial_index=False)
+
+    class Meta:
+        indexes = [
+            GistIndex(fields=["geom"], include=["id"], name="limfed_geom_id_gist"),
+        ]
 
 
 class Area(models.Model):
@@ -38,4 +56,9 @@ class Area(models.Model):
     name = models.CharField(max_length=255, null=True,
                             blank=True, db_index=True)
     source = models.CharField(max_length=128, null=True, blank=True)
-    geom = models.MultiPolygonField(srid=4326, spatial_index=True)
+    geom = models.MultiPolygonField(srid=4326, spatial_index=False)
+
+    class Meta:
+        indexes = [
+            GistIndex(fields=["geom"], include=["id"], name="area_geom_id_gist"),
+        ]
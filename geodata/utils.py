@@ -2,10 +2,10 @@
 from __future__ import annotations
 
 import io
-import json
 import zipfile
 from typing import Dict, Iterable, List, Tuple
 
+import orjson
 from django.contrib.gis.db.models.functions import Intersection, MakeValid
 from django.contrib.gis.geos import GEOSGeometry, MultiPolygon
 from django.db.models import F
@@ -31,7 +31,7 @@ def _mp(g: GEOSGeometry) -> MultiPolygon:
 
 
 def _norm_geom(obj) -> GEOSGeometry:
-    g = GEOSGeometry(json.dumps(obj) if isinstance(obj, dict) else obj)
+    g = GEOSGeometry(orjson.dumps(obj).decode() if isinstance(obj, dict) else obj)
     if g.srid is None:
         g.srid = 4326
     return g
@@ -1,15 +1,15 @@
 import io
 import json
 import zipfile
+from functools import lru_cache
 from typing import Iterable, List, Optional, Tuple
 
+import orjson
 from django.contrib.gis.db.models import GeometryField
-from django.contrib.gis.db.models.functions import (AsGeoJSON, Intersection,
-                                                    MakeValid)
 from django.contrib.gis.geos import GEOSGeometry, MultiPolygon
 from django.contrib.gis.geos import Polygon as GEOSPolygon
-from django.db import connection
-from django.db.models import F, Func, Value
+from django.db import DatabaseError, connection, transaction
+from django.db.models.expressions import RawSQL
 from django.db.utils import OperationalError
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
@@ -44,41 +44,6 @@ def _refresh_conn():
             pass
 
 
-def _yield_ids_in_batches(qs_ids, batch_size=2000):
-    """
-    Recebe um QuerySet de IDs (values_list(..., flat=True) + order_by('id')),
-    e rende listas de até batch_size IDs.
-    """
-    batch = []
-    for _id in qs_ids:
-        batch.append(_id)
-        if len(batch) >= batch_size:
-            yield batch
-            batch = []
-    if batch:
-        yield batch
-
-
-def _safe_geos_from_geojson(geom_obj):
-    """
-    Converte um dict GeoJSON geometry em GEOSGeometry SRID=4326, validando.
-    Suporta 2D/3D/4D (XYZM). O M é mantido internamente na GEOS se existir.
-    """
-    if not geom_obj:
-        return None
-    g = GEOSGeometry(json.dumps(geom_obj))
-    if g.srid is None:
-        g.srid = 4326
-    if g.srid != 4326:
-        g.transform(4326)
-    if not g.valid:
-        try:
-            g = g.buffer(0)  # tentativa de "make valid"
-        except Exception:
-            pass
-    return g
-
-
 def _close_rings_inplace(coords):
     """
     Fecha anéis de Polygon/MultiPolygon (2D/3D/4D).
@@ -165,20 +130,121 @@ def _coerce_geojson_to_geometry(obj):
     raise ValueError(f"Tipo de geometria não suportado: {obj.get('type')}")
 
 
-def _annotate_clip_simplify(qs, geom_expr, tol):
+def _annotate_clip_simplify(qs, aoi_ewkb, tol, make_valid=False):
     """
-    Aplica MakeValid + SimplifyPreserveTopology no resultado do recorte.
+    Recorte pela AOI + SimplifyPreserveTopology numa única expressão SQL
+    (geom_simpl), com a AOI ligada como EWKB. MakeValid só quando pedido
+    (make_valid=True), pois é um reparo topológico completo por linha e as
+    linhas (rios/LT/ferrovias) já chegam válidas da importação.
     Mantém a dimensão original armazenada no banco (GEOS controla Z/M).
     """
-    qs = qs.annotate(geom_valid=MakeValid(geom_expr)).annotate(
-        geom_simpl=Func(
-            F("geom_valid"),
-            Value(float(tol)),
-            function="ST_SimplifyPreserveTopology",
+    clip = f'ST_Intersection("{qs.model._meta.db_table}"."geom", ST_GeomFromEWKB(%s))'
+    if make_valid:
+        clip = f"ST_MakeValid({clip})"
+    return qs.annotate(
+        geom_simpl=RawSQL(
+            f"ST_SimplifyPreserveTopology({clip}, %s)",
+            [aoi_ewkb, float(tol)],
             output_field=GeometryField(srid=4326),
         )
     )
-    return qs
+
+
+def _iter_clipped_keyset(qs, aoi_ewkb, tol, batch_size=2000, make_valid=False):
+    """
+    Rende a geometria recortada/simplificada (geom_simpl) de cada linha de
+    qs (já filtrado pela AOI) numa única varredura ORDER BY id, lida em
+    janelas de batch_size por cursor server-side (iterator). values_list:
+    só (id, geom_simpl) por linha, sem instanciar o model nem carregar a
+    geom original. Se a conexão cair (OperationalError), reabre uma vez e
+    retoma do último id entregue (keyset: id > último), sem repetir linhas.
+    Obs.: com PGBOUNCER=1 não há cursor server-side e o iterator lê tudo
+    de uma vez.
+    """
+    last_id = None
+    retried = False
+    while True:
+        page = qs if last_id is None else qs.filter(id__gt=last_id)
+        rows = _annotate_clip_simplify(
+            page, aoi_ewkb, tol, make_valid=make_valid,
+        ).order_by("id").values_list("id", "geom_simpl").iterator(
+            chunk_size=batch_size)
+        try:
+            for pk, geom in rows:
+                last_id = pk
+                yield geom
+            return
+        except OperationalError:
+            if retried:
+                raise
+            retried = True
+            _refresh_conn()
+
+
+def _clip_simplify_geojson_batch(gjs, line_tols, aoi_ewkb, tol_pol):
+    """
+    Recorta pela AOI e simplifica geometrias GeoJSON (texto) numa só query
+    (unnest): polígonos com tol_pol, o resto com a tolerância de linha de
+    cada feição. Retorna {posição em gjs: GEOSGeometry} só dos recortes não
+    vazios. Se o PostGIS recusar alguma geometria, refaz feição a feição e
+    descarta só as ruins.
+    """
+    sql = """
+        WITH a AS (
+            SELECT ST_GeomFromEWKB(%s) AS g
+        ),
+        src AS MATERIALIZED (
+            SELECT u.i, u.tol, ST_GeomFromGeoJSON(u.gj) AS g
+            FROM unnest(%s::int[], %s::text[], %s::float8[]) AS u(i, gj, tol)
+        ),
+        v AS MATERIALIZED (
+            SELECT i, tol,
+                   CASE WHEN ST_IsValid(g2) THEN g2
+                        -- polígono inválido segue polígono (o MakeValid pode
+                        -- devolver GEOMETRYCOLLECTION polígono + linha)
+                        WHEN GeometryType(g2) IN ('POLYGON', 'MULTIPOLYGON')
+                        THEN ST_CollectionExtract(ST_MakeValid(g2), 3)
+                        ELSE ST_MakeValid(g2) END AS g
+            FROM (
+                SELECT i, tol,
+                       CASE WHEN ST_SRID(g) = 0 THEN ST_SetSRID(g, 4326)
+                            ELSE ST_Transform(g, 4326) END AS g2
+                FROM src
+            ) s
+        ),
+        c AS MATERIALIZED (
+            SELECT v.i, v.tol, ST_Intersection(v.g, a.g) AS g
+            FROM v, a
+        )
+        SELECT i, ST_AsEWKB(ST_SimplifyPreserveTopology(
+                   g, CASE WHEN GeometryType(g) IN ('POLYGON', 'MULTIPOLYGON')
+                           THEN %s ELSE tol END))
+        FROM c
+        WHERE g IS NOT NULL AND NOT ST_IsEmpty(g)
+    """
+
+    def _run(idxs):
+        with transaction.atomic(), connection.cursor() as cur:
+            cur.execute(sql, [
+                aoi_ewkb, idxs, [gjs[j] for j in idxs],
+                [float(line_tols[j]) for j in idxs], float(tol_pol),
+            ])
+            return {j: GEOSGeometry(memoryview(wkb))
+                    for j, wkb in cur.fetchall() if wkb}
+
+    idxs = list(range(len(gjs)))
+    if not idxs:
+        return {}
+    try:
+        return _run(idxs)
+    except DatabaseError:
+        out = {}
+        for j in idxs:
+            try:
+                out.update(_run([j]))
+            except DatabaseError:
+                pass
+        return out
 
 
 # ============================ KML helpers (2D/3D/4D) ============================
@@ -217,7 +283,26 @@ def _coords_for_kml_line(geom) -> Tuple[List[Tuple[float, ...]], List[float]]:
     return coords_xyz, m_vals
 
 
-def _add_lines_to_kml(folder, geos_geom, line_color, name_prefix):
+def _shared_style(styles, line_color, fill_color=None):
+    """
+    Um simplekml.Style por combinação de cores, reaproveitado entre placemarks
+    (sai um único <Style> no documento, referenciado por styleUrl).
+    styles: dict do export corrente (None → estilo novo, sem cache).
+    """
+    key = (line_color, fill_color)
+    st = styles.get(key) if styles is not None else None
+    if st is None:
+        st = simplekml.Style()
+        st.linestyle.width = 2
+        st.linestyle.color = line_color
+        if fill_color is not None:
+            st.polystyle.color = fill_color
+        if styles is not None:
+            styles[key] = st
+    return st
+
+
+def _add_lines_to_kml(folder, geos_geom, line_color, name_prefix, styles=None):
     """
     Adiciona LineStrings ao KML preservando Z quando existir e guardando M (se houver)
     em ExtendedData como JSON (campo 'm_values').
@@ -227,21 +312,21 @@ def _add_lines_to_kml(folder, geos_geom, line_color, name_prefix):
         if not coords_xyz:
             continue
         ls = folder.newlinestring(name=name_prefix, coords=coords_xyz)
-        ls.style.linestyle.width = 2
-        ls.style.linestyle.color = line_color
+        ls.style = _shared_style(styles, line_color)
         if m_vals:
             try:
                 # Armazena M como JSON; um viewer pode correlacionar por índice
                 ls.extendeddata.newdata(
-                    name="m_values", value=json.dumps(m_vals))
+                    name="m_values", value=orjson.dumps(m_vals).decode())
             except Exception:
                 # Se ExtendedData falhar, seguimos em frente sem M
                 pass
 
 
-def _add_polygons_to_kml(folder, gj_geom, fill_color, line_color, name_prefix):
+def _add_polygons_to_kml(folder, geos_geom, fill_color, line_color, name_prefix, styles=None):
     """
-    Adiciona Polygon/MultiPolygon ao KML preservando Z (se houver).
+    Adiciona Polygon/MultiPolygon (GEOS) ao KML preservando Z (se houver),
+    lendo os anéis direto de .coords (sem passar por GeoJSON).
     M (4D) é descartado no KML e não é usual armazenar M por vértice em polígonos;
     se necessário um dia, poderíamos adicionar ExtendedData por anel, mas aqui omitimos.
     """
@@ -255,30 +340,31 @@ def _add_polygons_to_kml(folder, gj_geom, fill_color, line_color, name_prefix):
             out.append(out[0])
         return out
 
-    def add_polygon(coords, nm):
-        if not coords:
+    def add_polygon(poly, nm):
+        if poly.empty:
             return
-        outer = clean_ring(coords[0])
-        holes = [clean_ring(r) for r in coords[1:]] if len(coords) > 1 else []
+        outer = clean_ring(poly.exterior_ring.coords)
+        holes = [clean_ring(poly[i].coords) for i in range(1, len(poly))]
 
         p = folder.newpolygon(name=nm)
         p.outerboundaryis = outer
         if holes:
             p.innerboundaryis = holes
-        p.style.polystyle.color = fill_color
-        p.style.linestyle.color = line_color
-        p.style.linestyle.width = 2
+        p.style = style
 
-    t = (gj_geom.get("type") or "").lower()
-    if t == "polygon":
-        add_polygon(gj_geom["coordinates"], name_prefix)
-    elif t == "multipolygon":
-        for i, coords in enumerate(gj_geom["coordinates"], 1):
-            add_polygon(coords, f"{name_prefix} {i}")
+    if not geos_geom:
+        return
+    style = _shared_style(styles, line_color, fill_color)
+    if geos_geom.geom_type == "Polygon":
+        add_polygon(geos_geom, name_prefix)
+    elif geos_geom.geom_type == "MultiPolygon":
+        for i, poly in enumerate(geos_geom, 1):
+            add_polygon(poly, f"{name_prefix} {i}")
 
 
+@lru_cache(maxsize=None)
 def _color_a(alpha_int, rgb_hex_or_name):
-    """Monta cor ARGB usando helper do simplekml."""
+    """Monta cor ARGB usando helper do simplekml (memoizado: poucas combinações)."""
     from simplekml import Color
     base = getattr(Color, rgb_hex_or_name, Color.white)
     return Color.changealphaint(alpha_int, base)
@@ -300,17 +386,23 @@ def _extract_lines(geos_geom):
     return [ln for ln in lines if not ln.empty and len(ln.coords) >= 2]
 
 
+_OVERLAY_PALETTE_NAMES = ("red", "orange", "yellow", "green",
+                          "cyan", "blue", "purple", "white")
+
+
+@lru_cache(maxsize=None)
+def _overlay_palette_for(name):
+    fill = _color_a(40, name)  # ~16% opaco
+    line = getattr(simplekml.Color, name, simplekml.Color.white)
+    return fill, line
+
+
 def _overlay_palette(idx):
     """
     Define um par (fill_color, line_color) para cada overlay.
     Usa nomes suportados pelo simplekml.Color.
     """
-    names = ["red", "orange", "yellow", "green",
-             "cyan", "blue", "purple", "white"]
-    name = names[idx % len(names)]
-    fill = _color_a(40, name)  # ~16% opaco
-    line = getattr(simplekml.Color, name, simplekml.Color.white)
-    return fill, line
+    return _overlay_palette_for(_OVERLAY_PALETTE_NAMES[idx % len(_OVERLAY_PALETTE_NAMES)])
 
 
 # ============================ Endpoint unificado ============================
@@ -365,6 +457,9 @@ def export_mapa_kmz(request):
     except Exception as e:
         return Response({"detail": f"AOI inválida: {e}"}, status=400)
 
+    # AOI serializada uma vez; ligada como parâmetro em todos os recortes
+    aoi_ewkb = bytes(aoi.ewkb)
+
     # flags de camadas
     layers = (data.get("layers") or {})
     want_rios = bool(layers.get("rios"))
@@ -393,6 +488,8 @@ def export_mapa_kmz(request):
 
     # ---------- KML base ----------
     kml = simplekml.Kml()
+    # estilos compartilhados por combinação de cores (ver _shared_style)
+    styles = {}
     fld_aoi = kml.newfolder(name="AOI")
     fld_rios = None
     fld_lt = None
@@ -403,13 +500,13 @@ def export_mapa_kmz(request):
 
     # AOI (referência visual) – preserva Z se houver; M é descartado
     try:
-        aoi_gj = json.loads(aoi.json)
         _add_polygons_to_kml(
             folder=fld_aoi,
-            gj_geom=aoi_gj,
+            geos_geom=aoi,
             fill_color=_color_a(60, "cyan"),
             line_color=simplekml.Color.cyan,
-            name_prefix="AOI"
+            name_prefix="AOI",
+            styles=styles
         )
     except Exception:
         pass
@@ -418,366 +515,137 @@ def export_mapa_kmz(request):
 
     # ---------- 1) Rios (linhas) ----------
     if want_rios:
-        ids_qs = (
-            Waterway.objects
-            .filter(geom__intersects=aoi)
-            .order_by('id')
-            .values_list('id', flat=True)
-        )
-        for id_batch in _yield_ids_in_batches(ids_qs, batch_size=2000):
-            try:
-                qs = (
-                    Waterway.objects
-                    .filter(id__in=id_batch)
-                    .annotate(
-                        clipped=Intersection("geom", Value(
-                            aoi, output_field=GeometryField(srid=4326)))
-                    )
-                )
-                qs = _annotate_clip_simplify(
-                    qs, F("clipped"), tol_rios).only("id")
-
-                for row in qs:
-                    for ln in _extract_lines(row.geom_simpl):
-                        coords_xyz, m_vals = _coords_for_kml_line(ln)
-                        if not coords_xyz:
-                            continue
-                        if fld_rios is None:
-                            fld_rios = kml.newfolder(name="Rios")
-
-                        ls = fld_rios.newlinestring(coords=coords_xyz)
-                        ls.style.linestyle.width = 2
-                        ls.style.linestyle.color = simplekml.Color.royalblue
-                        if m_vals:
-                            try:
-                                ls.extendeddata.newdata(
-                                    name="m_values", value=json.dumps(m_vals))
-                            except Exception:
-                                pass
-                        total += 1
-
-            except OperationalError:
-                _refresh_conn()
-                qs = (
-                    Waterway.objects
-                    .filter(id__in=id_batch)
-                    .annotate(
-                        clipped=Intersection("geom", Value(
-                            aoi, output_field=GeometryField(srid=4326)))
-                    )
-                )
-                qs = _annotate_clip_simplify(
-                    qs, F("clipped"), tol_rios).only("id")
-
-                for row in qs:
-                    for ln in _extract_lines(row.geom_simpl):
-                        coords_xyz, m_vals = _coords_for_kml_line(ln)
-                        if not coords_xyz:
-                            continue
-                        if fld_rios is None:
-                            fld_rios = kml.newfolder(name="Rios")
-
-                        ls = fld_rios.newlinestring(coords=coords_xyz)
-                        ls.style.linestyle.width = 2
-                        ls.style.linestyle.color = simplekml.Color.royalblue
-                        if m_vals:
-                            try:
-                                ls.extendeddata.newdata(
-                                    name="m_values", value=json.dumps(m_vals))
-                            except Exception:
-                                pass
-                        total += 1
+        for geom in _iter_clipped_keyset(
+            Waterway.objects.filter(geom__intersects=aoi),
+            aoi_ewkb, tol_rios, batch_size=2000,
+        ):
+            for ln in _extract_lines(geom):
+                coords_xyz, m_vals = _coords_for_kml_line(ln)
+                if not coords_xyz:
+                    continue
+                if fld_rios is None:
+                    fld_rios = kml.newfolder(name="Rios")
+
+                ls = fld_rios.newlinestring(coords=coords_xyz)
+                ls.style = _shared_style(styles, simplekml.Color.royalblue)
+                if m_vals:
+                    try:
+                        ls.extendeddata.newdata(
+                            name="m_values", value=orjson.dumps(m_vals).decode())
+                    except Exception:
+                        pass
+                total += 1
 
     # ---------- 2) Linhas de Transmissão (linhas) ----------
     if want_lt:
-        ids_qs = (
-            LinhaTransmissao.objects
-            .filter(geom__intersects=aoi)
-            .order_by('id')
-            .values_list('id', flat=True)
-        )
-        for id_batch in _yield_ids_in_batches(ids_qs, batch_size=2000):
-            try:
-                qs = (
-                    LinhaTransmissao.objects
-                    .filter(id__in=id_batch)
-                    .annotate(clipped=Intersection("geom", Value(aoi, output_field=GeometryField(srid=4326))))
-                )
-                qs = _annotate_clip_simplify(
-                    qs, F("clipped"), tol_lt).only("id")
-                for row in qs:
-                    for ln in _extract_lines(row.geom_simpl):
-                        coords_xyz, m_vals = _coords_for_kml_line(ln)
-                        if not coords_xyz:
-                            continue
-
-                        if fld_lt is None:
-                            fld_lt = kml.newfolder(
-                                name="Linhas de Transmissão")
-
-                        ls = fld_lt.newlinestring(coords=coords_xyz)
-                        ls.style.linestyle.width = 2
-                        ls.style.linestyle.color = simplekml.Color.red
-                        if m_vals:
-                            try:
-                                ls.extendeddata.newdata(
-                                    name="m_values", value=json.dumps(m_vals))
-                            except Exception:
-                                pass
-                        total += 1
-            except OperationalError:
-                _refresh_conn()
-                qs = (
-                    LinhaTransmissao.objects
-                    .filter(id__in=id_batch)
-                    .annotate(clipped=Intersection("geom", Value(aoi, output_field=GeometryField(srid=4326))))
-                )
-                qs = _annotate_clip_simplify(
-                    qs, F("clipped"), tol_lt).only("id")
-                for row in qs:
-                    for ln in _extract_lines(row.geom_simpl):
-                        coords_xyz, m_vals = _coords_for_kml_line(ln)
-                        if not coords_xyz:
-                            continue
-                        ls = fld_lt.newlinestring(coords=coords_xyz)
-                        ls.style.linestyle.width = 2
-                        ls.style.linestyle.color = simplekml.Color.red
-                        if m_vals:
-                            try:
-                                ls.extendeddata.newdata(
-                                    name="m_values", value=json.dumps(m_vals))
-                            except Exception:
-                                pass
-                        total += 1
-
-        # ---------- 3) Malha Ferroviária (linhas) ----------
-    if want_mf:
-        ids_qs = (
-            MalhaFerroviaria.objects
-            .filter(geom__intersects=aoi)
-            .order_by('id')
-            .values_list('id', flat=True)
-        )
+        for geom in _iter_clipped_keyset(
+            LinhaTransmissao.objects.filter(geom__intersects=aoi),
+            aoi_ewkb, tol_lt, batch_size=2000,
+        ):
+            for ln in _extract_lines(geom):
+                coords_xyz, m_vals = _coords_for_kml_line(ln)
+                if not coords_xyz:
+                    continue
 
-        _some = list(ids_qs[:1])
-        if not _some:
-            print("[export_mapa_kmz] MF: 0 features intersectando AOI")
+                if fld_lt is None:
+                    fld_lt = kml.newfolder(
+                        name="Linhas de Transmissão")
+
+                ls = fld_lt.newlinestring(coords=coords_xyz)
+                ls.style = _shared_style(styles, simplekml.Color.red)
+                if m_vals:
+                    try:
+                        ls.extendeddata.newdata(
+                            name="m_values", value=orjson.dumps(m_vals).decode())
+                    except Exception:
+                        pass
+                total += 1
 
+    # ---------- 3) Malha Ferroviária (linhas) ----------
+    if want_mf:
         batch_total = 0
-        for id_batch in _yield_ids_in_batches(ids_qs, batch_size=2000):
-            try:
-                qs = (
-                    MalhaFerroviaria.objects
-                    .filter(id__in=id_batch)
-                    .annotate(
-                        clipped=Intersection("geom", Value(
-                            aoi, output_field=GeometryField(srid=4326)))
-                    )
-                )
-                qs = _annotate_clip_simplify(
-                    qs, F("clipped"), tol_mf).only("id")
-
-                for row in qs:
-                    for ln in _extract_lines(row.geom_simpl):
-                        coords_xyz, m_vals = _coords_for_kml_line(ln)
-                        if not coords_xyz:
-                            continue
-
-                        if fld_mf is None:
-                            fld_mf = kml.newfolder(name="Ferrovias")
-
-                        ls = fld_mf.newlinestring(coords=coords_xyz)
-                        ls.style.linestyle.width = 2
-                        ls.style.linestyle.color = simplekml.Color.black
-                        if m_vals:
-                            try:
-                                ls.extendeddata.newdata(
-                                    name="m_values", value=json.dumps(m_vals))
-                            except Exception:
-                                pass
-                        total += 1
-                        batch_total += 1
-
-            except OperationalError:
-                _refresh_conn()
-                qs = (
-                    MalhaFerroviaria.objects
-                    .filter(id__in=id_batch)
-                    .annotate(
-                        clipped=Intersection("geom", Value(
-                            aoi, output_field=GeometryField(srid=4326)))
-                    )
-                )
-                qs = _annotate_clip_simplify(
-                    qs, F("clipped"), tol_mf).only("id")
-
-                for row in qs:
-                    for ln in _extract_lines(row.geom_simpl):
-                        coords_xyz, m_vals = _coords_for_kml_line(ln)
-                        if not coords_xyz:
-                            continue
-
-                        if fld_mf is None:
-                            fld_mf = kml.newfolder(name="Ferrovias")
-
-                        ls = fld_mf.newlinestring(coords=coords_xyz)
-                        ls.style.linestyle.width = 2
-                        ls.style.linestyle.color = simplekml.Color.black
-                        if m_vals:
-                            try:
-                                ls.extendeddata.newdata(
-                                    name="m_values", value=json.dumps(m_vals))
-                            except Exception:
-                                pass
-                        total += 1
-                        batch_total += 1
+        for geom in _iter_clipped_keyset(
+            MalhaFerroviaria.objects.filter(geom__intersects=aoi),
+            aoi_ewkb, tol_mf, batch_size=2000,
+        ):
+            for ln in _extract_lines(geom):
+                coords_xyz, m_vals = _coords_for_kml_line(ln)
+                if not coords_xyz:
+                    continue
+
+                if fld_mf is None:
+                    fld_mf = kml.newfolder(name="Ferrovias")
+
+                ls = fld_mf.newlinestring(coords=coords_xyz)
+                ls.style = _shared_style(styles, simplekml.Color.black)
+                if m_vals:
+                    try:
+                        ls.extendeddata.newdata(
+                            name="m_values", value=orjson.dumps(m_vals).decode())
+                    except Exception:
+                        pass
+                total += 1
+                batch_total += 1
 
+        if not batch_total:
+            print("[export_mapa_kmz] MF: 0 features intersectando AOI")
         print(f"[export_mapa_kmz] MF: adicionadas {batch_total} linhas ao KML")
 
     # ---------- 4) Cidades (polígonos) ----------
     if want_cidades:
-        ids_qs = (
-            Cidade.objects
-            .filter(geom__intersects=aoi)
-            .order_by('id')
-            .values_list('id', flat=True)
-        )
-        for id_batch in _yield_ids_in_batches(ids_qs, batch_size=1000):
-            try:
-                qs = (
-                    Cidade.objects
-                    .filter(id__in=id_batch)
-                    .annotate(clipped=Intersection("geom", Value(aoi, output_field=GeometryField(srid=4326))))
-                )
-                qs = _annotate_clip_simplify(
-                    qs, F("clipped"), tol_pol).only("id")
-                for row in qs:
-                    gj = json.loads(row.geom_simpl.json)
-                    if fld_cidades is None:
-                        fld_cidades = kml.newfolder(name="Municípios")
-                    _add_polygons_to_kml(
-                        folder=fld_cidades,
-                        gj_geom=gj,
-                        fill_color=_color_a(50, "yellow"),
-                        line_color=simplekml.Color.yellow,
-                        name_prefix="Município"
-                    )
-                    total += 1
-            except OperationalError:
-                _refresh_conn()
-                qs = (
-                    Cidade.objects
-                    .filter(id__in=id_batch)
-                    .annotate(clipped=Intersection("geom", Value(aoi, output_field=GeometryField(srid=4326))))
-                )
-                qs = _annotate_clip_simplify(
-                    qs, F("clipped"), tol_pol).only("id")
-                for row in qs:
-                    gj = json.loads(row.geom_simpl.json)
-                    _add_polygons_to_kml(
-                        folder=fld_cidades,
-                        gj_geom=gj,
-                        fill_color=_color_a(50, "yellow"),
-                        line_color=simplekml.Color.yellow,
-                        name_prefix="Município"
-                    )
-                    total += 1
+        for geom in _iter_clipped_keyset(
+            Cidade.objects.filter(geom__intersects=aoi),
+            aoi_ewkb, tol_pol, batch_size=1000, make_valid=True,
+        ):
+            if fld_cidades is None:
+                fld_cidades = kml.newfolder(name="Municípios")
+            _add_polygons_to_kml(
+                folder=fld_cidades,
+                geos_geom=geom,
+                fill_color=_color_a(50, "yellow"),
+                line_color=simplekml.Color.yellow,
+                name_prefix="Município",
+                styles=styles
+            )
+            total += 1
 
     # ---------- 5) Áreas Federais (polígonos) ----------
     if want_lim_fed:
-        ids_qs = (
-            LimiteFederal.objects
-            .filter(geom__intersects=aoi)
-            .order_by('id')
-            .values_list('id', flat=True)
-        )
-        for id_batch in _yield_ids_in_batches(ids_qs, batch_size=1000):
-            try:
-                qs = (
-                    LimiteFederal.objects
-                    .filter(id__in=id_batch)
-                    .annotate(clipped=Intersection("geom", Value(aoi, output_field=GeometryField(srid=4326))))
-                )
-                qs = _annotate_clip_simplify(
-                    qs, F("clipped"), tol_pol).only("id")
-                for row in qs:
-                    gj = json.loads(row.geom_simpl.json)
-                    if fld_fed is None:
-                        fld_fed = kml.newfolder(name="Áreas Federais")
-                    _add_polygons_to_kml(
-                        folder=fld_fed,
-                        gj_geom=gj,
-                        fill_color=_color_a(60, "green"),
-                        line_color=simplekml.Color.green,
-                        name_prefix="Área Federal"
-                    )
-                    total += 1
-            except OperationalError:
-                _refresh_conn()
-                qs = (
-                    LimiteFederal.objects
-                    .filter(id__in=id_batch)
-                    .annotate(clipped=Intersection("geom", Value(aoi, output_field=GeometryField(srid=4326))))
-                )
-                qs = _annotate_clip_simplify(
-                    qs, F("clipped"), tol_pol).only("id")
-                for row in qs:
-                    gj = json.loads(row.geom_simpl.json)
-                    _add_polygons_to_kml(
-                        folder=fld_fed,
-                        gj_geom=gj,
-                        fill_color=_color_a(60, "green"),
-                        line_color=simplekml.Color.green,
-                        name_prefix="Área Federal"
-                    )
-                    total += 1
+        for geom in _iter_clipped_keyset(
+            LimiteFederal.objects.filter(geom__intersects=aoi),
+            aoi_ewkb, tol_pol, batch_size=1000, make_valid=True,
+        ):
+            if fld_fed is None:
+                fld_fed = kml.newfolder(name="Áreas Federais")
+            _add_polygons_to_kml(
+                folder=fld_fed,
+                geos_geom=geom,
+                fill_color=_color_a(60, "green"),
+                line_color=simplekml.Color.green,
+                name_prefix="Área Federal",
+                styles=styles
+            )
+            total += 1
 
     # ---------- 6) Áreas Estaduais (polígonos) ----------
     if want_areas_est:
         base_qs = Area.objects.filter(geom__intersects=aoi)
         if uf:
             base_qs = base_qs.filter(uf=uf)
-        ids_qs = base_qs.order_by('id').values_list('id', flat=True)
-        for id_batch in _yield_ids_in_batches(ids_qs, batch_size=1000):
-            try:
-                qs = (
-                    Area.objects
-                    .filter(id__in=id_batch)
-                    .annotate(clipped=Intersection("geom", Value(aoi, output_field=GeometryField(srid=4326))))
-                )
-                qs = _annotate_clip_simplify(
-                    qs, F("clipped"), tol_pol).only("id")
-                for row in qs:
-                    if fld_est is None:
-                        fld_est = kml.newfolder(name="Áreas Estaduais")
-                    gj = json.loads(row.geom_simpl.json)
-                    _add_polygons_to_kml(
-                        folder=fld_est,
-                        gj_geom=gj,
-                        fill_color=_color_a(60, "purple"),
-                        line_color=simplekml.Color.purple,
-                        name_prefix="Área Estadual"
-                    )
-                    total += 1
-            except OperationalError:
-                _refresh_conn()
-                qs = (
-                    Area.objects
-                    .filter(id__in=id_batch)
-                    .annotate(clipped=Intersection("geom", Value(aoi, output_field=GeometryField(srid=4326))))
-                )
-                qs = _annotate_clip_simplify(
-                    qs, F("clipped"), tol_pol).only("id")
-                for row in qs:
-                    gj = json.loads(row.geom_simpl.json)
-                    _add_polygons_to_kml(
-                        folder=fld_est,
-                        gj_geom=gj,
-                        fill_color=_color_a(60, "purple"),
-                        line_color=simplekml.Color.purple,
-                        name_prefix="Área Estadual"
-                    )
-                    total += 1
+        for geom in _iter_clipped_keyset(
+            base_qs, aoi_ewkb, tol_pol, batch_size=1000, make_valid=True,
+        ):
+            if fld_est is None:
+                fld_est = kml.newfolder(name="Áreas Estaduais")
+            _add_polygons_to_kml(
+                folder=fld_est,
+                geos_geom=geom,
+                fill_color=_color_a(60, "purple"),
+                line_color=simplekml.Color.purple,
+                name_prefix="Área Estadual",
+                styles=styles
+            )
+            total += 1
 
     # ---------- 7) Overlays (KMLs Secundários) ----------
     # Decide fonte: se houver algo cru, recorta no servidor; senão usa o já-recortado do cliente
@@ -794,6 +662,19 @@ def export_mapa_kmz(request):
                 return tol_mf
             return tol_lt
 
+        # recorte + simplificação de todas as feições numa query só (PostGIS)
+        pos_of, gjs, line_tols = {}, [], []
+        for i, feat in enumerate(feats):
+            if not isinstance(feat, dict) or not feat.get("geometry"):
+                continue
+            props = (feat.get("properties") or {})
+            pos_of[i] = len(gjs)
+            gjs.append(orjson.dumps(feat["geometry"]).decode())
+            line_tols.append(_line_tol_for(
+                props.get("__overlay_id") or f"overlay_{i+1}"))
+        clipped = _clip_simplify_geojson_batch(gjs, line_tols, aoi_ewkb, tol_pol)
+        del gjs
+
         id_to_color = {}
         id_to_folder = {}
 
@@ -812,37 +693,23 @@ def export_mapa_kmz(request):
                         name=str(overlay_id))
                 subfolder = id_to_folder[overlay_id]
 
-                g = _safe_geos_from_geojson(feat.get("geometry"))
-                if not g or g.empty:
-                    continue
-
-                g_clip = g.intersection(aoi)
-                if not g_clip or g_clip.empty:
+                g_clip = clipped.pop(pos_of.get(i), None)
+                if g_clip is None:
                     continue
 
                 if g_clip.geom_type in ("Polygon", "MultiPolygon"):
-                    try:
-                        g_clip = g_clip.simplify(
-                            tol_pol, preserve_topology=True)
-                    except Exception:
-                        pass
                     if g_clip.empty:
                         continue
-                    gj = json.loads(g_clip.json)
-                    _add_polygons_to_kml(folder=subfolder, gj_geom=gj, fill_color=fill_color,
-                                         line_color=line_color, name_prefix=str(overlay_id))
+                    _add_polygons_to_kml(folder=subfolder, geos_geom=g_clip, fill_color=fill_color,
+                                         line_color=line_color, name_prefix=str(overlay_id),
+                                         styles=styles)
 
                     total += 1
 
                 elif g_clip.geom_type in ("LineString", "MultiLineString", "GeometryCollection"):
-                    try:
-                        line_tol = _line_tol_for(overlay_id)
-                        g_clip_simpl = g_clip.simplify(
-                            line_tol, preserve_topology=True)
-                    except Exception:
-                        g_clip_simpl = g_clip
-                    _add_lines_to_kml(folder=subfolder, geos_geom=g_clip_simpl,
-                                      line_color=line_color, name_prefix=str(overlay_id))
+                    _add_lines_to_kml(folder=subfolder, geos_geom=g_clip,
+                                      line_color=line_color, name_prefix=str(overlay_id),
+                                      styles=styles)
 
                     total += 1
 
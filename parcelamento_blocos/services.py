@@ -2,12 +2,16 @@ from __future__ import annotations
 
 import json
 import math
+from functools import lru_cache
 from typing import Any, Dict, Optional, Tuple
 
+from django.conf import settings
 from django.contrib.gis.geos import GEOSGeometry, MultiPolygon
-from django.db import transaction
+from django.db import connection, transaction
 from pyproj import Transformer
 from shapely import affinity
+from shapely import difference as shp_difference
+from shapely import from_wkb as shp_from_wkb
 from shapely.geometry import LineString
 from shapely.geometry import MultiPolygon as ShpMultiPolygon
 from shapely.geometry import Polygon, mapping, shape
@@ -198,6 +202,32 @@ def _ensure_mpoly_shp(g):
     return None
 
 
+@lru_cache(maxsize=128)
+def _al_metric_cached(restricoes_id: int, al_wkb: bytes, srid_calc: int, inset_m: float):
+    """
+    AL (4674) -> (al_m, inner_al_m) no SRID métrico.
+    Cacheado por worker: a chave inclui o WKB da AL, então qualquer edição
+    da restrição gera outra entrada (sem risco de geometria velha).
+    """
+    tf_4674_to_m = Transformer.from_crs(4674, srid_calc, always_xy=True)
+
+    al_shp_4674 = _ensure_mpoly_shp(shp_from_wkb(al_wkb))
+    if al_shp_4674 is None or al_shp_4674.is_empty:
+        raise ValueError("AL inválida após conversão (shapely).")
+
+    al_m = _ensure_mpoly_shp(_proj_shp(al_shp_4674, tf_4674_to_m).buffer(0))
+    if al_m is None or al_m.is_empty:
+        raise ValueError("AL métrica vazia.")
+
+    # inner AL
+    if inset_m > 0:
+        inner_al_m = _ensure_mpoly_shp(al_m.buffer(-inset_m).buffer(0)) or al_m
+    else:
+        inner_al_m = al_m
+
+    return al_m, inner_al_m
+
+
 def _shp_to_geos_mpoly_4326(g_shp) -> MultiPolygon | None:
     if g_shp is None or getattr(g_shp, "is_empty", False):
         return None
@@ -350,32 +380,78 @@ def _pick_component_near_side(g_mpoly, pos_h: str):
     return max(polys, key=lambda p: p.bounds[2])
 
 
-def _fc_from_geos_queryset(qs, prop_builder=None) -> Dict[str, Any]:
-    feats = []
-    for row in qs:
-        g = getattr(row, "geom", None)
-        if not g or g.empty:
-            continue
-        geom = json.loads(g.geojson)
-        props = prop_builder(row) if prop_builder else {}
-        feats.append(
-            {"type": "Feature", "geometry": geom, "properties": props})
-    return {"type": "FeatureCollection", "features": feats}
+def _fc_quarteiroes_calcadas(versao_id: int) -> Tuple[Dict[str, Any], Dict[str, Any], int, int]:
+    """
+    Monta as duas FeatureCollections (quarteirões e calçadas) da versão
+    direto no PostGIS (ST_AsGeoJSON + jsonb_build_object), em 1 round trip.
+    Retorna (fc_quarteiroes, fc_calcadas, n_quarteiroes_total, n_calcadas_total).
+    """
+    from parcelamento.models import Calcada, Quarteirao
+
+    q_table = Quarteirao._meta.db_table
+    c_table = Calcada._meta.db_table
+    sql = f"""
+        SELECT
+          (SELECT jsonb_build_object(
+              'type', 'FeatureCollection',
+              'features', COALESCE(jsonb_agg(q.feat ORDER BY q.id), '[]'::jsonb))
+           FROM (
+             SELECT id, geom,
+                    jsonb_build_object(
+                      'type', 'Feature',
+                      'geometry', ST_AsGeoJSON(geom)::jsonb,
+                      'properties', jsonb_build_object(
+                        'id', id,
+                        'versao_id', versao_id,
+                        'numero', row_number() OVER (ORDER BY id))
+                    ) AS feat
+             FROM "{q_table}" WHERE versao_id = %s
+           ) q
+           WHERE q.geom IS NOT NULL AND NOT ST_IsEmpty(q.geom)),
+          (SELECT jsonb_build_object(
+              'type', 'FeatureCollection',
+              'features', COALESCE(jsonb_agg(
+                jsonb_build_object(
+                  'type', 'Feature',
+                  'geometry', ST_AsGeoJSON(c.geom)::jsonb,
+                  'properties', jsonb_build_object(
+                    'id', c.id,
+                    'versao_id', c.versao_id,
+                    'largura_m', c.largura_m::float8)
+                ) ORDER BY c.id), '[]'::jsonb))
+           FROM "{c_table}" c
+           WHERE c.versao_id = %s
+             AND c.geom IS NOT NULL AND NOT ST_IsEmpty(c.geom)),
+          (SELECT count(*) FROM "{q_table}" WHERE versao_id = %s),
+          (SELECT count(*) FROM "{c_table}" WHERE versao_id = %s)
+    """
+    with connection.cursor() as cur:
+        cur.execute(sql, [versao_id] * 4)
+        fc_q, fc_c, n_q, n_c = cur.fetchone()
+
+    # psycopg2 já decodifica jsonb -> dict; fallback se vier como texto
+    if isinstance(fc_q, str):
+        fc_q = json.loads(fc_q)
+    if isinstance(fc_c, str):
+        fc_c = json.loads(fc_c)
+    return fc_q, fc_c, int(n_q or 0), int(n_c or 0)
 
 
 def _remaining_rot_for_version(*, versao, inner_rot, tf_4326_to_m: Transformer, angle_deg: float, origin_xy):
     from parcelamento.models import Quarteirao
 
-    qs = Quarteirao.objects.filter(versao=versao).only("geom")
-    if not qs.exists():
-        return inner_rot
+    # só a coluna geom, em streaming (sem hidratar Quarteirao nem o JSON de ia_metadata)
+    qs = (
+        Quarteirao.objects.filter(versao=versao)
+        .values_list("geom", flat=True)
+        .iterator(chunk_size=2000)
+    )
 
     geoms = []
-    for row in qs:
-        g = row.geom
+    for g in qs:
         if not g or g.empty:
             continue
-        shp4326 = shape(json.loads(g.geojson))
+        shp4326 = shp_from_wkb(bytes(g.wkb))
         shp_m = _ensure_mpoly_shp(_proj_shp(shp4326, tf_4326_to_m))
         if shp_m is None or shp_m.is_empty:
             continue
@@ -516,25 +592,14 @@ def run_incremental_quarteiroes_calcadas(
     start_new_phase = _as_bool(params.get("start_new_phase"), default=False)
 
     # transforms
-    tf_4674_to_m = Transformer.from_crs(4674, srid_calc, always_xy=True)
     tf_m_to_4674 = Transformer.from_crs(srid_calc, 4674, always_xy=True)
     tf_4674_to_4326 = Transformer.from_crs(4674, 4326, always_xy=True)
     tf_4326_to_m = Transformer.from_crs(4326, srid_calc, always_xy=True)
 
-    al_shp_4674 = _ensure_mpoly_shp(_geos_to_shp(al_geos))
-    if al_shp_4674 is None or al_shp_4674.is_empty:
-        raise ValueError("AL inválida após conversão (shapely).")
-
-    al_m = _ensure_mpoly_shp(_proj_shp(al_shp_4674, tf_4674_to_m).buffer(0))
-    if al_m is None or al_m.is_empty:
-        raise ValueError("AL métrica vazia.")
-
-    # inner AL
-    if (not calcada_encosta_aoi) and calcada_largura_m > 0:
-        inner_al_m = _ensure_mpoly_shp(
-            al_m.buffer(-calcada_largura_m).buffer(0)) or al_m
-    else:
-        inner_al_m = al_m
+    inset_m = calcada_largura_m if (
+        not calcada_encosta_aoi) and calcada_largura_m > 0 else 0.0
+    al_m, inner_al_m = _al_metric_cached(
+        int(restricoes.id), bytes(al_geos.wkb), srid_calc, inset_m)
 
     passo_faixa = float(prof_quarteirao + larg_rua_horiz_m +
                         (2.0 * calcada_largura_m))
@@ -695,8 +760,6 @@ def run_incremental_quarteiroes_calcadas(
         "calcada": {"largura_m": calcada_largura_m, "encosta_aoi": calcada_encosta_aoi},
         "cursor_before": {"x_cursor_m": x_cursor_rel, "row_index": row_index, "done": done},
         "max_quarteiroes": int(max_quarteiroes or 1),
-        "attempts": [],
-        "created_ids": [],
         "stopped_reason": None,
     }
 
@@ -731,16 +794,13 @@ def run_incremental_quarteiroes_calcadas(
             }
 
     if done:
-        q_qs = Quarteirao.objects.filter(versao=versao).order_by("id")
-        c_qs = Calcada.objects.filter(versao=versao).order_by("id")
-        q_ids = list(q_qs.values_list("id", flat=True))
-        q_index = {qid: i + 1 for i, qid in enumerate(q_ids)}
+        fc_q, fc_c, n_q, n_c = _fc_quarteiroes_calcadas(versao.id)
         return {
             "versao_id": versao.id,
             "created": created,
-            "quarteiroes": _fc_from_geos_queryset(q_qs, prop_builder=lambda r: {"id": r.id, "versao_id": versao.id, "numero": q_index.get(r.id)}),
-            "calcadas": _fc_from_geos_queryset(c_qs, prop_builder=lambda r: {"id": r.id, "versao_id": versao.id, "largura_m": float(r.largura_m)}),
-            "metrics": {"step_index": versao.step_index, "n_quarteiroes_total": len(q_ids), "n_calcadas_total": c_qs.count(), "n_novos": 0},
+            "quarteiroes": fc_q,
+            "calcadas": fc_c,
+            "metrics": {"step_index": versao.step_index, "n_quarteiroes_total": n_q, "n_calcadas_total": n_c, "n_novos": 0},
             "debug": debug,
         }
 
@@ -757,7 +817,8 @@ def run_incremental_quarteiroes_calcadas(
 
     if anchor_x is not None:
         # começa exatamente no X da linha base (em coords rotacionadas)
-        x_cursor = float(anchor_x)
+        anchor_x = float(anchor_x)
+        x_cursor = anchor_x
     else:
         # fallback antigo
         if pos_h == "esquerda":
@@ -765,15 +826,24 @@ def run_incremental_quarteiroes_calcadas(
         else:
             x_cursor = maxx - x_cursor_rel
 
+    # log detalhado só com PARCELAMENTO_DEBUG (tuplas; vira dict no final)
+    debug_on = bool(getattr(settings, "PARCELAMENTO_DEBUG", False))
+    attempts_log = []
+    created_log = []
+
+    # coerções feitas uma vez (fora do loop)
+    max_q = int(max_quarteiroes or 1)
+    step_index_base = int(versao.step_index or 0)
+
     created_quarteiroes = 0
-    max_attempts = max(12, int(max_quarteiroes or 1) * 25)
+    max_attempts = max(12, max_q * 25)
     attempts = 0
 
     # área mínima: evita fragmentos
     min_area_ok = max(80.0, 0.08 * abs((maxx - minx) * prof_quarteirao))
 
     with transaction.atomic():
-        while created_quarteiroes < int(max_quarteiroes or 1) and attempts < max_attempts:
+        while created_quarteiroes < max_q and attempts < max_attempts:
             attempts += 1
 
             band = _row_band(bounds, prof_quarteirao,
@@ -786,8 +856,8 @@ def run_incremental_quarteiroes_calcadas(
             side_clip = _clip_from_x(bounds, x_cursor, pos_h)
             band_clip = band.intersection(side_clip).buffer(0)
             if band_clip.is_empty:
-                debug["attempts"].append(
-                    {"ok": False, "reason": "band_clip_empty", "row_index": row_index})
+                if debug_on:
+                    attempts_log.append(("band_clip_empty", row_index, None))
                 row_index += 1
                 x_cursor_rel = 0.0
                 x_cursor = (minx if pos_h == "esquerda" else maxx)
@@ -796,8 +866,8 @@ def run_incremental_quarteiroes_calcadas(
             cand = _ensure_mpoly_shp(
                 remaining_rot.intersection(band_clip).buffer(0))
             if cand is None or cand.is_empty:
-                debug["attempts"].append(
-                    {"ok": False, "reason": "no_space_in_band", "row_index": row_index})
+                if debug_on:
+                    attempts_log.append(("no_space_in_band", row_index, None))
                 row_index += 1
                 x_cursor_rel = 0.0
                 x_cursor = (minx if pos_h == "esquerda" else maxx)
@@ -805,8 +875,8 @@ def run_incremental_quarteiroes_calcadas(
 
             poly = _pick_component_near_side(cand, pos_h)
             if poly is None or poly.is_empty:
-                debug["attempts"].append(
-                    {"ok": False, "reason": "no_component", "row_index": row_index})
+                if debug_on:
+                    attempts_log.append(("no_component", row_index, None))
                 row_index += 1
                 x_cursor_rel = 0.0
                 x_cursor = (minx if pos_h == "esquerda" else maxx)
@@ -818,7 +888,7 @@ def run_incremental_quarteiroes_calcadas(
                     poly,
                     bounds=bounds,
                     pos_h=pos_h,
-                    anchor_x=float(anchor_x),
+                    anchor_x=anchor_x,
                     max_len=compr_max_quarteirao_m,
                 )
             else:
@@ -827,8 +897,8 @@ def run_incremental_quarteiroes_calcadas(
 
             poly = _ensure_mpoly_shp(poly.buffer(0))
             if poly is None or poly.is_empty or poly.area < min_area_ok:
-                debug["attempts"].append(
-                    {"ok": False, "reason": "too_small_after_clip", "row_index": row_index})
+                if debug_on:
+                    attempts_log.append(("too_small_after_clip", row_index, None))
                 row_index += 1
                 x_cursor_rel = 0.0
                 x_cursor = (minx if pos_h == "esquerda" else maxx)
@@ -849,8 +919,8 @@ def run_incremental_quarteiroes_calcadas(
             q_4326 = _proj_shp(q_4674, tf_4674_to_4326)
             q_geos = _shp_to_geos_mpoly_4326(_ensure_mpoly_shp(q_4326))
             if q_geos is None or q_geos.empty:
-                debug["attempts"].append(
-                    {"ok": False, "reason": "q_geos_empty_after_proj", "row_index": row_index})
+                if debug_on:
+                    attempts_log.append(("q_geos_empty_after_proj", row_index, None))
                 row_index += 1
                 x_cursor_rel = 0.0
                 x_cursor = (minx if pos_h == "esquerda" else maxx)
@@ -874,14 +944,17 @@ def run_incremental_quarteiroes_calcadas(
                     )
 
             created_quarteiroes += 1
-            debug["created_ids"].append({"quarteirao_id": q_obj.id, "calcada_id": getattr(
-                c_obj, "id", None), "row_index": row_index})
-            debug["attempts"].append(
-                {"ok": True, "row_index": row_index, "area_m2": float(poly.area)})
+            if debug_on:
+                created_log.append(
+                    (q_obj.id, getattr(c_obj, "id", None), row_index))
+                attempts_log.append((None, row_index, poly.area))
 
             # consome imediatamente (evita overlap dentro da mesma chamada)
-            remaining_rot = _ensure_mpoly_shp(
-                remaining_rot.difference(poly).buffer(0)) or remaining_rot
+            # OverlayNG com grid_size já devolve geometria válida (dispensa
+            # buffer(0) + _ensure_mpoly_shp a cada passo)
+            rem = shp_difference(remaining_rot, poly, grid_size=1e-9)
+            if not rem.is_empty:
+                remaining_rot = rem
 
             # próximo: por padrão vai pra próxima faixa
             row_index += 1
@@ -896,27 +969,36 @@ def run_incremental_quarteiroes_calcadas(
                 f"Não foi possível gerar nenhum quarteirão. Versão #{vid} descartada.")
 
         # salva estado
-        versao.step_index = int(versao.step_index or 0) + \
-            int(created_quarteiroes)
-        versao.cursor_state = {
-            **(versao.cursor_state or {}),
-            "x_cursor_m": float(x_cursor_rel),
-            "row_index": int(row_index),
-            "done": bool(done),
-        }
+        # x_cursor_rel/row_index/done já são float/int/bool nativos
+        versao.step_index = step_index_base + created_quarteiroes
+        cs = versao.cursor_state if isinstance(
+            versao.cursor_state, dict) else {}
+        cs["x_cursor_m"] = x_cursor_rel
+        cs["row_index"] = row_index
+        cs["done"] = done
+        versao.cursor_state = cs
+        if debug_on:
+            debug["attempts"] = [
+                {"ok": True, "row_index": ri, "area_m2": area} if reason is None
+                else {"ok": False, "reason": reason, "row_index": ri}
+                for (reason, ri, area) in attempts_log
+            ]
+            debug["created_ids"] = [
+                {"quarteirao_id": qid, "calcada_id": cid, "row_index": ri}
+                for (qid, cid, ri) in created_log
+            ]
+        else:
+            debug["n_attempts"] = attempts
         versao.debug_last = debug
         versao.save(update_fields=["step_index", "cursor_state", "debug_last"])
 
-    q_qs = Quarteirao.objects.filter(versao=versao).order_by("id")
-    c_qs = Calcada.objects.filter(versao=versao).order_by("id")
-    q_ids = list(q_qs.values_list("id", flat=True))
-    q_index = {qid: i + 1 for i, qid in enumerate(q_ids)}
+    fc_q, fc_c, n_q, n_c = _fc_quarteiroes_calcadas(versao.id)
 
     return {
         "versao_id": versao.id,
         "created": created,
-        "quarteiroes": _fc_from_geos_queryset(q_qs, prop_builder=lambda r: {"id": r.id, "versao_id": versao.id, "numero": q_index.get(r.id)}),
-        "calcadas": _fc_from_geos_queryset(c_qs, prop_builder=lambda r: {"id": r.id, "versao_id": versao.id, "largura_m": float(r.largura_m)}),
-        "metrics": {"step_index": versao.step_index, "n_quarteiroes_total": len(q_ids), "n_calcadas_total": c_qs.count(), "n_novos": int(created_quarteiroes)},
+        "quarteiroes": fc_q,
+        "calcadas": fc_c,
+        "metrics": {"step_index": versao.step_index, "n_quarteiroes_total": n_q, "n_calcadas_total": n_c, "n_novos": created_quarteiroes},
         "debug": debug,
     }
@@ -25,7 +25,3 @@ class ProjectFeatureAdmin(admin.ModelAdmin):
 @admin.register(ExportSnapshot)
 class ExportSnapshotAdmin(admin.ModelAdmin):
     list_display = ("id", "project", "artifact", "created_at")
-
-
-class ExportSnapshotAdmin(admin.ModelAdmin):
-    list_display = ("id", "project", "artifact", "created_at")
@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projetos', '0002_project_municipio'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='projectfeature',
+            index=models.Index(fields=['project', 'overlay_id'], name='projetos_pr_project_f38f6e_idx'),
+        ),
+    ]
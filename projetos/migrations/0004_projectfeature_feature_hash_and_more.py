@@ -0,0 +1,22 @@
+# Generated by Django 4.2 on 2026-10-17 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projetos', '0003_projectfeature_projetos_pr_project_f38f6e_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='projectfeature',
+            name='feature_hash',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='projectfeature',
+            constraint=models.UniqueConstraint(condition=models.Q(('feature_hash__isnull', False)), fields=('project', 'overlay_id', 'feature_hash'), name='uniq_projectfeature_hash_por_overlay'),
+        ),
+    ]
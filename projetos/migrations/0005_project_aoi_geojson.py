@@ -0,0 +1,23 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    GeoJSON da AOI como coluna gerada (STORED): calculado pelo PostgreSQL na
+    gravação de aoi_geom. Fica fora do model (Django 4.2 não tem
+    GeneratedField); as views leem a coluna via RawSQL.
+    """
+
+    dependencies = [
+        ('projetos', '0004_projectfeature_feature_hash_and_more'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=(
+                'ALTER TABLE "projetos_project" ADD COLUMN "aoi_geojson" text '
+                'GENERATED ALWAYS AS (ST_AsGeoJSON("aoi_geom")) STORED;'
+            ),
+            reverse_sql='ALTER TABLE "projetos_project" DROP COLUMN "aoi_geojson";',
+        ),
+    ]
@@ -2,6 +2,7 @@ from django.conf import settings
 from django.contrib.gis.db import models as gis
 from django.contrib.postgres.indexes import GistIndex
 from django.db import models
+from django.db.models import Q
 
 User = settings.AUTH_USER_MODEL
 
@@ -76,6 +77,9 @@ class ProjectFeature(models.Model):
     # LineString/MultiLineString/Polygon/MultiPolygon
     geom = gis.GeometryField(srid=4326)
     geom_simpl = gis.GeometryField(srid=4326, null=True, blank=True)
+    # md5 de geometria + properties + cor (overlays do payload): identifica a
+    # mesma feição entre exports; camadas base ficam NULL
+    feature_hash = models.CharField(max_length=32, blank=True, null=True)
 
     created_by = models.ForeignKey(
         User, on_delete=models.SET_NULL, null=True, blank=True, related_name="features_criadas")
@@ -86,6 +90,17 @@ class ProjectFeature(models.Model):
             GistIndex(fields=["geom"]),
             GistIndex(fields=["geom_simpl"]),
             models.Index(fields=["overlay_id"]),
+            # resumo por overlay (GROUP BY), GeoJSON e delete por overlay
+            # sempre filtram project + overlay_id
+            models.Index(fields=["project", "overlay_id"]),
+        ]
+        constraints = [
+            # re-export da mesma feição não duplica (ON CONFLICT DO NOTHING)
+            models.UniqueConstraint(
+                fields=["project", "overlay_id", "feature_hash"],
+                condition=Q(feature_hash__isnull=False),
+                name="uniq_projectfeature_hash_por_overlay",
+            ),
         ]
 
 
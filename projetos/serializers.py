@@ -1,8 +1,12 @@
 from __future__ import annotations
 
+import base64
+import binascii
 import json
+import threading
 
 from django.contrib.auth import get_user_model
+from django.contrib.gis.gdal import CoordTransform, SpatialReference
 from django.contrib.gis.geos import GEOSGeometry, MultiPolygon
 from rest_framework import serializers
 
@@ -14,6 +18,22 @@ User = get_user_model()
 # projetos/serializers.py
 
 
+_tls = threading.local()
+
+
+def _ct_to_4326(src_srid: int) -> CoordTransform:
+    # reaproveita o pipeline do PROJ por SRID de origem (evita recriar a cada
+    # AOI); um cache por thread: o CoordTransform do OGR não é thread-safe
+    cache = getattr(_tls, "ct_to_4326", None)
+    if cache is None:
+        cache = _tls.ct_to_4326 = {}
+    ct = cache.get(src_srid)
+    if ct is None:
+        ct = cache[src_srid] = CoordTransform(
+            SpatialReference(src_srid), SpatialReference(4326))
+    return ct
+
+
 class ProjectSerializer(serializers.ModelSerializer):
     owner = serializers.PrimaryKeyRelatedField(read_only=True)
     dono = serializers.PrimaryKeyRelatedField(read_only=True)
@@ -80,6 +100,10 @@ class ProjectUpsertExportSerializer(serializers.Serializer):
     simplify = serializers.JSONField(required=False, default=dict)
     overlays_raw = serializers.JSONField(required=False, default=dict)
     overlays = serializers.JSONField(required=False, default=dict)
+    # alternativa binária ao GeoJSON (parse bem mais barato):
+    # [{"overlay_id", "color", "properties", "wkb": <(E)WKB em base64>}, ...]
+    overlays_wkb = serializers.ListField(
+        child=serializers.DictField(), required=False, default=list)
     persist = serializers.BooleanField(required=False, default=True)
 
     # Opções
@@ -99,7 +123,7 @@ class ProjectUpsertExportSerializer(serializers.Serializer):
             g.srid = 4326
         elif g.srid != 4326:
             try:
-                g.transform(4326)
+                g.transform(_ct_to_4326(int(g.srid)))
             except Exception:
                 pass
         if not g.valid:
@@ -114,6 +138,21 @@ class ProjectUpsertExportSerializer(serializers.Serializer):
                 "AOI deve ser Polygon/MultiPolygon.")
         return g
 
+    def validate_overlays_wkb(self, value):
+        # decodifica o base64 aqui; a view recebe bytes prontos
+        out = []
+        for i, item in enumerate(value):
+            try:
+                wkb = base64.b64decode(item.get("wkb") or "", validate=True)
+            except (binascii.Error, ValueError):
+                raise serializers.ValidationError(
+                    f"overlays_wkb[{i}]: 'wkb' não é base64 válido.")
+            if not wkb:
+                raise serializers.ValidationError(
+                    f"overlays_wkb[{i}]: 'wkb' obrigatório.")
+            out.append({**item, "wkb": wkb})
+        return out
+
     def validate_uf(self, v):
         v = (v or "").upper().strip()
         return v[:2] or ""
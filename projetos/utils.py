@@ -2,29 +2,47 @@
 from __future__ import annotations
 
 import io
-import json
+import logging
+import threading
 import zipfile
-from typing import Dict, Iterable, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from xml.sax.saxutils import escape as xml_escape
 
+import numpy as np
+import orjson
 from django.contrib.gis.db.models import GeometryField
-from django.contrib.gis.db.models.functions import Intersection, MakeValid
 from django.contrib.gis.geos import GEOSGeometry, MultiPolygon, WKBWriter
 from django.db import connection
-from django.db.models import F, Func, Value
+from django.db.models import Func, TextField, Value
+from django.db.models.functions import Coalesce
 from django.utils.text import slugify
 # MODELS PostGIS
 from geodata.models import (Area, Cidade, LimiteFederal, LinhaTransmissao,
                             MalhaFerroviaria)
 from rios.models import Waterway
 
-try:
-    import simplekml
-except Exception:
-    simplekml = None
+logger = logging.getLogger(__name__)
 
 
 # ============================ Helpers DB / GEOS ============================
 
+_tls = threading.local()
+
+
+def _write_wkb_2d(g: GEOSGeometry) -> memoryview:
+    """
+    WKB 2D de g. Um WKBWriter por thread, reaproveitado (em vez de alocar
+    um writer GEOS por geometria; o writer não é thread-safe).
+    """
+    w = getattr(_tls, "wkb2d", None)
+    if w is None:
+        w = _tls.wkb2d = WKBWriter()
+        w.outdim = 2
+    return w.write(g)
+
+
 def _refresh_conn():
     try:
         connection.close_if_unusable_or_obsolete()
@@ -35,25 +53,19 @@ def _refresh_conn():
             pass
 
 
-def _yield_ids_in_batches(qs_ids, batch_size=2000):
-    batch = []
-    for _id in qs_ids:
-        batch.append(_id)
-        if len(batch) >= batch_size:
-            yield batch
-            batch = []
-    if batch:
-        yield batch
-
-
 def _to_geos(obj) -> GEOSGeometry:
     """
     Converte dict GeoJSON ou WKT/WKB/GeoJSON string em GEOSGeometry,
     FORÇANDO 2D se vier com Z (ex.: KMZ/KML com lon,lat,alt).
+    GEOSGeometry já pronto é só clonado (sem ida e volta por GeoJSON).
     Garante SRID=4326 e tenta validar.
     """
     # 1) Parse
-    g = GEOSGeometry(json.dumps(obj) if isinstance(obj, dict) else obj)
+    if isinstance(obj, GEOSGeometry):
+        g = obj.clone()
+    else:
+        g = GEOSGeometry(
+            orjson.dumps(obj).decode() if isinstance(obj, dict) else obj)
 
     # 2) SRID
     if g.srid is None:
@@ -64,12 +76,10 @@ def _to_geos(obj) -> GEOSGeometry:
     # 3) FORÇA 2D se vier com Z (caso típico de KMZ/KML)
     try:
         if getattr(g, "hasz", False):
-            w = WKBWriter()
-            w.outdim = 2
-            g = GEOSGeometry(w.write(g), srid=g.srid)
+            g = GEOSGeometry(_write_wkb_2d(g), srid=g.srid)
     except Exception:
-        # fallback bruto: reconstroi via WKT (também remove Z)
-        g = GEOSGeometry(g.wkt, srid=g.srid)
+        # fallback: cópia via EWKB (sem serializar texto)
+        g = GEOSGeometry(memoryview(g.ewkb), srid=g.srid)
 
     # 4) Tenta validar (evita problemas posteriores em intersecções/simplify)
     if not g.valid:
@@ -89,25 +99,111 @@ def _ensure_mp(g: GEOSGeometry) -> MultiPolygon:
     return g
 
 
-def _force2d_expr(expr):
-    """Envolve uma expressão SQL em ST_Force2D, garantindo 2D (SRID 4326)."""
-    return Func(expr, function="ST_Force2D", output_field=GeometryField(srid=4326))
+# AOI quebrada em pedaços pequenos: GEOS compara cada feição só com as
+# partes vizinhas (e não com todos os vértices da AOI)
+AOI_SUBDIVIDE_MAX_VERTICES = 128
+
+
+# acima disso a AOI é simplificada (tol_polys) antes de entrar no ST_Intersection
+AOI_SIMPLIFY_MIN_VERTICES = 10_000
+
+
+def _aoi_for_clip(aoi: GEOSGeometry, tol: float) -> GEOSGeometry:
+    """AOI usada como lado direito do recorte; reduz vértices só se for muito densa."""
+    if aoi.num_coords <= AOI_SIMPLIFY_MIN_VERTICES:
+        return aoi
+    try:
+        simpl = aoi.simplify(tol, preserve_topology=True)
+    except Exception:
+        return aoi
+    if simpl.empty:
+        return aoi
+    return _ensure_mp(simpl)
+
+
+# linhas trazidas por ida ao servidor no cursor server-side
+LAYER_CURSOR_ITERSIZE = 500
 
 
-def _annotate_clip_simplify(qs, geom_expr, tol):
+def _iter_sql_rows(sql: str, params: List, size: int) -> Iterator[Tuple]:
     """
-    MakeValid → SimplifyPreserveTopology em 2D.
-    OBS: 'geom_expr' deve estar 2D (use _force2d_expr antes).
+    Executa sql e rende as linhas em janelas de size. Com
+    DISABLE_SERVER_SIDE_CURSORS (PGBOUNCER=1) usa cursor comum + fetchmany:
+    o cursor nomeado do chunked_cursor() (WITH HOLD em autocommit, caso das
+    threads de camada) não sobrevive ao pooling por transação. Sem
+    pgbouncer, cursor server-side — o mesmo que QuerySet.iterator() abre.
     """
-    qs = qs.annotate(geom_valid=MakeValid(geom_expr)).annotate(
-        geom_simpl=Func(
-            F("geom_valid"),
-            Value(float(tol)),
-            function="ST_SimplifyPreserveTopology",
-            output_field=GeometryField(srid=4326),
+    if connection.settings_dict.get("DISABLE_SERVER_SIDE_CURSORS"):
+        with connection.cursor() as cur:
+            cur.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(size)
+                if not rows:
+                    return
+                yield from rows
+    with connection.chunked_cursor() as cur:
+        cur.cursor.itersize = size
+        cur.execute(sql, params)
+        yield from cur
+
+
+def _iter_clipped_layers(layers: List[Tuple[int, object, float, Optional[str]]], aoi_ewkb: bytes) -> Iterator[Tuple[int, Dict]]:
+    """
+    Recorta (ST_Subdivide da AOI + ST_Intersection por parte) e simplifica
+    as feições de todas as camadas pedidas que tocam a AOI, em 1 query
+    (UNION ALL entre camadas, AOI subdividida uma vez só), lida em streaming
+    por cursor server-side.
+
+    layers: [(idx, model, tol, uf|None), ...] — idx identifica a camada na saída.
+    Feição inteiramente dentro de alguma parte (ST_CoveredBy) volta como está.
+    Gera (idx, GeoJSON dict) ordenado por camada e id.
+    """
+    if not layers:
+        return
+
+    selects = []
+    params: List = [aoi_ewkb]
+    for idx, model, tol, uf in layers:
+        uf_sql = "AND t.uf = %s" if uf else ""
+        selects.append(f"""
+            SELECT {int(idx)} AS layer, %s::float8 AS tol, t.id,
+                   ST_CoveredBy(t.geom, p.g) AS inside,
+                   CASE WHEN ST_CoveredBy(t.geom, p.g) THEN t.geom
+                        ELSE ST_Intersection(t.geom, p.g) END AS g
+            FROM "{model._meta.db_table}" t
+            JOIN parts p ON ST_Intersects(t.geom, p.g)
+            WHERE TRUE {uf_sql}
+        """)
+        params.append(float(tol))
+        if uf:
+            params.append(uf)
+
+    sql = f"""
+        WITH parts AS (
+            SELECT ST_Subdivide(ST_GeomFromEWKB(%s), {AOI_SUBDIVIDE_MAX_VERTICES}) AS g
+        ),
+        hits AS ({" UNION ALL ".join(selects)})
+        SELECT layer, ST_AsGeoJSON(
+            ST_SimplifyPreserveTopology(
+                ST_MakeValid(ST_Force2D(
+                    CASE WHEN bool_or(inside)
+                         THEN (array_agg(g) FILTER (WHERE inside))[1]
+                         ELSE ST_Union(g) END
+                )),
+                tol
+            ),
+            6
         )
-    )
-    return qs
+        FROM hits
+        GROUP BY layer, tol, id
+        ORDER BY layer, id
+    """
+    for layer, gj_text in _iter_sql_rows(sql, params, LAYER_CURSOR_ITERSIZE):
+        if not gj_text:
+            continue
+        gj = orjson.loads(gj_text)
+        if gj.get("coordinates") or gj.get("geometries"):
+            yield layer, gj
 
 
 # ============================ KML helpers (XYZ e M) ============================
@@ -123,418 +219,438 @@ def _split_xyz_m(pt: Iterable[float]) -> Tuple[Tuple[float, ...], Optional[float
     return (x, y), None
 
 
-def _coords_for_kml_line(geom) -> Tuple[List[Tuple[float, ...]], List[float]]:
-    coords_xyz, m_vals = [], []
-    for pt in geom.coords:
-        xyz, m = _split_xyz_m(pt)
-        coords_xyz.append(xyz)
-        if m is not None:
-            m_vals.append(m)
+def _coords_for_kml_line(geom) -> Tuple[List[List[float]], List[float]]:
+    """
+    Aceita LineString GEOS ou lista de coordenadas GeoJSON.
+    Converte tudo de uma vez via numpy: colunas XY(Z) para o KML e M à parte.
+    """
+    pts = getattr(geom, "coords", geom)
+    try:
+        arr = np.asarray(pts, dtype=np.float64)
+    except (TypeError, ValueError):
+        arr = None
+    if arr is None or arr.ndim != 2 or arr.shape[1] < 2:
+        # coordenadas irregulares (dimensões misturadas): caminho ponto a ponto
+        coords_xyz, m_vals = [], []
+        for pt in pts:
+            xyz, m = _split_xyz_m(pt)
+            coords_xyz.append(list(xyz))
+            if m is not None:
+                m_vals.append(m)
+        return coords_xyz, m_vals
+
+    ncols = arr.shape[1]
+    coords_xyz = arr[:, :3].tolist() if ncols >= 3 else arr[:, :2].tolist()
+    m_vals = arr[:, 3].tolist() if ncols >= 4 else []
     return coords_xyz, m_vals
 
 
-def _extract_lines(geos_geom):
-    lines = []
-    if geos_geom.geom_type == "LineString":
-        lines = [geos_geom]
-    elif geos_geom.geom_type == "MultiLineString":
-        lines = list(geos_geom)
-    elif geos_geom.geom_type == "GeometryCollection":
-        for sub in geos_geom:
-            if sub.geom_type == "LineString":
-                lines.append(sub)
-            elif sub.geom_type == "MultiLineString":
-                lines.extend(list(sub))
-    return [ln for ln in lines if not ln.empty and len(ln.coords) >= 2]
+def _extract_line_coords_gj(gj: Dict) -> List[List]:
+    """Listas de coordenadas das linhas de um GeoJSON (Line/MultiLine/Collection)."""
+    t = gj.get("type")
+    if t == "LineString":
+        parts = [gj.get("coordinates") or []]
+    elif t == "MultiLineString":
+        parts = gj.get("coordinates") or []
+    elif t == "GeometryCollection":
+        parts = []
+        for sub in gj.get("geometries") or []:
+            parts.extend(_extract_line_coords_gj(sub))
+    else:
+        parts = []
+    return [c for c in parts if len(c) >= 2]
+
+
+# Cores KML (aabbggrr) — mesmos valores de simplekml.Color
+KML_COLORS = {
+    "white": "ffffffff",
+    "black": "ff000000",
+    "red": "ff0000ff",
+    "orange": "ff00a5ff",
+    "yellow": "ff00ffff",
+    "green": "ff008000",
+    "cyan": "ffffff00",
+    "blue": "ffff0000",
+    "royalblue": "ffe16941",
+    "purple": "ff800080",
+}
+
+
+@lru_cache(maxsize=None)
+def _color_a(alpha_int, rgb_name):
+    base = KML_COLORS.get(rgb_name, KML_COLORS["white"])
+    return f"{int(alpha_int) & 0xFF:02x}{base[2:]}"
 
 
-def _color_a(alpha_int, rgb_name):
-    from simplekml import Color
-    base = getattr(Color, rgb_name, Color.white)
-    return Color.changealphaint(alpha_int, base)
+def _kml_coords(coords) -> str:
+    return " ".join(",".join(repr(c) for c in pt) for pt in coords)
 
 
-def _add_lines_to_kml(folder, geos_geom, line_color, name_prefix):
-    for ln in _extract_lines(geos_geom):
-        coords_xyz, m_vals = _coords_for_kml_line(ln)
-        if not coords_xyz:
-            continue
-        ls = folder.newlinestring(name=name_prefix, coords=coords_xyz)
-        ls.style.linestyle.width = 2
-        ls.style.linestyle.color = line_color
-        if m_vals:
-            try:
-                ls.extendeddata.newdata(
-                    name="m_values", value=json.dumps(m_vals))
-            except Exception:
-                pass
+class KmlWriter:
+    """
+    Escreve KML direto num stream binário, sem montar árvore de objetos
+    (simplekml). Pastas são abertas/fechadas explicitamente e cada
+    placemark é escrito de uma vez (nunca fica XML pela metade).
+    """
+
+    def __init__(self, fp):
+        self._write = fp.write
+
+    def _out(self, text: str):
+        self._write(text.encode("utf-8"))
 
+    def open_document(self):
+        self._out('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<kml xmlns="http://www.opengis.net/kml/2.2"><Document>\n')
 
-def _add_polygons_to_kml(folder, gj_geom, line_color, name_prefix, fill_alpha: int = 0):
-    """Polígonos com preenchimento opcional (padrão 0 → só contorno)."""
+    def close_document(self):
+        self._out("</Document></kml>\n")
+
+    def open_folder(self, name: str):
+        self._out(f"<Folder><name>{xml_escape(str(name))}</name>\n")
+
+    def close_folder(self):
+        self._out("</Folder>\n")
+
+    def write_fragment(self, data: bytes):
+        """KML já pronto (ex.: pasta gerada por outro KmlWriter)."""
+        self._write(data)
+
+    def line(self, coords, color: str, *, name: Optional[str] = None, m_vals=None, width: int = 2):
+        parts = ["<Placemark>"]
+        if name:
+            parts.append(f"<name>{xml_escape(str(name))}</name>")
+        parts.append(
+            f"<Style><LineStyle><color>{color}</color><width>{width}</width></LineStyle></Style>")
+        if m_vals:
+            parts.append('<ExtendedData><Data name="m_values"><value>'
+                         f"{xml_escape(orjson.dumps(m_vals).decode())}</value></Data></ExtendedData>")
+        parts.append(
+            f"<LineString><coordinates>{_kml_coords(coords)}</coordinates></LineString>")
+        parts.append("</Placemark>\n")
+        self._out("".join(parts))
+
+    def polygon(self, outer, holes, *, line_color: str, fill_color: str, fill: bool,
+                name: Optional[str] = None, width: int = 2):
+        parts = ["<Placemark>"]
+        if name:
+            parts.append(f"<name>{xml_escape(str(name))}</name>")
+        parts.append(
+            f"<Style><LineStyle><color>{line_color}</color><width>{width}</width></LineStyle>"
+            f"<PolyStyle><color>{fill_color}</color><fill>{1 if fill else 0}</fill></PolyStyle></Style>")
+        parts.append("<Polygon><outerBoundaryIs><LinearRing><coordinates>"
+                     f"{_kml_coords(outer)}</coordinates></LinearRing></outerBoundaryIs>")
+        for ring in holes:
+            parts.append("<innerBoundaryIs><LinearRing><coordinates>"
+                         f"{_kml_coords(ring)}</coordinates></LinearRing></innerBoundaryIs>")
+        parts.append("</Polygon></Placemark>\n")
+        self._out("".join(parts))
+
+
+def _write_polygons(kw: KmlWriter, polys, line_color, name_prefix, fill_alpha: int, numbered: bool):
+    """polys: lista de polígonos, cada um lista de anéis (externo primeiro)."""
     def clean_ring(ring):
-        out = []
-        for pt in ring:
-            xyz, _m = _split_xyz_m(pt)
-            out.append(xyz)
+        out, _m = _coords_for_kml_line(ring)
         if out and out[0] != out[-1]:
             out.append(out[0])
         return out
 
-    def add_polygon(coords, nm):
-        if not coords:
-            return
-        outer = clean_ring(coords[0])
-        holes = [clean_ring(r) for r in coords[1:]] if len(coords) > 1 else []
-        p = folder.newpolygon(name=nm)
-        p.outerboundaryis = outer
-        if holes:
-            p.innerboundaryis = holes
-        p.style.polystyle.color = _color_a(fill_alpha, "white")
-        p.style.polystyle.fill = 1 if fill_alpha > 0 else 0
-        p.style.linestyle.color = line_color
-        p.style.linestyle.width = 2
+    fill_color = _color_a(fill_alpha, "white")
+    for i, rings in enumerate(polys, 1):
+        if not rings:
+            continue
+        outer = clean_ring(rings[0])
+        holes = [clean_ring(r) for r in rings[1:]]
+        nm = f"{name_prefix} {i}" if numbered else name_prefix
+        kw.polygon(outer, holes, line_color=line_color,
+                   fill_color=fill_color, fill=fill_alpha > 0, name=nm)
+
+
+def _add_polygons_to_kml(kw: KmlWriter, geos_geom, line_color, name_prefix, fill_alpha: int = 0):
+    """Polígonos GEOS com preenchimento opcional (padrão 0 → só contorno)."""
+    if geos_geom.geom_type == "Polygon":
+        polys, numbered = [geos_geom], False
+    elif geos_geom.geom_type == "MultiPolygon":
+        polys, numbered = list(geos_geom), True
+    else:
+        return
+    _write_polygons(
+        kw,
+        [[ring.coords for ring in poly] for poly in polys if not poly.empty],
+        line_color, name_prefix, fill_alpha, numbered,
+    )
+
 
+def _add_polygons_gj_to_kml(kw: KmlWriter, gj_geom, line_color, name_prefix, fill_alpha: int = 0):
+    """Mesmo que _add_polygons_to_kml, para GeoJSON já vindo do banco."""
     t = (gj_geom.get("type") or "").lower()
     if t == "polygon":
-        add_polygon(gj_geom["coordinates"], name_prefix)
+        _write_polygons(kw, [gj_geom["coordinates"]],
+                        line_color, name_prefix, fill_alpha, False)
     elif t == "multipolygon":
-        for i, coords in enumerate(gj_geom["coordinates"], 1):
-            add_polygon(coords, f"{name_prefix} {i}")
+        _write_polygons(kw, gj_geom["coordinates"],
+                        line_color, name_prefix, fill_alpha, True)
+
+
+_OVERLAY_PALETTE = tuple(
+    KML_COLORS[name] for name in
+    ("red", "orange", "yellow", "green", "cyan", "blue", "purple", "white")
+)
 
 
 def _overlay_palette(idx):
-    names = ["red", "orange", "yellow", "green",
-             "cyan", "blue", "purple", "white"]
-    name = names[idx % len(names)]
-    line = getattr(simplekml.Color, name, simplekml.Color.white)
-    return line
+    return _OVERLAY_PALETTE[idx % len(_OVERLAY_PALETTE)]
+
+
+# ============================ Camadas base ============================
+
+# (flag, model, tipo, pasta, cor (KML_COLORS), nome do placemark, fill_alpha)
+BASE_LAYERS = (
+    ("rios", Waterway, "line", "Rios", "royalblue", None, 0),
+    ("lt", LinhaTransmissao, "line", "Linhas de Transmissão", "red", None, 0),
+    ("mf", MalhaFerroviaria, "line", "Ferrovias", "black", None, 0),
+    ("cidades", Cidade, "polygon", "Municípios", "yellow", "Município", 40),
+    ("limites_federais", LimiteFederal, "polygon",
+     "Áreas Federais", "green", "Área Federal", 50),
+    ("areas_estaduais", Area, "polygon",
+     "Áreas Estaduais", "purple", "Área Estadual", 50),
+)
+
+
+def _add_base_feature(kw: KmlWriter, kind, gj, line_color, name_prefix, fill_alpha) -> int:
+    """Escreve uma feição (GeoJSON) de camada base; retorna quantos placemarks."""
+    n = 0
+    if kind == "line":
+        for ln in _extract_line_coords_gj(gj):
+            coords_xyz, m_vals = _coords_for_kml_line(ln)
+            if not coords_xyz:
+                continue
+            kw.line(coords_xyz, line_color, m_vals=m_vals)
+            n += 1
+    else:
+        _add_polygons_gj_to_kml(
+            kw,
+            gj_geom=gj,
+            line_color=line_color,
+            name_prefix=name_prefix,
+            fill_alpha=fill_alpha,
+        )
+        n += 1
+    return n
 
 
-# ============================ Builder principal ============================
+# KMZ exportado fica em memória até esse tamanho; acima vai para disco
+KMZ_SPOOL_MAX_BYTES = 32 * 1024 * 1024
 
-def build_kmz_from_payload(
-    *,
-    project,                 # instancia Project
-    aoi_geojson: dict,
-    layer_flags: Dict,
-    simplify: Dict | None = None,
-    include_saved_overlays: bool = True,
-    out_format: str = "kmz",
-) -> Tuple[bytes, str, str]:
-    """
-    Gera KML/KMZ com pastas:
-      - AOI (somente CONTORNO)
-      - Rios, LT, Ferrovias, Municípios, Áreas Federais, Áreas Estaduais (DB)
-      - Overlays Secundários (ProjectFeature) em subpastas por overlay_id
-    Usa recorte e simplificação no banco (ST_Intersection + ST_SimplifyPreserveTopology).
-    """
-    if simplekml is None:
-        raise RuntimeError("simplekml não instalado. pip install simplekml")
+# threads para as camadas base (cada uma com sua conexão ao PostGIS)
+BASE_LAYER_WORKERS = 6
 
-    simplify = simplify or {}
-    tol_lines = float(simplify.get("lines", simplify.get(
-        "rios", simplify.get("lt", 0))) or 0) or 0.00002
-    tol_polys = float(simplify.get(
-        "polygons", simplify.get("polygon", 0)) or 0) or 0.00005
 
-    # AOI garantidamente 2D + MultiPolygon
-    aoi = _ensure_mp(_to_geos(aoi_geojson))
-    if getattr(aoi, "hasz", False):
-        w = WKBWriter()
-        w.outdim = 2
-        aoi = GEOSGeometry(w.write(aoi), srid=aoi.srid or 4326)
+def _write_base_layers(kw: KmlWriter, layers, aoi_ewkb: bytes) -> int:
+    """Escreve as pastas das camadas base pedidas; retorna total de feições."""
+    total = 0
+    # linhas vêm ordenadas por camada: pasta aberta na 1ª feição e fechada na troca
+    open_idx = None
+    try:
+        for idx, gj in _iter_clipped_layers(layers, aoi_ewkb):
+            _flag, _model, kind, folder_name, color_name, name_prefix, fill_alpha = BASE_LAYERS[idx]
+            if kind == "line" and not _extract_line_coords_gj(gj):
+                continue
+            if idx != open_idx:
+                if open_idx is not None:
+                    kw.close_folder()
+                kw.open_folder(folder_name)
+                open_idx = idx
+            total += _add_base_feature(
+                kw, kind, gj, KML_COLORS[color_name], name_prefix, fill_alpha)
+    except Exception:
+        # não devolve KMZ truncado: registra, libera a conexão e falha o export
+        logger.exception(
+            "Falha ao escrever camadas base %s",
+            [BASE_LAYERS[layer[0]][3] for layer in layers])
+        _refresh_conn()
+        raise
+    finally:
+        if open_idx is not None:
+            kw.close_folder()
+    return total
+
+
+def _render_base_layer(layer, aoi_ewkb: bytes) -> Tuple[bytes, int]:
+    """Roda numa thread do pool: 1 camada -> fragmento KML (pasta completa)."""
+    buf = io.BytesIO()
+    try:
+        n = _write_base_layers(KmlWriter(buf), [layer], aoi_ewkb)
+    finally:
+        # conexão é por thread; fecha para não vazar do pool
+        connection.close()
+    return buf.getvalue(), n
+
 
-    kml = simplekml.Kml()
+# ============================ Builder principal ============================
+
+def _write_kml_document(
+    fp,
+    *,
+    project,
+    aoi: GEOSGeometry,
+    aoi_ewkb: bytes,
+    layer_flags: Dict,
+    tol_lines: float,
+    tol_polys: float,
+    include_saved_overlays: bool,
+) -> int:
+    """Escreve o documento KML inteiro em 'fp' (binário). Retorna total de feições base."""
+    kw = KmlWriter(fp)
+    kw.open_document()
 
     # 0) AOI (apenas contorno)
-    fld_aoi = kml.newfolder(name="AOI")
+    kw.open_folder("AOI")
     try:
-        aoi_gj = json.loads(aoi.json)
         _add_polygons_to_kml(
-            folder=fld_aoi,
-            gj_geom=aoi_gj,
-            line_color=simplekml.Color.cyan,
+            kw,
+            geos_geom=aoi,
+            line_color=KML_COLORS["cyan"],
             name_prefix="AOI",
             fill_alpha=0,  # sem preenchimento
         )
     except Exception:
         pass
+    kw.close_folder()
 
     total = 0
 
-    # ---------- 1) Rios ----------
-    if layer_flags.get("rios"):
-        fld_rios = None
-        ids_qs = (
-            Waterway.objects
-            .filter(geom__intersects=aoi)
-            .order_by("id")
-            .values_list("id", flat=True)
-        )
-        for id_batch in _yield_ids_in_batches(ids_qs, batch_size=2000):
-            try:
-                qs = (
-                    Waterway.objects
-                    .filter(id__in=id_batch)
-                    .annotate(clipped=Intersection("geom", Value(aoi, output_field=GeometryField(srid=4326))))
-                    .annotate(clipped2d=_force2d_expr(F("clipped")))
-                )
-                qs = _annotate_clip_simplify(
-                    qs, F("clipped2d"), tol_lines).only("id")
-                for row in qs:
-                    for ln in _extract_lines(row.geom_simpl):
-                        coords_xyz, m_vals = _coords_for_kml_line(ln)
-                        if not coords_xyz:
-                            continue
-                        if fld_rios is None:
-                            fld_rios = kml.newfolder(name="Rios")
-                        ls = fld_rios.newlinestring(coords=coords_xyz)
-                        ls.style.linestyle.width = 2
-                        ls.style.linestyle.color = simplekml.Color.royalblue
-                        if m_vals:
-                            try:
-                                ls.extendeddata.newdata(
-                                    name="m_values", value=json.dumps(m_vals))
-                            except Exception:
-                                pass
-                        total += 1
-            except Exception:
-                _refresh_conn()
-                continue
-
-    # ---------- 2) Linhas de Transmissão ----------
-    if layer_flags.get("lt"):
-        fld_lt = None
-        ids_qs = (
-            LinhaTransmissao.objects
-            .filter(geom__intersects=aoi)
-            .order_by("id")
-            .values_list("id", flat=True)
-        )
-        for id_batch in _yield_ids_in_batches(ids_qs, batch_size=2000):
-            try:
-                qs = (
-                    LinhaTransmissao.objects
-                    .filter(id__in=id_batch)
-                    .annotate(clipped=Intersection("geom", Value(aoi, output_field=GeometryField(srid=4326))))
-                    .annotate(clipped2d=_force2d_expr(F("clipped")))
-                )
-                qs = _annotate_clip_simplify(
-                    qs, F("clipped2d"), tol_lines).only("id")
-                for row in qs:
-                    for ln in _extract_lines(row.geom_simpl):
-                        coords_xyz, m_vals = _coords_for_kml_line(ln)
-                        if not coords_xyz:
-                            continue
-                        if fld_lt is None:
-                            fld_lt = kml.newfolder(
-                                name="Linhas de Transmissão")
-                        ls = fld_lt.newlinestring(coords=coords_xyz)
-                        ls.style.linestyle.width = 2
-                        ls.style.linestyle.color = simplekml.Color.red
-                        if m_vals:
-                            try:
-                                ls.extendeddata.newdata(
-                                    name="m_values", value=json.dumps(m_vals))
-                            except Exception:
-                                pass
-                        total += 1
-            except Exception:
-                _refresh_conn()
-                continue
-
-    # ---------- 3) Malha Ferroviária ----------
-    if layer_flags.get("mf"):
-        fld_mf = None
-        ids_qs = (
-            MalhaFerroviaria.objects
-            .filter(geom__intersects=aoi)
-            .order_by("id")
-            .values_list("id", flat=True)
-        )
-        for id_batch in _yield_ids_in_batches(ids_qs, batch_size=2000):
-            try:
-                qs = (
-                    MalhaFerroviaria.objects
-                    .filter(id__in=id_batch)
-                    .annotate(clipped=Intersection("geom", Value(aoi, output_field=GeometryField(srid=4326))))
-                    .annotate(clipped2d=_force2d_expr(F("clipped")))
-                )
-                qs = _annotate_clip_simplify(
-                    qs, F("clipped2d"), tol_lines).only("id")
-                for row in qs:
-                    for ln in _extract_lines(row.geom_simpl):
-                        coords_xyz, m_vals = _coords_for_kml_line(ln)
-                        if not coords_xyz:
-                            continue
-                        if fld_mf is None:
-                            fld_mf = kml.newfolder(name="Ferrovias")
-                        ls = fld_mf.newlinestring(coords=coords_xyz)
-                        ls.style.linestyle.width = 2
-                        ls.style.linestyle.color = simplekml.Color.black
-                        if m_vals:
-                            try:
-                                ls.extendeddata.newdata(
-                                    name="m_values", value=json.dumps(m_vals))
-                            except Exception:
-                                pass
-                        total += 1
-            except Exception:
-                _refresh_conn()
-                continue
-
-    # ---------- 4) Cidades ----------
-    if layer_flags.get("cidades"):
-        fld_cidades = None
-        ids_qs = (
-            Cidade.objects
-            .filter(geom__intersects=aoi)
-            .order_by("id")
-            .values_list("id", flat=True)
-        )
-        for id_batch in _yield_ids_in_batches(ids_qs, batch_size=1000):
-            try:
-                qs = (
-                    Cidade.objects
-                    .filter(id__in=id_batch)
-                    .annotate(clipped=Intersection("geom", Value(aoi, output_field=GeometryField(srid=4326))))
-                    .annotate(clipped2d=_force2d_expr(F("clipped")))
-                )
-                qs = _annotate_clip_simplify(
-                    qs, F("clipped2d"), tol_polys).only("id")
-                for row in qs:
-                    gj = json.loads(row.geom_simpl.json)
-                    if fld_cidades is None:
-                        fld_cidades = kml.newfolder(name="Municípios")
-                    _add_polygons_to_kml(
-                        folder=fld_cidades,
-                        gj_geom=gj,
-                        line_color=simplekml.Color.yellow,
-                        name_prefix="Município",
-                        fill_alpha=40,
-                    )
-                    total += 1
-            except Exception:
-                _refresh_conn()
-                continue
-
-    # ---------- 5) Áreas Federais ----------
-    if layer_flags.get("limites_federais"):
-        fld_fed = None
-        ids_qs = (
-            LimiteFederal.objects
-            .filter(geom__intersects=aoi)
-            .order_by("id")
-            .values_list("id", flat=True)
-        )
-        for id_batch in _yield_ids_in_batches(ids_qs, batch_size=1000):
-            try:
-                qs = (
-                    LimiteFederal.objects
-                    .filter(id__in=id_batch)
-                    .annotate(clipped=Intersection("geom", Value(aoi, output_field=GeometryField(srid=4326))))
-                    .annotate(clipped2d=_force2d_expr(F("clipped")))
-                )
-                qs = _annotate_clip_simplify(
-                    qs, F("clipped2d"), tol_polys).only("id")
-                for row in qs:
-                    gj = json.loads(row.geom_simpl.json)
-                    if fld_fed is None:
-                        fld_fed = kml.newfolder(name="Áreas Federais")
-                    _add_polygons_to_kml(
-                        folder=fld_fed,
-                        gj_geom=gj,
-                        line_color=simplekml.Color.green,
-                        name_prefix="Área Federal",
-                        fill_alpha=50,
-                    )
-                    total += 1
-            except Exception:
-                _refresh_conn()
-                continue
-
-    # ---------- 6) Áreas Estaduais ----------
-    if layer_flags.get("areas_estaduais"):
-        fld_est = None
-        base_qs = Area.objects.filter(geom__intersects=aoi)
-        # opcional: filtra por UF do projeto, se existir
-        try:
-            if getattr(project, "uf", None):
-                base_qs = base_qs.filter(uf=project.uf)
-        except Exception:
-            pass
-        ids_qs = base_qs.order_by("id").values_list("id", flat=True)
-        for id_batch in _yield_ids_in_batches(ids_qs, batch_size=1000):
-            try:
-                qs = (
-                    Area.objects
-                    .filter(id__in=id_batch)
-                    .annotate(clipped=Intersection("geom", Value(aoi, output_field=GeometryField(srid=4326))))
-                    .annotate(clipped2d=_force2d_expr(F("clipped")))
-                )
-                qs = _annotate_clip_simplify(
-                    qs, F("clipped2d"), tol_polys).only("id")
-                for row in qs:
-                    gj = json.loads(row.geom_simpl.json)
-                    if fld_est is None:
-                        fld_est = kml.newfolder(name="Áreas Estaduais")
-                    _add_polygons_to_kml(
-                        folder=fld_est,
-                        gj_geom=gj,
-                        line_color=simplekml.Color.purple,
-                        name_prefix="Área Estadual",
-                        fill_alpha=50,
-                    )
-                    total += 1
-            except Exception:
-                _refresh_conn()
-                continue
+    # ---------- 1-6) Camadas base (DB) ----------
+    uf = getattr(project, "uf", None) or None
+    layers = [
+        (idx, model, tol_lines if kind == "line" else tol_polys,
+         # opcional: filtra Áreas Estaduais por UF do projeto, se existir
+         uf if model is Area else None)
+        for idx, (flag, model, kind, *_rest) in enumerate(BASE_LAYERS)
+        if layer_flags.get(flag)
+    ]
+    if len(layers) > 1 and BASE_LAYER_WORKERS > 1:
+        # camadas independentes em paralelo (1 conexão por thread);
+        # fragmentos entram no documento na ordem de BASE_LAYERS
+        with ThreadPoolExecutor(max_workers=min(BASE_LAYER_WORKERS, len(layers))) as ex:
+            futures = [ex.submit(_render_base_layer, layer, aoi_ewkb)
+                       for layer in layers]
+            for layer, fut in zip(layers, futures):
+                try:
+                    fragment, n = fut.result()
+                except Exception:
+                    # pasta faltando não passa em silêncio: falha o export
+                    logger.exception(
+                        "Falha na camada base %s", BASE_LAYERS[layer[0]][3])
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+                kw.write_fragment(fragment)
+                total += n
+    else:
+        total += _write_base_layers(kw, layers, aoi_ewkb)
 
     # ---------- 7) Overlays Secundários (salvos no PostGIS) ----------
     if include_saved_overlays:
         from .models import ProjectFeature  # import local para evitar ciclos
+
+        # GeoJSON (2D) e tipo já saem prontos do banco: sem carregar GEOS por feição
+        g_expr = Func(Coalesce("geom_simpl", "geom"),
+                      function="ST_Force2D", output_field=GeometryField(srid=4326))
         feats = (
             ProjectFeature.objects
             .filter(project=project)
-            .only("overlay_id", "properties", "color", "geom", "geom_simpl")
+            .annotate(
+                gj=Func(g_expr, Value(6), function="ST_AsGeoJSON",
+                        output_field=TextField()),
+                gtype=Func(g_expr, function="GeometryType",
+                           output_field=TextField()),
+            )
+            .values_list("overlay_id", "properties", "gj", "gtype")
         )
 
         groups: Dict[str, List] = {}
-        for pf in feats.iterator():
-            groups.setdefault(pf.overlay_id or "overlay", []).append(pf)
+        for overlay_id, props, gj_text, gtype in feats.iterator():
+            if not gj_text:
+                continue
+            groups.setdefault(overlay_id or "overlay", []).append(
+                (props, gj_text, gtype))
 
         if groups:
-            fld_over = kml.newfolder(name="Overlays")
+            kw.open_folder("Overlays")
             for idx, (overlay_id, items) in enumerate(sorted(groups.items(), key=lambda x: x[0])):
-                sub = fld_over.newfolder(name=str(overlay_id))
+                kw.open_folder(str(overlay_id))
                 line_color = _overlay_palette(idx)
-                for pf in items:
-                    g = pf.geom_simpl or pf.geom
-                    if not g or g.empty:
-                        continue
-                    # (em tese estes campos estão 2D; se quiser blindar:)
-                    if getattr(g, "hasz", False):
-                        try:
-                            w = WKBWriter()
-                            w.outdim = 2
-                            g = GEOSGeometry(w.write(g), srid=g.srid or 4326)
-                        except Exception:
-                            g = GEOSGeometry(g.wkt, srid=g.srid or 4326)
-
-                    nm = (pf.properties or {}).get("name") or overlay_id
-                    if g.geom_type in ("LineString", "MultiLineString", "GeometryCollection"):
-                        _add_lines_to_kml(sub, g, line_color, nm)
-                    elif g.geom_type in ("Polygon", "MultiPolygon"):
-                        gj = json.loads(g.json)
-                        _add_polygons_to_kml(
-                            folder=sub,
-                            gj_geom=gj,
+                for props, gj_text, gtype in items:
+                    nm = (props or {}).get("name") or overlay_id
+                    if gtype in ("LINESTRING", "MULTILINESTRING", "GEOMETRYCOLLECTION"):
+                        for ln in _extract_line_coords_gj(orjson.loads(gj_text)):
+                            coords_xyz, m_vals = _coords_for_kml_line(ln)
+                            if coords_xyz:
+                                kw.line(coords_xyz, line_color,
+                                        name=nm, m_vals=m_vals)
+                    elif gtype in ("POLYGON", "MULTIPOLYGON"):
+                        _add_polygons_gj_to_kml(
+                            kw,
+                            gj_geom=orjson.loads(gj_text),
                             line_color=line_color,
                             name_prefix=nm,
                             fill_alpha=40,
                         )
                     # (points/others ignorados)
+                kw.close_folder()
+            kw.close_folder()
+
+    kw.close_document()
+    return total
+
+
+def write_kmz_from_payload(
+    fp,
+    *,
+    project,                 # instancia Project
+    aoi_geojson: dict | GEOSGeometry,
+    layer_flags: Dict,
+    simplify: Dict | None = None,
+    include_saved_overlays: bool = True,
+    out_format: str = "kmz",
+    compresslevel: int = 1,
+) -> Tuple[str, str]:
+    """
+    Gera KML/KMZ com pastas:
+      - AOI (somente CONTORNO)
+      - Rios, LT, Ferrovias, Municípios, Áreas Federais, Áreas Estaduais (DB)
+      - Overlays Secundários (ProjectFeature) em subpastas por overlay_id
+    Usa recorte e simplificação no banco (ST_Intersection + ST_SimplifyPreserveTopology).
+    O KML é escrito direto em bytes (KmlWriter), sem simplekml, no arquivo
+    binário 'fp' (seekable; ex.: SpooledTemporaryFile). Retorna (filename, content_type).
+    compresslevel: DEFLATE do doc.kml no KMZ (1 = rápido; 0 = sem compressão,
+    útil quando a resposta já sai com gzip no HTTP).
+    """
+    simplify = simplify or {}
+    tol_lines = float(simplify.get("lines", simplify.get(
+        "rios", simplify.get("lt", 0))) or 0) or 0.00002
+    tol_polys = float(simplify.get(
+        "polygons", simplify.get("polygon", 0)) or 0) or 0.00005
+
+    # AOI garantidamente 2D + MultiPolygon
+    aoi = _ensure_mp(_to_geos(aoi_geojson))
+    if getattr(aoi, "hasz", False):
+        aoi = GEOSGeometry(_write_wkb_2d(aoi), srid=aoi.srid or 4326)
+
+    # a AOI original continua sendo desenhada na pasta "AOI"
+    aoi_ewkb = bytes(_aoi_for_clip(aoi, tol_polys).ewkb)
+
+    write_doc = partial(
+        _write_kml_document,
+        project=project,
+        aoi=aoi,
+        aoi_ewkb=aoi_ewkb,
+        layer_flags=layer_flags,
+        tol_lines=tol_lines,
+        tol_polys=tol_polys,
+        include_saved_overlays=include_saved_overlays,
+    )
 
     # ---------- Saída ----------
     # Nome base usando o NOME DO PROJETO (slug) como preferência
@@ -543,26 +659,34 @@ def build_kmz_from_payload(
     base_slug = slugify(nome_proj)
 
     if out_format.lower() == "kml":
-        payload = kml.kml().encode("utf-8")
-        return payload, f"{base_slug}.kml", "application/vnd.google-earth.kml+xml"
+        write_doc(fp)
+        return f"{base_slug}.kml", "application/vnd.google-earth.kml+xml"
+
+    # pasta interna do KMZ com nome do projeto
+    internal_folder = f"{base_slug}/"   # ex: "loteamento-x/"
+
+    if compresslevel and compresslevel > 0:
+        zip_kw = {"compression": zipfile.ZIP_DEFLATED,
+                  "compresslevel": min(int(compresslevel), 9)}
     else:
-        kml_bytes = kml.kml().encode("utf-8")
-
-        # pasta interna do KMZ com nome do projeto
-        internal_folder = f"{base_slug}/"   # ex: "loteamento-x/"
-
-        buf = io.BytesIO()
-        with zipfile.ZipFile(buf, "w") as zf:
-            # mimetype primeiro sem compressão (KMZ válido) - fica na raiz
-            zinfo = zipfile.ZipInfo("mimetype")
-            zinfo.compress_type = zipfile.ZIP_STORED
-            zf.writestr(zinfo, b"application/vnd.google-earth.kmz")
-
-            # doc.kml dentro da pasta do projeto
-            zf.writestr(
-                internal_folder + "doc.kml",
-                kml_bytes,
-                compress_type=zipfile.ZIP_DEFLATED,
-            )
+        zip_kw = {"compression": zipfile.ZIP_STORED}
+
+    with zipfile.ZipFile(fp, "w", **zip_kw) as zf:
+        # mimetype primeiro sem compressão (KMZ válido) - fica na raiz
+        zinfo = zipfile.ZipInfo("mimetype")
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zf.writestr(zinfo, b"application/vnd.google-earth.kmz")
+
+        # doc.kml dentro da pasta do projeto, escrito em streaming
+        # (o KML inteiro nunca fica em memória descomprimido)
+        with zf.open(internal_folder + "doc.kml", "w", force_zip64=True) as doc_fp:
+            write_doc(doc_fp)
+
+    return f"{base_slug}.kmz", "application/vnd.google-earth.kmz"
+
 
-        return buf.getvalue(), f"{base_slug}.kmz", "application/vnd.google-earth.kmz"
+def build_kmz_from_payload(**kwargs) -> Tuple[bytes, str, str]:
+    """Mesmo que write_kmz_from_payload, devolvendo os bytes (bytes, filename, content_type)."""
+    buf = io.BytesIO()
+    filename, content_type = write_kmz_from_payload(buf, **kwargs)
+    return buf.getvalue(), filename, content_type
@@ -1,15 +1,16 @@
 from __future__ import annotations
 
-import json
+import tempfile
 from typing import Any, Dict, List, Optional, Set
 
-from django.contrib.gis.db.models import GeometryField
-from django.contrib.gis.db.models.functions import Intersection, MakeValid
-from django.contrib.gis.geos import GEOSGeometry, MultiPolygon, WKBWriter
-from django.core.files.base import ContentFile
-from django.db import connection, transaction
-from django.db.models import F, Func, Value
-from django.http import HttpResponse
+import orjson
+import shapely
+from django.contrib.gis.geos import GEOSGeometry, MultiPolygon
+from django.core.files.base import File
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models import Count, Min, Q, TextField
+from django.db.models.expressions import RawSQL
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils.timezone import now
 from geodata.models import (Area, Cidade, LimiteFederal, LinhaTransmissao,
@@ -22,62 +23,41 @@ from rios.models import Waterway
 
 from .models import ExportSnapshot, MapArtifact, Project, ProjectFeature
 from .serializers import ProjectSerializer, ProjectUpsertExportSerializer
-from .utils import build_kmz_from_payload
+from .utils import (AOI_SUBDIVIDE_MAX_VERTICES, KMZ_SPOOL_MAX_BYTES,
+                    _aoi_for_clip, _write_wkb_2d, write_kmz_from_payload)
 
 # ------------------------------------------------------------------------------
 # Helpers
 # ------------------------------------------------------------------------------
 
+# janela de ProjectFeature lidas por vez no streaming do GeoJSON
+PF_FLUSH_SIZE = 500
 
-def _force2d_now(g):
-    """Força 2D AGORA (independente do que veio antes)."""
-    if not g:
-        return g
-    try:
-        if getattr(g, "hasz", False):
-            w = WKBWriter()
-            w.outdim = 2
-            return GEOSGeometry(w.write(g), srid=g.srid or 4326)
-    except Exception:
-        return GEOSGeometry(g.wkt, srid=g.srid or 4326)
-    return g
+
+def _aoi_geojson_col():
+    """
+    Coluna gerada aoi_geojson (ST_AsGeoJSON(aoi_geom) STORED, migration
+    0005): o GeoJSON da AOI é calculado na gravação, não a cada leitura.
+    """
+    return RawSQL(f'"{Project._meta.db_table}"."aoi_geojson"', [],
+                  output_field=TextField())
 
 
 def _geos_force2d(g: Optional[GEOSGeometry]) -> Optional[GEOSGeometry]:
-    if not g:
+    """Força 2D (só reescreve quando há Z)."""
+    if g is None or not g.hasz:
         return g
-    try:
-        if getattr(g, "hasz", False):
-            w = WKBWriter()
-            w.outdim = 2
-            return GEOSGeometry(w.write(g), srid=g.srid or 4326)
-    except Exception:
-        return GEOSGeometry(g.wkt, srid=g.srid or 4326)
-    return g
-
-
-def _yield_ids_in_batches(qs_ids, batch_size=2000):
-    batch = []
-    for _id in qs_ids:
-        batch.append(_id)
-        if len(batch) >= batch_size:
-            yield batch
-            batch = []
-    if batch:
-        yield batch
+    return GEOSGeometry(_write_wkb_2d(g), srid=g.srid or 4326)
 
 
 def _same_tenant_or_owner(user, project: Project) -> bool:
-    try:
-        if getattr(user, "role", None) == "dono":
-            return project.dono_id == getattr(user, "id", None)
-        if project.owner_id == getattr(user, "id", None):
-            return True
-        if getattr(user, "dono", None):
-            return project.dono_id == getattr(user, "dono", None)
-        return project.owner_id == getattr(user, "id", None)
-    except Exception:
-        return project.owner_id == getattr(user, "id", None)
+    # Mantém a regra atual: "dono" edita os projetos do seu tenant; demais
+    # usuários só os que criaram (membros do tenant não entram aqui).
+    # Ids apenas: não carrega o usuário dono (user.dono)
+    user_id = getattr(user, "id", None)
+    if getattr(user, "role", None) == "dono":
+        return project.dono_id == user_id
+    return project.owner_id == user_id
 
 
 def _ensure_mp(g: GEOSGeometry) -> GEOSGeometry:
@@ -89,18 +69,16 @@ def _ensure_mp(g: GEOSGeometry) -> GEOSGeometry:
         f"AOI deve ser Polygon ou MultiPolygon; veio {g.geom_type}")
 
 
-def _force2d_all_geom_fields(instance):
-    for f in instance._meta.get_fields():
-        gf = getattr(f, "target_field", f)
-        if isinstance(gf, GeometryField):
-            name = getattr(f, "attname", f.name)
-            val = getattr(instance, name, None)
-            if val is not None:
-                setattr(instance, name, _geos_force2d(val))
-
 # ---------------- Lógica simples de dono ----------------
 
 
+def _full_name(nome, sobrenome, email):
+    """Mesmo resultado de User.get_full_name() a partir de colunas soltas."""
+    if nome:
+        return f"{nome} {sobrenome or ''}".strip()
+    return email
+
+
 def _resolve_dono(user):
     # Mesmo padrão que você já tinha: se for dono, ele próprio; senão, FK user.dono
     if getattr(user, "role", None) == "dono":
@@ -135,8 +113,39 @@ def list_projects(request):
     # if user.is_superuser:
     #     qs = Project.objects.all().order_by("-updated_at", "-created_at")
 
-    serializer = ProjectSerializer(qs, many=True)
-    return Response(serializer.data)
+    # mesmo formato do ProjectSerializer, mas numa query só: owner/dono vêm
+    # por JOIN (sem 2 queries por projeto) e a AOI já sai em GeoJSON do banco
+    rows = qs.annotate(aoi_gj=_aoi_geojson_col()).values(
+        "id", "name", "description", "uf", "municipio",
+        "owner_id", "owner__nome", "owner__sobrenome", "owner__email",
+        "dono_id", "dono__nome", "dono__sobrenome", "dono__email",
+        "created_at", "updated_at", "aoi_gj", "layer_flags",
+    )
+    data = [
+        {
+            "id": r["id"],
+            "name": r["name"],
+            "description": r["description"],
+            "uf": r["uf"],
+            "municipio": r["municipio"],
+            "owner": r["owner_id"],
+            "owner_nome": _full_name(
+                r["owner__nome"], r["owner__sobrenome"], r["owner__email"]),
+            "owner_email": r["owner__email"],
+            "dono": r["dono_id"],
+            "dono_nome": _full_name(
+                r["dono__nome"], r["dono__sobrenome"], r["dono__email"]),
+            "dono_email": r["dono__email"],
+            "created_at": r["created_at"],
+            "updated_at": r["updated_at"],
+            "aoi_geom": orjson.Fragment(r["aoi_gj"]) if r["aoi_gj"] else None,
+            "layer_flags": r["layer_flags"],
+        }
+        for r in rows
+    ]
+    # OPT_UTC_Z: datas no mesmo formato do DRF (...Z)
+    return HttpResponse(orjson.dumps(data, option=orjson.OPT_UTC_Z),
+                        content_type="application/json")
 
 
 @api_view(["GET", "PATCH", "DELETE"])
@@ -168,31 +177,33 @@ def update_delete_project(request, pk: int):
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def project_map_summary(request, pk: int):
-    proj = get_object_or_404(Project, pk=pk)
-
-    counts, colors = {}, {}
-    for pf in ProjectFeature.objects.filter(project=proj).only("overlay_id", "color").iterator():
-        counts[pf.overlay_id] = counts.get(pf.overlay_id, 0) + 1
-        if pf.color and pf.overlay_id not in colors:
-            colors[pf.overlay_id] = pf.color
+    # AOI já sai como GeoJSON guardado no banco (sem GEOS nem ST_AsGeoJSON)
+    proj = get_object_or_404(
+        Project.objects.defer("aoi_geom").annotate(aoi_gj=_aoi_geojson_col()),
+        pk=pk,
+    )
 
-    overlays = [
-        {"overlay_id": k, "count": counts.get(k, 0), "color": colors.get(k)}
-        for k in sorted(counts.keys())
-    ]
+    # contagem/cor por overlay agregadas no banco (1 linha por overlay)
+    overlays = list(
+        ProjectFeature.objects.filter(project=proj)
+        .values("overlay_id")
+        .annotate(count=Count("*"), color=Min("color", filter=Q(color__gt="")))
+        .order_by("overlay_id")
+    )
 
-    return Response({
+    # orjson direto no HttpResponse; a AOI entra como texto já pronto (Fragment)
+    return HttpResponse(orjson.dumps({
         "id": proj.id,
         "name": proj.name,
         "description": proj.description,
         "uf": proj.uf,
         "municipio": proj.municipio,
-        "aoi": json.loads(proj.aoi_geom.geojson) if proj.aoi_geom else None,
+        "aoi": orjson.Fragment(proj.aoi_gj) if proj.aoi_gj else None,
         "layer_flags": proj.layer_flags or {},
         "overlays": overlays,
         "dono": proj.dono_id,
         "owner": proj.owner_id,
-    })
+    }), content_type="application/json")
 
 
 @api_view(["GET"])
@@ -208,21 +219,45 @@ def project_features_geojson(request, pk: int):
     simplified = str(request.query_params.get("simplified", "true")).lower() in {
         "1", "true", "yes", "y"}
 
-    feats = []
-    qs = ProjectFeature.objects.filter(project=proj, overlay_id=overlay_id).only(
-        "geom", "geom_simpl", "properties", "color"
-    )
-    for pf in qs.iterator():
-        g = pf.geom_simpl if simplified and pf.geom_simpl else pf.geom
-        if not g:
-            continue
-        feats.append({
-            "type": "Feature",
-            "properties": {**(pf.properties or {}), "__overlay_id": overlay_id, "__color": pf.color},
-            "geometry": json.loads(g.geojson),
-        })
-
-    return Response({"type": "FeatureCollection", "features": feats})
+    # cada Feature sai pronta como texto JSON do PostgreSQL (properties já
+    # com __overlay_id/__color + ST_AsGeoJSON); o Python só junta as janelas.
+    # Concatenação de texto, não jsonb_build_object: o GeoJSON da geometria
+    # não é reparseado para jsonb
+    sql = f"""
+        SELECT '{{"type":"Feature","properties":'
+               || (COALESCE(properties, '{{}}'::jsonb)
+                   || jsonb_build_object('__overlay_id', %s::text,
+                                         '__color', color))::text
+               || ',"geometry":'
+               || ST_AsGeoJSON(COALESCE(
+                      CASE WHEN %s THEN geom_simpl END, geom))
+               || '}}'
+        FROM "{ProjectFeature._meta.db_table}"
+        WHERE project_id = %s AND overlay_id = %s AND geom IS NOT NULL
+    """
+    params = [overlay_id, simplified, proj.pk, overlay_id]
+
+    # cursor server-side: lê e envia em janelas, sem montar o corpo todo.
+    # chunked_cursor() ignora DISABLE_SERVER_SIDE_CURSORS; com pgbouncer
+    # (pooling por transação) usa cursor comum + fetchmany
+    no_server_side = connection.settings_dict.get(
+        "DISABLE_SERVER_SIDE_CURSORS")
+
+    def _stream():
+        yield '{"type":"FeatureCollection","features":['
+        sep = ""
+        with (connection.cursor() if no_server_side
+              else connection.chunked_cursor()) as cur:
+            cur.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(PF_FLUSH_SIZE)
+                if not rows:
+                    break
+                yield sep + ",".join([row[0] for row in rows])
+                sep = ","
+        yield "]}"
+
+    return StreamingHttpResponse(_stream(), content_type="application/json")
 
 
 @api_view(["PATCH"])
@@ -236,12 +271,71 @@ def project_overlay_patch(request, pk: int):
         return Response({"detail": "overlay_id é obrigatório."}, status=400)
     new_overlay_id = (request.data or {}).get("new_overlay_id")
     color = (request.data or {}).get("color")
-    qs = ProjectFeature.objects.filter(project=proj, overlay_id=overlay_id)
-    if new_overlay_id:
-        qs.update(overlay_id=str(new_overlay_id)[:200])
+    updates = {}
+    if new_overlay_id and str(new_overlay_id)[:200] != overlay_id:
+        updates["overlay_id"] = str(new_overlay_id)[:200]
     if color is not None:
-        qs.update(color=str(color)[:16])
-    return Response({"ok": True})
+        updates["color"] = str(color)[:16]
+    if not updates:
+        return Response({"ok": True, "updated": 0, "merged": 0})
+
+    target = updates.get("overlay_id", overlay_id)
+    new_color = updates.get("color")
+    pf_table = ProjectFeature._meta.db_table
+    # feature_hash recalculado com a cor final (mesmo md5 de _clip_overlays:
+    # geometria + properties + cor); camadas base seguem com hash NULL
+    new_hash = """
+        CASE WHEN pf.feature_hash IS NULL THEN NULL
+             ELSE md5(ST_AsEWKB(pf.geom)
+                      || convert_to(pf.properties::text, 'UTF8')
+                      || convert_to(COALESCE(%s, pf.color, ''), 'UTF8')) END
+    """
+    # feições que, depois da troca, repetiriam uma que já existe no overlay
+    # de destino (ou outra do próprio overlay) são fundidas: fica uma só
+    merge_sql = f"""
+        WITH u AS (
+            SELECT pf.id, {new_hash} AS h
+            FROM "{pf_table}" pf
+            WHERE pf.project_id = %s AND pf.overlay_id = %s
+        )
+        DELETE FROM "{pf_table}" WHERE id IN (
+            SELECT u.id FROM u
+            WHERE u.h IS NOT NULL AND (
+                EXISTS (SELECT 1 FROM "{pf_table}" o
+                        WHERE o.project_id = %s AND o.overlay_id = %s
+                          AND o.overlay_id <> %s AND o.feature_hash = u.h)
+                OR EXISTS (SELECT 1 FROM u u2
+                           WHERE u2.h = u.h AND u2.id < u.id)
+            )
+        )
+    """
+    # um único UPDATE mesmo quando renomeia e troca cor juntos; só cor: não
+    # reescreve (nova versão da linha + índices) as que já estão com ela
+    update_sql = f"""
+        UPDATE "{pf_table}" pf
+        SET overlay_id = %s, color = COALESCE(%s, pf.color),
+            feature_hash = {new_hash}
+        WHERE pf.project_id = %s AND pf.overlay_id = %s
+          AND (%s OR pf.color IS DISTINCT FROM %s)
+    """
+    try:
+        with transaction.atomic(), connection.cursor() as cur:
+            cur.execute(merge_sql, [
+                new_color, proj.pk, overlay_id,
+                proj.pk, target, overlay_id,
+            ])
+            merged = cur.rowcount
+            cur.execute(update_sql, [
+                target, new_color, new_color, proj.pk, overlay_id,
+                "overlay_id" in updates, new_color,
+            ])
+            n = cur.rowcount
+    except IntegrityError:
+        # export concorrente gravou a mesma feição no destino no meio tempo
+        return Response(
+            {"detail": "Conflito com feições do overlay de destino; tente novamente."},
+            status=409)
+    return Response({"ok": True, "updated": n, "merged": merged})
 
 
 @api_view(["DELETE"])
@@ -294,6 +388,9 @@ def exportar_projeto(request):
     uf = v.get("uf") or None
     municipio = (v.get("municipio") or "").strip() or None
 
+    # overlays em WKB (base64 já decodificado pelo serializer)
+    overlays_wkb = v.get("overlays_wkb") or []
+
     # Aceita "layers" (novo) ou "layer_flags" (legado)
     layers = (v.get("layers") or v.get("layer_flags") or {}) or {}
 
@@ -304,36 +401,6 @@ def exportar_projeto(request):
     created = False
 
     # ---------- Helpers locais ----------
-    def _force2d_sql(expr):
-        """Wrap em ST_Force2D(expr)"""
-        return Func(expr, function="ST_Force2D", output_field=GeometryField(srid=4326))
-
-    def _db_intersection_2d(geom: GEOSGeometry, aoi_mp: GEOSGeometry) -> Optional[GEOSGeometry]:
-        """Interseção no PostGIS forçando 2D em entradas e saída."""
-        if not geom or geom.empty or not aoi_mp or aoi_mp.empty:
-            return None
-        try:
-            with connection.cursor() as cur:
-                cur.execute(
-                    """
-                    SELECT ST_AsEWKB(
-                        ST_Force2D(
-                            ST_Intersection(
-                                ST_MakeValid(ST_Force2D(%s::geometry)),
-                                ST_MakeValid(ST_Force2D(%s::geometry))
-                            )
-                        )
-                    )
-                    """,
-                    [geom.ewkb, aoi_mp.ewkb],
-                )
-                row = cur.fetchone()
-                if not row or not row[0]:
-                    return None
-                return GEOSGeometry(memoryview(row[0]))
-        except Exception:
-            return None
-
     def _iter_features(fc: Dict):
         if not fc:
             return []
@@ -344,11 +411,24 @@ def exportar_projeto(request):
             return [fc]
         return []
 
-    def _geos_from_json_2d(geom_obj: Any) -> GEOSGeometry:
-        """GEOS em 4326 e 2D (remove Z implicitamente)."""
-        g = GEOSGeometry(json.dumps(geom_obj) if isinstance(
-            geom_obj, (dict, list)) else str(geom_obj)
-        )
+    def _geos_from_json_2d(geom_obj: Any, make_valid: bool = True) -> GEOSGeometry:
+        """
+        GEOS em 4326 e 2D (remove Z implicitamente).
+        GeoJSON (dict sem 'crs') vai pelo leitor GeoJSON do shapely e entra
+        no GEOS como WKB já 2D, sem o parser de texto do GDAL.
+        make_valid=False deixa a validação para o PostGIS (ST_MakeValid no
+        recorte em lote).
+        """
+        if isinstance(geom_obj, GEOSGeometry):
+            g = geom_obj.clone()
+        elif isinstance(geom_obj, dict) and "crs" not in geom_obj:
+            wkb = shapely.to_wkb(shapely.from_geojson(orjson.dumps(geom_obj)),
+                                 output_dimension=2)
+            g = GEOSGeometry(memoryview(wkb), srid=4326)
+        else:
+            g = GEOSGeometry(orjson.dumps(geom_obj).decode() if isinstance(
+                geom_obj, (dict, list)) else str(geom_obj)
+            )
         if g.srid in (None, 0):
             g.srid = 4326
         elif g.srid != 4326:
@@ -357,15 +437,8 @@ def exportar_projeto(request):
             except Exception:
                 pass
         # “achata” para 2D se veio com Z
-        try:
-            if getattr(g, "hasz", False):
-                from django.contrib.gis.geos import WKBWriter
-                w = WKBWriter()
-                w.outdim = 2
-                g = GEOSGeometry(w.write(g), srid=g.srid or 4326)
-        except Exception:
-            g = GEOSGeometry(g.wkt, srid=g.srid or 4326)
-        if not g.valid:
+        g = _geos_force2d(g)
+        if make_valid and not g.valid:
             try:
                 g = g.buffer(0)
             except Exception:
@@ -373,7 +446,8 @@ def exportar_projeto(request):
         return g
 
     # ---------- Variáveis que serão usadas fora da transação ----------
-    km_bytes = None
+    km_file = None
+    km_size = 0
     filename = None
     content_type = None
     overlays_used: Set[str] = set()
@@ -420,7 +494,7 @@ def exportar_projeto(request):
                 created = True
 
         # AOI 2D (sempre, para o KMZ)
-        proj.aoi_geom = _geos_from_json_2d(json.loads(aoi.geojson))
+        proj.aoi_geom = _geos_from_json_2d(aoi)
 
         # layer_flags ficam apenas em memória se persist=False;
         # se persist=True, acabam salvos em banco.
@@ -447,12 +521,27 @@ def exportar_projeto(request):
         else:
             tol_polys = float(simplify.get("polygon", 0.00005))
 
-        to_create = []
+        # serializa a AOI de recorte uma única vez; todas as queries ligam
+        # esses bytes como parâmetro (texto SQL estável entre lotes).
+        # Os filtros (&& / ST_Intersects) seguem usando a AOI original.
+        aoi_full_ewkb = bytes(proj.aoi_geom.ewkb)
+        aoi_ewkb = bytes(_aoi_for_clip(proj.aoi_geom, tol_polys).ewkb)
+
         overlays_used = set()
-        overlays_touched: Set[str] = set()
         total_in = 0
         total_clip = 0
 
+        pf_table = ProjectFeature._meta.db_table
+        pf_cols = ", ".join(
+            f'"{ProjectFeature._meta.get_field(name).column}"'
+            for name in ("project", "overlay_id", "properties", "color",
+                         "geom", "geom_simpl", "created_by", "created_at")
+        )
+
+        # 1) prepara as feições; 2) parse/recorte/gravação todos no PostGIS
+        staged = []
+        gjs: List[Optional[str]] = []
+        wkbs: List[Optional[bytes]] = []
         for f in feats:
             geom = f.get("geometry")
             if not geom:
@@ -464,169 +553,267 @@ def exportar_projeto(request):
                 props.get("overlay_id") or props.get("name") or "overlay",
             )
             color = props.pop("__color", None)
+            staged.append((
+                str(overlay_id)[:200],
+                str(color)[:16] if color else None,
+                orjson.dumps(props).decode(),
+            ))
+            # a geometria segue como texto GeoJSON (ST_GeomFromGeoJSON);
+            # só o que não é dict (WKT etc.) passa antes pelo GEOS
+            gjs.append(
+                orjson.dumps(geom).decode() if isinstance(geom, dict)
+                else _geos_from_json_2d(geom, make_valid=False).json
+            )
+            wkbs.append(None)
 
-            g = _geos_from_json_2d(geom)
-            inter = _db_intersection_2d(g, proj.aoi_geom)
-            if not inter or inter.empty:
-                continue
-            total_clip += 1
-
-            try:
-                if inter.geom_type in (
-                    "LineString",
-                    "MultiLineString",
-                    "GeometryCollection",
-                ):
-                    g_simpl = inter.simplify(tol_lines, preserve_topology=True)
-                else:
-                    g_simpl = inter.simplify(tol_polys, preserve_topology=True)
-            except Exception:
-                g_simpl = inter
-
-            to_create.append(
-                ProjectFeature(
-                    project=proj,
-                    overlay_id=str(overlay_id)[:200],
-                    properties=props,
-                    color=(str(color)[:16] if color else None),
-                    geom=inter,
-                    geom_simpl=g_simpl,
-                    created_by=user,
+        # overlays já em (E)WKB: vão direto para ST_GeomFromEWKB, sem GeoJSON
+        for item in overlays_wkb:
+            total_in += 1
+            props = dict(item.get("properties") or {})
+            overlay_id = (item.get("overlay_id") or props.get("overlay_id")
+                          or props.get("name") or "overlay")
+            color = item.get("color")
+            staged.append((
+                str(overlay_id)[:200],
+                str(color)[:16] if color else None,
+                orjson.dumps(props).decode(),
+            ))
+            gjs.append(None)
+            wkbs.append(item["wkb"])
+
+        def _clip_overlays(idxs: List[int], write: bool) -> List[str]:
+            """
+            Recorta as feições staged[idxs] pela AOI numa única query (unnest
+            de arrays com overlay_id/cor/properties/GeoJSON ou EWKB). O parse,
+            o 2D (ST_Force2D) e o MakeValid das feições são feitos pelo
+            PostGIS; 'crs' do GeoJSON é respeitado (ST_Transform para 4326).
+            A AOI é validada uma vez só no CTE. Mantém só a maior dimensão de
+            cada recorte (ST_CollectionExtract) e simplifica com a tolerância
+            de linhas ou de polígonos; geom_simpl fica NULL quando não mudou.
+            Feição inteira dentro da AOI (ST_CoveredBy, com a AOI preparada
+            e cacheada pelo PostGIS) entra sem ST_Intersection; fora dela
+            (sem ST_Intersects) vira NULL e é descartada.
+            Parse, recorte e simplificação ficam em CTEs MATERIALIZED,
+            calculados uma vez por feição (embutidos, repetiriam a cada uso).
+            write=True grava as ProjectFeature na mesma query, como UPSERT
+            por feature_hash (md5 de geometria + properties + cor): feição
+            que já existe no overlay não é regravada (ON CONFLICT DO
+            NOTHING). Com replace_overlays, um DELETE no CTE tira só as
+            antigas que não vieram de novo (sem apagar/reinserir as iguais).
+            Retorna o overlay_id de cada recorte.
+            """
+            final = f"""
+                , s AS MATERIALIZED (
+                    SELECT k.*, ST_SimplifyPreserveTopology(
+                               g, CASE ST_Dimension(g) WHEN 1 THEN %s
+                                                       ELSE %s END) AS gs,
+                           md5(ST_AsEWKB(g)
+                               || convert_to(props::text, 'UTF8')
+                               || convert_to(COALESCE(color, ''), 'UTF8')) AS h
+                    FROM k
+                ),
+                d AS (
+                    DELETE FROM "{pf_table}" pf
+                    WHERE %s AND pf.project_id = %s
+                      AND pf.overlay_id IN (SELECT overlay_id FROM s)
+                      AND NOT EXISTS (
+                          SELECT 1 FROM s
+                          WHERE s.overlay_id = pf.overlay_id
+                            AND s.h = pf.feature_hash
+                      )
+                ),
+                ins AS (
+                    INSERT INTO "{pf_table}" ({pf_cols}, "feature_hash")
+                    SELECT %s, overlay_id, props, color, g,
+                           CASE WHEN ST_OrderingEquals(gs, g)
+                                THEN NULL ELSE gs END,
+                           %s, now(), h
+                    FROM s
+                    ORDER BY i
+                    ON CONFLICT (project_id, overlay_id, feature_hash)
+                        WHERE feature_hash IS NOT NULL
+                    DO NOTHING
                 )
-            )
-            overlays_used.add(str(overlay_id))
-            overlays_touched.add(str(overlay_id))
+                SELECT overlay_id FROM s ORDER BY i
+            """ if write else "SELECT overlay_id FROM k"
+            sql = f"""
+                WITH a AS (
+                    SELECT ST_MakeValid(ST_Force2D(ST_GeomFromEWKB(%s))) AS g
+                ),
+                src AS MATERIALIZED (
+                    SELECT t.i, t.overlay_id, t.color, t.props::jsonb AS props,
+                           COALESCE(ST_GeomFromEWKB(t.wkb),
+                                    ST_GeomFromGeoJSON(t.gj)) AS g
+                    FROM unnest(%s::int[], %s::text[], %s::text[], %s::text[],
+                                %s::text[], %s::bytea[])
+                         AS t(i, overlay_id, color, props, gj, wkb)
+                ),
+                v AS MATERIALIZED (
+                    SELECT i, overlay_id, color, props,
+                           ST_MakeValid(ST_Force2D(
+                               CASE WHEN ST_SRID(g) = 0
+                                    THEN ST_SetSRID(g, 4326)
+                                    ELSE ST_Transform(g, 4326) END)) AS g
+                    FROM src
+                ),
+                c AS MATERIALIZED (
+                    SELECT v.i, v.overlay_id, v.color, v.props,
+                           CASE WHEN ST_CoveredBy(v.g, a.g) THEN v.g
+                                WHEN ST_Intersects(v.g, a.g)
+                                THEN ST_Force2D(ST_Intersection(v.g, a.g))
+                           END AS g
+                    FROM v, a
+                ),
+                k AS (
+                    SELECT i, overlay_id, color, props,
+                           ST_CollectionExtract(
+                               g, CASE ST_Dimension(g) WHEN 2 THEN 3
+                                                       WHEN 1 THEN 2
+                                                       ELSE 1 END) AS g
+                    FROM c
+                    WHERE g IS NOT NULL AND NOT ST_IsEmpty(g)
+                )
+                {final}
+            """
+            params = [
+                aoi_ewkb,
+                idxs,
+                [staged[i][0] for i in idxs],
+                [staged[i][1] for i in idxs],
+                [staged[i][2] for i in idxs],
+                [gjs[i] for i in idxs],
+                [wkbs[i] for i in idxs],
+            ]
+            if write:
+                params += [tol_lines, tol_polys, bool(replace_overlays),
+                           proj.pk, proj.pk, getattr(user, "pk", None)]
+            with connection.cursor() as cur:
+                cur.execute(sql, params)
+                return [row[0] for row in cur.fetchall()]
 
-        if persist:
-            if replace_overlays and overlays_touched:
-                ProjectFeature.objects.filter(
-                    project=proj, overlay_id__in=list(overlays_touched)
-                ).delete()
-            if to_create:
-                ProjectFeature.objects.bulk_create(to_create, batch_size=1000)
+        if staged:
+            idxs = list(range(len(staged)))
+            try:
+                # savepoint: uma falha aqui não aborta a transação do export
+                with transaction.atomic():
+                    clipped_ids = _clip_overlays(idxs, persist)
+            except DatabaseError:
+                # alguma geometria que o PostGIS recusa: testa uma a uma
+                # (só recorte, sem gravar) e refaz o lote sem as rejeitadas
+                ok = []
+                for i in idxs:
+                    try:
+                        with transaction.atomic():
+                            _clip_overlays([i], False)
+                        ok.append(i)
+                    except DatabaseError:
+                        pass
+                clipped_ids = _clip_overlays(ok, persist) if ok else []
+            total_clip = len(clipped_ids)
+            overlays_used = set(clipped_ids)
 
         # ---------- Camadas base (rios, LT, etc.) ----------
-        base_creates = []
-
-        def _save_lines(Model, overlay_name: str):
-            ids = (
-                Model.objects.filter(geom__intersects=proj.aoi_geom)
-                .order_by("id")
-                .values_list("id", flat=True)
-            )
-            for batch in _yield_ids_in_batches(ids, batch_size=2000):
-                qs = (
-                    Model.objects.filter(id__in=batch)
-                    .annotate(
-                        clipped=Intersection(
-                            "geom",
-                            Value(
-                                proj.aoi_geom,
-                                output_field=GeometryField(srid=4326),
-                            ),
-                        )
-                    )
-                )
-                # Força 2D ANTES de MakeValid/Simplify
-                qs = qs.annotate(clipped2d=_force2d_sql(F("clipped")))
-                qs = qs.annotate(geom_valid=MakeValid(F("clipped2d"))).annotate(
-                    geom_simpl=Func(
-                        F("geom_valid"),
-                        Value(float(tol_lines)),
-                        function="ST_SimplifyPreserveTopology",
-                        output_field=GeometryField(srid=4326),
+        def _save_base_layers(specs):
+            """
+            Recorta/simplifica as camadas pedidas e grava as ProjectFeature
+            num único INSERT ... SELECT (nenhuma geometria passa pelo Python).
+            specs: [(Model, overlay_name, tol, uf|None), ...]; as camadas
+            entram como ramos de um UNION ALL, na mesma transação do export.
+            Sem ORDER BY: o Append já grava camada a camada, na ordem da
+            varredura, sem ordenar (sort) as geometrias recortadas.
+            && (bbox, GiST) + ST_Intersects contra as partes da AOI original
+            (ST_Subdivide: bboxes justas mesmo com AOI irregular) e
+            ST_Intersection com a AOI de recorte, as duas ligadas como EWKB
+            (feição inteira dentro da AOI, ST_CoveredBy, entra sem recorte).
+            Força 2D ANTES de MakeValid/Simplify. O recorte fica num CTE
+            MATERIALIZED: sem ele o PostgreSQL embute o CTE e repete o
+            ST_Intersection a cada uso de g (filtro e simplificação).
+            geom já é a versão
+            simplificada, então geom_simpl fica NULL (sem duplicar bytes).
+            Não dá para espalhar as camadas em threads (1 conexão cada): o
+            projeto recém-criado ainda não está commitado (FK falharia nas
+            outras conexões) e persist=False precisa desfazer tudo junto.
+            Obs.: as colunas geom das camadas base precisam de índice espacial
+            (GiST; SP-GiST rende mais em polígonos muito sobrepostos) para o
+            && usar índice.
+            """
+            if not specs:
+                return
+            selects = []
+            params = [aoi_full_ewkb, aoi_ewkb]
+            for Model, overlay_name, tol, uf in specs:
+                uf_sql = "AND t.uf = %s" if uf else ""
+                selects.append(f"""
+                    SELECT %s::text AS overlay_name, %s::float8 AS tol,
+                           ST_MakeValid(ST_Force2D(
+                               CASE WHEN ST_CoveredBy(t.geom, a.clip_g)
+                                    THEN t.geom
+                                    ELSE ST_Intersection(t.geom, a.clip_g)
+                               END)) AS g
+                    FROM "{Model._meta.db_table}" t, a
+                    WHERE EXISTS (
+                        SELECT 1 FROM parts p
+                        WHERE t.geom && p.g AND ST_Intersects(t.geom, p.g)
                     )
+                    {uf_sql}
+                """)
+                params += [overlay_name, float(tol)]
+                if uf:
+                    params.append(uf)
+            sql = f"""
+                WITH parts AS (
+                    SELECT ST_Subdivide(ST_MakeValid(ST_GeomFromEWKB(%s)),
+                                        {AOI_SUBDIVIDE_MAX_VERTICES}) AS g
+                ),
+                a AS (
+                    SELECT ST_GeomFromEWKB(%s) AS clip_g
+                ),
+                c AS MATERIALIZED ({" UNION ALL ".join(selects)}),
+                s AS (
+                    SELECT overlay_name, COALESCE(
+                        ST_SimplifyPreserveTopology(g, tol), g) AS g
+                    FROM c
+                    WHERE g IS NOT NULL AND NOT ST_IsEmpty(g)
                 )
-                for row in qs.only("id"):
-                    g = getattr(row, "geom_simpl", None) or getattr(
-                        row, "geom_valid", None
-                    )
-                    if g and not g.empty:
-                        base_creates.append(
-                            ProjectFeature(
-                                project=proj,
-                                overlay_id=overlay_name,
-                                properties={},
-                                color=None,
-                                geom=g,
-                                geom_simpl=g,
-                                created_by=user,
-                            )
-                        )
-
-        def _save_polys(Model, overlay_name: str, extra_filter=None):
-            base = Model.objects.filter(geom__intersects=proj.aoi_geom)
-            if extra_filter:
-                base = base.filter(**extra_filter)
-            ids = base.order_by("id").values_list("id", flat=True)
-            for batch in _yield_ids_in_batches(ids, batch_size=1000):
-                qs = (
-                    Model.objects.filter(id__in=batch)
-                    .annotate(
-                        clipped=Intersection(
-                            "geom",
-                            Value(
-                                proj.aoi_geom,
-                                output_field=GeometryField(srid=4326),
-                            ),
-                        )
-                    )
-                )
-                # Força 2D ANTES de MakeValid/Simplify
-                qs = qs.annotate(clipped2d=_force2d_sql(F("clipped")))
-                qs = qs.annotate(geom_valid=MakeValid(F("clipped2d"))).annotate(
-                    geom_simpl=Func(
-                        F("geom_valid"),
-                        Value(float(tol_polys)),
-                        function="ST_SimplifyPreserveTopology",
-                        output_field=GeometryField(srid=4326),
-                    )
-                )
-                for row in qs.only("id"):
-                    g = getattr(row, "geom_simpl", None) or getattr(
-                        row, "geom_valid", None
-                    )
-                    if g and not g.empty:
-                        base_creates.append(
-                            ProjectFeature(
-                                project=proj,
-                                overlay_id=overlay_name,
-                                properties={},
-                                color=None,
-                                geom=g,
-                                geom_simpl=g,
-                                created_by=user,
-                            )
-                        )
+                INSERT INTO "{pf_table}" ({pf_cols})
+                SELECT %s, overlay_name, '{{}}'::jsonb, NULL, g, NULL, %s, now()
+                FROM s
+            """
+            params += [proj.pk, getattr(user, "pk", None)]
+            with connection.cursor() as cur:
+                cur.execute(sql, params)
 
         if persist:
+            specs = []
             if layers.get("rios"):
-                _save_lines(Waterway, "Rios")
+                specs.append((Waterway, "Rios", tol_lines, None))
             if layers.get("lt"):
-                _save_lines(LinhaTransmissao, "Linhas de Transmissão")
+                specs.append((LinhaTransmissao, "Linhas de Transmissão", tol_lines, None))
             if layers.get("mf"):
-                _save_lines(MalhaFerroviaria, "Ferrovias")
+                specs.append((MalhaFerroviaria, "Ferrovias", tol_lines, None))
             if layers.get("cidades"):
-                _save_polys(Cidade, "Municípios")
+                specs.append((Cidade, "Municípios", tol_polys, None))
             if layers.get("limites_federais"):
-                _save_polys(LimiteFederal, "Áreas Federais")
+                specs.append((LimiteFederal, "Áreas Federais", tol_polys, None))
             if layers.get("areas_estaduais"):
-                extra = {"uf": proj.uf} if proj.uf else None
-                _save_polys(Area, "Áreas Estaduais", extra_filter=extra)
-
-            if base_creates:
-                ProjectFeature.objects.bulk_create(
-                    base_creates, batch_size=1000)
+                specs.append((Area, "Áreas Estaduais", tol_polys, proj.uf or None))
+            _save_base_layers(specs)
 
         # ---------- Gera KML/KMZ ainda DENTRO da transação ----------
-        km_bytes, filename, content_type = build_kmz_from_payload(
+        # direto num arquivo temporário (em memória até KMZ_SPOOL_MAX_BYTES):
+        # o mesmo blob vai para o storage e para a resposta, sem cópias
+        km_file = tempfile.SpooledTemporaryFile(max_size=KMZ_SPOOL_MAX_BYTES)
+        filename, content_type = write_kmz_from_payload(
+            km_file,
             project=proj,
-            aoi_geojson=json.loads(proj.aoi_geom.geojson),
+            # AOI já em GEOS 2D/4326: sem serializar/reparsear GeoJSON
+            aoi_geojson=proj.aoi_geom,
             layer_flags=proj.layer_flags or {},
             simplify=simplify,
             include_saved_overlays=True,
             out_format=out_format,
         )
+        km_size = km_file.tell()
 
         # Se NÃO for pra persistir, marcamos rollback:
         # nada do que fizemos no banco é realmente gravado.
@@ -640,10 +827,11 @@ def exportar_projeto(request):
                 project=proj,
                 kind="export",
                 content_type=content_type,
-                size_bytes=len(km_bytes),
+                size_bytes=km_size,
                 meta={"filename": filename},
             )
-            artifact.file.save(filename, ContentFile(km_bytes), save=True)
+            km_file.seek(0)
+            artifact.file.save(filename, File(km_file), save=True)
             ExportSnapshot.objects.create(
                 project=proj,
                 artifact=artifact,
@@ -656,8 +844,9 @@ def exportar_projeto(request):
             pass
 
     # ---------- Resposta ----------
-    resp = HttpResponse(km_bytes, content_type=content_type)
-    resp["Content-Disposition"] = f'attachment; filename="{filename}"'
+    km_file.seek(0)
+    resp = FileResponse(km_file, content_type=content_type,
+                        as_attachment=True, filename=filename)
 
     if persist:
         resp["X-Proj-Id"] = str(proj.id)
@@ -668,6 +857,6 @@ def exportar_projeto(request):
         resp["X-Proj-Created"] = "0"
 
     resp["X-Overlays-Used"] = ",".join(sorted(overlays_used))
-    resp["X-Features-In"] = str(len(feats))
+    resp["X-Features-In"] = str(len(feats) + len(overlays_wkb))
     resp["X-Features-Clipped"] = str(total_clip)
     return resp
@@ -61,6 +61,6 @@ class MargemFerroviaVAdmin(admin.ModelAdmin):
     list_filter = ["restricoes"]
 
 @admin.register(ManualRestricaoV)
-class MargemFerroviaVAdmin(admin.ModelAdmin):
+class ManualRestricaoVAdmin(admin.ModelAdmin):
     list_display = ["id", "restricoes"]
     list_filter = ["restricoes"]
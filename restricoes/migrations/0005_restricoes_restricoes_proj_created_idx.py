@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-17 10:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('restricoes', '0004_restricoes_is_oficial_alter_restricoes_project_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='restricoes',
+            index=models.Index(fields=['project', '-created_at'], name='restricoes_proj_created_idx'),
+        ),
+    ]
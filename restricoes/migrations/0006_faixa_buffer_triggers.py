@@ -0,0 +1,83 @@
+from django.db import migrations
+
+FAIXA_SQL = """
+-- buffer em metros (Web Mercator) recortado pela AOI da restrição;
+-- NULL se não sobra polígono dentro da AOI
+CREATE OR REPLACE FUNCTION restricoes_faixa_buffer(
+    line geometry, meters double precision, rid bigint
+) RETURNS geometry
+LANGUAGE sql STABLE AS $$
+    SELECT CASE WHEN ST_IsEmpty(f) THEN NULL ELSE ST_Multi(f) END
+    FROM (
+        SELECT ST_CollectionExtract(ST_MakeValid(ST_Intersection(
+                   ST_MakeValid(ST_Transform(
+                       ST_Buffer(ST_Transform(line, 3857), meters), 4674)),
+                   r.aoi_snapshot)), 3) AS f
+        FROM restricoes_restricoes r
+        WHERE r.id = rid
+          AND line IS NOT NULL
+          AND meters > 0
+          AND r.aoi_snapshot IS NOT NULL
+    ) s
+$$;
+
+CREATE OR REPLACE FUNCTION restricoes_ruav_mask() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    NEW.mask := restricoes_faixa_buffer(
+        NEW.eixo, NEW.largura_m / 2.0, NEW.restricoes_id);
+    RETURN NEW;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION restricoes_margem_faixa() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    NEW.faixa := restricoes_faixa_buffer(
+        NEW.centerline, NEW.margem_m, NEW.restricoes_id);
+    RETURN NEW;
+END
+$$;
+
+CREATE TRIGGER restricoes_ruav_mask
+    BEFORE INSERT OR UPDATE OF eixo, largura_m ON restricoes_ruav
+    FOR EACH ROW EXECUTE FUNCTION restricoes_ruav_mask();
+
+CREATE TRIGGER restricoes_margemriov_faixa
+    BEFORE INSERT OR UPDATE OF centerline, margem_m ON restricoes_margemriov
+    FOR EACH ROW EXECUTE FUNCTION restricoes_margem_faixa();
+
+CREATE TRIGGER restricoes_margemltv_faixa
+    BEFORE INSERT OR UPDATE OF centerline, margem_m ON restricoes_margemltv
+    FOR EACH ROW EXECUTE FUNCTION restricoes_margem_faixa();
+
+CREATE TRIGGER restricoes_margemferroviav_faixa
+    BEFORE INSERT OR UPDATE OF centerline, margem_m ON restricoes_margemferroviav
+    FOR EACH ROW EXECUTE FUNCTION restricoes_margem_faixa();
+"""
+
+FAIXA_REVERSE_SQL = """
+DROP TRIGGER IF EXISTS restricoes_margemferroviav_faixa ON restricoes_margemferroviav;
+DROP TRIGGER IF EXISTS restricoes_margemltv_faixa ON restricoes_margemltv;
+DROP TRIGGER IF EXISTS restricoes_margemriov_faixa ON restricoes_margemriov;
+DROP TRIGGER IF EXISTS restricoes_ruav_mask ON restricoes_ruav;
+DROP FUNCTION IF EXISTS restricoes_margem_faixa();
+DROP FUNCTION IF EXISTS restricoes_ruav_mask();
+DROP FUNCTION IF EXISTS restricoes_faixa_buffer(geometry, double precision, bigint);
+"""
+
+
+class Migration(migrations.Migration):
+    """
+    mask (ruas) e faixa (margens) calculadas no PostGIS por trigger, a partir
+    do eixo/centerline, da largura/margem e da aoi_snapshot da restrição:
+    o buffer não passa mais pelo Python (nem ida e volta de WKB).
+    """
+
+    dependencies = [
+        ('restricoes', '0005_restricoes_restricoes_proj_created_idx'),
+    ]
+
+    operations = [
+        migrations.RunSQL(sql=FAIXA_SQL, reverse_sql=FAIXA_REVERSE_SQL),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 4.2 on 2026-10-17 11:00
+
+import django.contrib.gis.db.models.fields
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('restricoes', '0006_faixa_buffer_triggers'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='ruav',
+            name='restricoes__eixo_21332f_gist',
+        ),
+        migrations.RemoveIndex(
+            model_name='margemriov',
+            name='restricoes__centerl_a0b188_gist',
+        ),
+        migrations.RemoveIndex(
+            model_name='margemltv',
+            name='restricoes__centerl_3758c5_gist',
+        ),
+        migrations.RemoveIndex(
+            model_name='margemferroviav',
+            name='restricoes__centerl_41c968_gist',
+        ),
+        migrations.AlterField(
+            model_name='ruav',
+            name='eixo',
+            field=django.contrib.gis.db.models.fields.MultiLineStringField(spatial_index=False, srid=4674),
+        ),
+        migrations.AlterField(
+            model_name='margemriov',
+            name='centerline',
+            field=django.contrib.gis.db.models.fields.MultiLineStringField(spatial_index=False, srid=4674),
+        ),
+        migrations.AlterField(
+            model_name='margemltv',
+            name='centerline',
+            field=django.contrib.gis.db.models.fields.MultiLineStringField(spatial_index=False, srid=4674),
+        ),
+        migrations.AlterField(
+            model_name='margemferroviav',
+            name='centerline',
+            field=django.contrib.gis.db.models.fields.MultiLineStringField(spatial_index=False, srid=4674),
+        ),
+        migrations.AddIndex(
+            model_name='ruav',
+            index=django.contrib.postgres.indexes.SpGistIndex(fields=['eixo'], name='restr_rua_eixo_spgist'),
+        ),
+        migrations.AddIndex(
+            model_name='margemriov',
+            index=django.contrib.postgres.indexes.SpGistIndex(fields=['centerline'], name='restr_rio_centerl_spgist'),
+        ),
+        migrations.AddIndex(
+            model_name='margemltv',
+            index=django.contrib.postgres.indexes.SpGistIndex(fields=['centerline'], name='restr_lt_centerl_spgist'),
+        ),
+        migrations.AddIndex(
+            model_name='margemferroviav',
+            index=django.contrib.postgres.indexes.SpGistIndex(fields=['centerline'], name='restr_fer_centerl_spgist'),
+        ),
+    ]
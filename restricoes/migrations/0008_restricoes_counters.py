@@ -0,0 +1,84 @@
+# Generated by Django 4.2 on 2026-10-17 11:30
+
+from django.db import migrations, models
+
+# (coluna do contador em restricoes_restricoes, tabela filha)
+COUNTERS = [
+    ("areas_verdes_count", "restricoes_areaverdev"),
+    ("cortes_av_count", "restricoes_corteareaverdev"),
+    ("margens_rio_count", "restricoes_margemriov"),
+    ("margens_lt_count", "restricoes_margemltv"),
+    ("margens_ferrovia_count", "restricoes_margemferroviav"),
+    ("ruas_count", "restricoes_ruav"),
+]
+
+# triggers por statement (transition tables): um bulk_create de 500 filhos
+# vira 1 UPDATE por restrição, não 500
+FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION restricoes_bump_count() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        EXECUTE format(
+            'UPDATE restricoes_restricoes r SET %1$I = r.%1$I + d.n '
+            'FROM (SELECT restricoes_id, count(*) AS n FROM new_rows GROUP BY 1) d '
+            'WHERE r.id = d.restricoes_id', TG_ARGV[0]);
+    ELSE
+        EXECUTE format(
+            'UPDATE restricoes_restricoes r SET %1$I = r.%1$I - d.n '
+            'FROM (SELECT restricoes_id, count(*) AS n FROM old_rows GROUP BY 1) d '
+            'WHERE r.id = d.restricoes_id', TG_ARGV[0]);
+    END IF;
+    RETURN NULL;
+END
+$$;
+"""
+
+
+def _forward_sql():
+    stmts = [FUNCTION_SQL]
+    for col, table in COUNTERS:
+        stmts.append(
+            f"CREATE TRIGGER {table}_count_ins AFTER INSERT ON {table} "
+            f"REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT "
+            f"EXECUTE FUNCTION restricoes_bump_count('{col}');"
+        )
+        stmts.append(
+            f"CREATE TRIGGER {table}_count_del AFTER DELETE ON {table} "
+            f"REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT "
+            f"EXECUTE FUNCTION restricoes_bump_count('{col}');"
+        )
+        # backfill das restrições já existentes
+        stmts.append(
+            f"UPDATE restricoes_restricoes r SET {col} = "
+            f"(SELECT count(*) FROM {table} c WHERE c.restricoes_id = r.id);"
+        )
+    return "\n".join(stmts)
+
+
+def _reverse_sql():
+    stmts = []
+    for _col, table in COUNTERS:
+        stmts.append(f"DROP TRIGGER IF EXISTS {table}_count_ins ON {table};")
+        stmts.append(f"DROP TRIGGER IF EXISTS {table}_count_del ON {table};")
+    stmts.append("DROP FUNCTION IF EXISTS restricoes_bump_count();")
+    return "\n".join(stmts)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('restricoes', '0007_line_geometry_spgist_indexes'),
+    ]
+
+    operations = [
+        *[
+            migrations.AddField(
+                model_name='restricoes',
+                name=col,
+                field=models.IntegerField(default=0, editable=False),
+            )
+            for col, _table in COUNTERS
+        ],
+        migrations.RunSQL(sql=_forward_sql(), reverse_sql=_reverse_sql()),
+    ]
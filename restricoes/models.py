@@ -2,11 +2,23 @@ from __future__ import annotations
 
 from django.conf import settings
 from django.contrib.gis.db import models as gis
-from django.contrib.postgres.indexes import GistIndex
-from django.db import models
+from django.contrib.postgres.indexes import (GinIndex, GistIndex, OpClass,
+                                             SpGistIndex)
+from django.db import models, transaction
+from django.db.models.functions import Upper
 
 SRID_WGS = 4674  # SIRGAS2000
 
+# colunas de Restricoes atualizadas só pelos triggers dos models filhos
+TRIGGER_FIELDS = (
+    "areas_verdes_count",
+    "cortes_av_count",
+    "margens_rio_count",
+    "margens_lt_count",
+    "margens_ferrovia_count",
+    "ruas_count",
+)
+
 
 class Restricoes(models.Model):
     project = models.ForeignKey(
@@ -33,23 +45,55 @@ class Restricoes(models.Model):
     created_by = models.ForeignKey(
         settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
 
+    # contadores de filhos, mantidos por trigger no banco (migração 0008);
+    # a listagem lê direto, sem agregação
+    areas_verdes_count = models.IntegerField(default=0, editable=False)
+    cortes_av_count = models.IntegerField(default=0, editable=False)
+    margens_rio_count = models.IntegerField(default=0, editable=False)
+    margens_lt_count = models.IntegerField(default=0, editable=False)
+    margens_ferrovia_count = models.IntegerField(default=0, editable=False)
+    ruas_count = models.IntegerField(default=0, editable=False)
+
     class Meta:
         unique_together = (("project", "version"),)
         ordering = ["-created_at"]
+        indexes = [
+            # listagem por projeto já sai na ordem do Meta.ordering (sem sort)
+            models.Index(fields=["project", "-created_at"],
+                         name="restricoes_proj_created_idx"),
+            # busca do admin (icontains = UPPER(col) LIKE): trigram na
+            # mesma expressão para o LIKE '%...%' usar índice
+            GinIndex(OpClass(Upper("label"), name="gin_trgm_ops"),
+                     name="restr_label_trgm"),
+            GinIndex(OpClass(Upper("notes"), name="gin_trgm_ops"),
+                     name="restr_notes_trgm"),
+        ]
 
     def __str__(self):
         return f"Restricoes(project={self.project_id}, version={self.version}, oficial={self.is_oficial})"
 
     def save(self, *args, **kwargs):
         if not self.pk and not self.version:
-            last = (
-                Restricoes.objects
-                .filter(project=self.project)
-                .order_by("-version")
-                .values_list("version", flat=True)
-                .first()
-            )
-            self.version = (last or 0) + 1
+            with transaction.atomic():
+                # trava a linha do projeto: duas versões criadas ao mesmo
+                # tempo não pegam o mesmo número
+                Project = self._meta.get_field("project").related_model
+                Project.objects.select_for_update().filter(
+                    pk=self.project_id).values_list("pk").first()
+                # MAX no índice único (project, version): sem ordenar versões
+                last = (
+                    Restricoes.objects
+                    .filter(project_id=self.project_id)
+                    .aggregate(m=models.Max("version"))["m"]
+                )
+                self.version = (last or 0) + 1
+                return super().save(*args, **kwargs)
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            # save() completo não pode sobrescrever os contadores do trigger
+            kwargs["update_fields"] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in TRIGGER_FIELDS
+            ]
         return super().save(*args, **kwargs)
 
 
@@ -78,15 +122,18 @@ class CorteAreaVerdeV(models.Model):
 class RuaV(models.Model):
     restricoes = models.ForeignKey(
         Restricoes, on_delete=models.CASCADE, related_name="ruas")
-    eixo = gis.MultiLineStringField(srid=SRID_WGS)
+    eixo = gis.MultiLineStringField(srid=SRID_WGS, spatial_index=False)
     largura_m = models.FloatField(default=12.0)
+    # preenchida por trigger no banco (migração 0006)
     mask = gis.MultiPolygonField(srid=SRID_WGS, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         indexes = [
             models.Index(fields=["restricoes"]),
-            GistIndex(fields=["eixo"]),
+            # eixos/centerlines são segmentos curtos: SP-GiST rende mais;
+            # polígonos (mask/faixa/geom) ficam em GiST
+            SpGistIndex(fields=["eixo"], name="restr_rua_eixo_spgist"),
             GistIndex(fields=["mask"]),
         ]
 
@@ -94,15 +141,16 @@ class RuaV(models.Model):
 class MargemRioV(models.Model):
     restricoes = models.ForeignKey(
         Restricoes, on_delete=models.CASCADE, related_name="margens_rio")
-    centerline = gis.MultiLineStringField(srid=SRID_WGS)
+    centerline = gis.MultiLineStringField(srid=SRID_WGS, spatial_index=False)
     margem_m = models.FloatField(default=30.0)
+    # preenchida por trigger no banco (migração 0006)
     faixa = gis.MultiPolygonField(srid=SRID_WGS, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         indexes = [
             models.Index(fields=["restricoes"]),
-            GistIndex(fields=["centerline"]),
+            SpGistIndex(fields=["centerline"], name="restr_rio_centerl_spgist"),
             GistIndex(fields=["faixa"]),
         ]
 
@@ -110,15 +158,16 @@ class MargemRioV(models.Model):
 class MargemLTV(models.Model):
     restricoes = models.ForeignKey(
         Restricoes, on_delete=models.CASCADE, related_name="margens_lt")
-    centerline = gis.MultiLineStringField(srid=SRID_WGS)
+    centerline = gis.MultiLineStringField(srid=SRID_WGS, spatial_index=False)
     margem_m = models.FloatField(default=15.0)
+    # preenchida por trigger no banco (migração 0006)
     faixa = gis.MultiPolygonField(srid=SRID_WGS, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         indexes = [
             models.Index(fields=["restricoes"]),
-            GistIndex(fields=["centerline"]),
+            SpGistIndex(fields=["centerline"], name="restr_lt_centerl_spgist"),
             GistIndex(fields=["faixa"]),
         ]
 
@@ -126,15 +175,16 @@ class MargemLTV(models.Model):
 class MargemFerroviaV(models.Model):
     restricoes = models.ForeignKey(
         Restricoes, on_delete=models.CASCADE, related_name="margens_ferrovia")
-    centerline = gis.MultiLineStringField(srid=SRID_WGS)
+    centerline = gis.MultiLineStringField(srid=SRID_WGS, spatial_index=False)
     margem_m = models.FloatField(default=20.0)
+    # preenchida por trigger no banco (migração 0006)
     faixa = gis.MultiPolygonField(srid=SRID_WGS, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         indexes = [
             models.Index(fields=["restricoes"]),
-            GistIndex(fields=["centerline"]),
+            SpGistIndex(fields=["centerline"], name="restr_fer_centerl_spgist"),
             GistIndex(fields=["faixa"]),
         ]
 
@@ -1,15 +1,25 @@
 # restricoes/serializers.py
-# restricoes/serializers.py
+from __future__ import annotations
+
 from rest_framework import serializers
 
 from .models import Restricoes
 
 
+def requested_fields(request) -> set[str]:
+    """Campos pedidos em ?fields=a,b,c (vazio = todos)."""
+    if request is None:
+        return set()
+    raw = request.query_params.get("fields", "")
+    return {f.strip() for f in raw.split(",") if f.strip()}
+
+
 class RestricoesSerializer(serializers.ModelSerializer):
     # flag leve dizendo se já existe geometria de área loteável
-    has_area_loteavel = serializers.SerializerMethodField()
+    # (anotada nas views, sem carregar a geometria)
+    has_area_loteavel = serializers.BooleanField(read_only=True)
 
-    # contadores anotados nas views
+    # contadores: colunas de Restricoes mantidas por trigger no banco
     areas_verdes_count = serializers.IntegerField(read_only=True)
     cortes_av_count = serializers.IntegerField(read_only=True)
     margens_rio_count = serializers.IntegerField(read_only=True)
@@ -19,8 +29,10 @@ class RestricoesSerializer(serializers.ModelSerializer):
 
     # 🔹 novos campos para o card de restrições
     project_name = serializers.CharField(source="project.name", read_only=True)
-    created_by_nome = serializers.SerializerMethodField()
-    created_by_email = serializers.SerializerMethodField()
+    created_by_nome = serializers.CharField(
+        source="created_by.nome", read_only=True, default=None)
+    created_by_email = serializers.CharField(
+        source="created_by.email", read_only=True, default=None)
 
     class Meta:
         model = Restricoes
@@ -37,7 +49,7 @@ class RestricoesSerializer(serializers.ModelSerializer):
             "source",
             "is_active",
 
-            # contadores (vêm por annotate nas views)
+            # contadores (colunas mantidas por trigger)
             "areas_verdes_count",
             "cortes_av_count",
             "margens_rio_count",
@@ -45,7 +57,7 @@ class RestricoesSerializer(serializers.ModelSerializer):
             "margens_ferrovia_count",
             "ruas_count",
 
-            # flag calculada aqui
+            # flag anotada nas views
             "has_area_loteavel",
 
             # campos de autor
@@ -53,16 +65,10 @@ class RestricoesSerializer(serializers.ModelSerializer):
             "created_by_email",
         ]
 
-    def get_has_area_loteavel(self, obj):
-        try:
-            return bool(getattr(obj, "area_loteavel", None) and not obj.area_loteavel.empty)
-        except Exception:
-            return False
-
-    def get_created_by_nome(self, obj):
-        u = getattr(obj, "created_by", None)
-        return getattr(u, "nome", None) if u else None
-
-    def get_created_by_email(self, obj):
-        u = getattr(obj, "created_by", None)
-        return getattr(u, "email", None) if u else None
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # sparse fieldset: só serializa o que veio em ?fields=
+        requested = requested_fields(self.context.get("request"))
+        if requested:
+            for name in set(self.fields) - requested:
+                self.fields.pop(name)
@@ -2,12 +2,17 @@ from __future__ import annotations
 
 import json
 import math
+import tempfile
 from typing import Any, Dict, List
 
+import numpy as np
+import orjson
+import shapely
 from django.contrib.gis.geos import (GeometryCollection, GEOSGeometry,
                                      MultiLineString, MultiPolygon, Polygon)
 from django.db import models as djmodels
-from django.db import transaction
+from django.db import connection, transaction
+from django.db.models.functions import Coalesce
 from django.shortcuts import get_object_or_404
 from projetos.models import Project
 from pyproj import Transformer
@@ -19,21 +24,33 @@ from rest_framework.views import APIView
 from shapely.geometry import mapping, shape
 from shapely.ops import snap, unary_union
 from shapely.validation import make_valid as shapely_make_valid
-from django.http import HttpResponse
-from projetos.utils import build_kmz_from_payload 
-
-from rest_framework import status
-from django.shortcuts import get_object_or_404
+from django.http import FileResponse, Http404, HttpResponse
+from projetos.utils import KMZ_SPOOL_MAX_BYTES, write_kmz_from_payload
 
 from .models import ManualRestricaoV  # ---- MANUAIS
 from .models import (SRID_WGS, AreaVerdeV, CorteAreaVerdeV, MargemFerroviaV,
                      MargemLTV, MargemRioV, Restricoes, RuaV)
-from .serializers import RestricoesSerializer
+from .serializers import RestricoesSerializer, requested_fields
 
 SRID_IN = 4326
-SRID_WEBMERC = 3857
 SNAP_GRID = 1e-7
 
+
+def _has_area_loteavel():
+    """
+    Flag has_area_loteavel calculada no SQL (NOT ST_IsEmpty; NULL -> false):
+    a listagem não precisa trazer a geometria da área loteável por linha.
+    """
+    return Coalesce(
+        djmodels.Func(
+            "area_loteavel",
+            template="NOT ST_IsEmpty(%(expressions)s)",
+            output_field=djmodels.BooleanField(),
+        ),
+        djmodels.Value(False),
+    )
+
+
 # --- helpers para unir / diferenciar / medir ---
 
 
@@ -181,57 +198,6 @@ def _snap_4326_small(g: GEOSGeometry) -> GEOSGeometry:
         return gg
 
 
-def _norm_line_4674(g: GEOSGeometry) -> MultiLineString:
-    if not getattr(g, "srid", None):
-        try:
-            g = GEOSGeometry(g.geojson, srid=SRID_IN)
-        except Exception:
-            g.srid = SRID_IN
-    gg = _force_2d(g)
-    gg = _make_valid(gg)
-    if not getattr(gg, "srid", None):
-        gg.srid = SRID_IN
-    gg = _snap_4326_small(gg)
-    gg = _to_srid(gg, SRID_WGS)
-
-    def _as_mls_4674(x: GEOSGeometry) -> MultiLineString:
-        if x.geom_type == "LineString":
-            ml = MultiLineString(x)
-            ml.srid = SRID_WGS
-            return ml
-        if x.geom_type == "MultiLineString":
-            x.srid = SRID_WGS
-            return x
-        if x.geom_type == "GeometryCollection":
-            parts = []
-            for sub in x:
-                if sub.geom_type == "LineString":
-                    parts.append(sub)
-                elif sub.geom_type == "MultiLineString":
-                    parts.extend([ls for ls in sub])
-            if not parts:
-                raise ValueError("GeometryCollection sem linhas")
-            fixed = []
-            for ls in parts:
-                if ls.srid != SRID_WGS:
-                    ls = ls.clone()
-                    if not getattr(ls, "srid", None):
-                        ls.srid = SRID_WGS
-                    else:
-                        ls.transform(SRID_WGS)
-                fixed.append(ls)
-            ml = MultiLineString(*fixed)
-            ml.srid = SRID_WGS
-            return ml
-        raise ValueError(
-            f"Esperado LineString/MultiLineString, recebi {x.geom_type}")
-
-    ml = _as_mls_4674(gg)
-    if not getattr(ml, "srid", None):
-        ml.srid = SRID_WGS
-    return ml
-
-
 def _norm_poly_4674(g: GEOSGeometry) -> MultiPolygon:
     gg = _force_2d(_ensure_srid(g, SRID_IN))
     gg = _make_valid(gg)
@@ -266,36 +232,19 @@ def _norm_poly_4674(g: GEOSGeometry) -> MultiPolygon:
     raise ValueError(f"Esperado Polygon/MultiPolygon, recebi {gg.geom_type}")
 
 
-def _buffer_meters_stable_clip_aoi(line_4674: GEOSGeometry, meters: float, aoi_4674: MultiPolygon) -> MultiPolygon | None:
-    if not line_4674 or meters is None or float(meters) <= 0:
-        return None
-    line_4674 = _ensure_srid(line_4674, SRID_WGS)
-    aoi_4674 = _ensure_mpoly_4674(aoi_4674)
-    try:
-        g4326 = _to_srid(line_4674, SRID_IN)
-        g3857 = _to_srid(g4326, SRID_WEBMERC)
-        gb = g3857.buffer(float(meters))
-        if gb.srid != SRID_WEBMERC:
-            gb.transform(SRID_WEBMERC)
-        gb.transform(SRID_IN)
-        gb.transform(SRID_WGS)
-        gb = _ensure_srid(gb, SRID_WGS)
-    except Exception:
-        return None
-    try:
-        gb = _norm_poly_4674(gb)
-    except Exception:
-        return None
-    try:
-        clipped = gb.intersection(aoi_4674)
-        if not clipped or clipped.empty:
-            return None
-        clipped = _norm_poly_4674(_ensure_srid(clipped, SRID_WGS))
-        if clipped.empty:
-            return None
-        return _ensure_mpoly_4674(clipped)
-    except Exception:
-        return None
+def _restricao_masks(r) -> List[GEOSGeometry]:
+    """
+    Máscaras de rua e faixas de margem já gravadas para a restrição.
+    São calculadas no PostGIS (trigger da migração 0006: buffer em 3857
+    recortado pela aoi_snapshot), então são lidas de volta após o bulk_create.
+    """
+    masks: List[GEOSGeometry] = []
+    masks.extend(RuaV.objects.filter(restricoes=r, mask__isnull=False)
+                 .values_list("mask", flat=True))
+    for model in (MargemRioV, MargemLTV, MargemFerroviaV):
+        masks.extend(model.objects.filter(restricoes=r, faixa__isnull=False)
+                     .values_list("faixa", flat=True))
+    return masks
 
 
 def _iter_fc(fc):
@@ -313,6 +262,100 @@ def _from_geojson(geom_dict: Dict[str, Any], srid_default: int = SRID_IN) -> GEO
     return g
 
 
+# 4326 -> 4674 em lote (coordenadas em arrays numpy, sem GEOS por feição)
+_TR_4326_TO_4674 = Transformer.from_crs(SRID_IN, SRID_WGS, always_xy=True)
+
+
+def _shapely_from_geojson_batch(geom_dicts) -> np.ndarray:
+    """GeoJSON (4326) -> array shapely 2D; None onde a geometria não parseia."""
+    texts = [orjson.dumps(g).decode() for g in geom_dicts]
+    try:
+        geoms = shapely.from_geojson(texts, on_invalid="ignore")
+    except Exception:
+        # mesmo on_invalid do lote: uma feição ruim não muda o parse das outras
+        geoms = np.empty(len(texts), dtype=object)
+        for i, t in enumerate(texts):
+            try:
+                geoms[i] = shapely.from_geojson(t, on_invalid="ignore")
+            except Exception:
+                geoms[i] = None
+    return shapely.force_2d(geoms)
+
+
+def _to_4674_batch(geoms) -> np.ndarray:
+    """Reprojeta 4326 -> 4674 todas as coordenadas de uma vez."""
+    def _xy(coords):
+        x, y = _TR_4326_TO_4674.transform(coords[:, 0], coords[:, 1])
+        return np.column_stack([x, y])
+
+    return shapely.transform(geoms, _xy)
+
+
+def _to_geos_4674(geoms) -> List[GEOSGeometry | None]:
+    wkbs = shapely.to_wkb(np.asarray(geoms, dtype=object))
+    return [GEOSGeometry(memoryview(w), srid=SRID_WGS) if w is not None else None
+            for w in wkbs]
+
+
+def _lines_4674_batch(geom_dicts) -> List[MultiLineString | None]:
+    """
+    Linhas das features (4326) -> MultiLineString 4674: parse, 2D,
+    make_valid (em 4326) e reprojeção em poucas chamadas vetorizadas do
+    shapely.
+    Retorna MultiLineString 4674 (ou None) na mesma ordem da entrada.
+    """
+    if not geom_dicts:
+        return []
+    geoms = shapely.make_valid(_shapely_from_geojson_batch(geom_dicts))
+    geoms = _to_4674_batch(geoms)
+    out = []
+    for g in geoms:
+        if g is None or g.is_empty:
+            out.append(None)
+        elif g.geom_type == "LineString":
+            out.append(shapely.MultiLineString([g]))
+        elif g.geom_type == "MultiLineString":
+            out.append(g)
+        elif g.geom_type == "GeometryCollection":
+            parts = [q for p in shapely.get_parts(g) for q in shapely.get_parts(p)
+                     if q.geom_type == "LineString"]
+            out.append(shapely.MultiLineString(parts) if parts else None)
+        else:
+            out.append(None)
+    return _to_geos_4674(out)
+
+
+def _polys_4674_batch(geom_dicts) -> List[MultiPolygon | None]:
+    """Versão em lote de _ensure_mpoly_4674(_from_geojson(g))."""
+    if not geom_dicts:
+        return []
+    out = []
+    for g in _to_4674_batch(_shapely_from_geojson_batch(geom_dicts)):
+        if g is None:
+            out.append(None)
+        elif g.geom_type == "Polygon":
+            out.append(shapely.MultiPolygon([g]))
+        elif g.geom_type == "MultiPolygon":
+            out.append(g)
+        else:
+            out.append(None)
+    return _to_geos_4674(out)
+
+
+def _iter_fc_lines_4674(fc):
+    """(feature, MultiLineString 4674) das features com linha válida."""
+    feats = [f for f in _iter_fc(fc) if f.get("geometry")]
+    lines = _lines_4674_batch([f["geometry"] for f in feats])
+    return [(f, g) for f, g in zip(feats, lines) if g is not None]
+
+
+def _iter_fc_polys_4674(fc):
+    """(feature, MultiPolygon 4674) das features com polígono válido."""
+    feats = [f for f in _iter_fc(fc) if f.get("geometry")]
+    polys = _polys_4674_batch([f["geometry"] for f in feats])
+    return [(f, g) for f, g in zip(feats, polys) if g is not None]
+
+
 def _to_srid(g: GEOSGeometry, srid: int) -> GEOSGeometry:
     gg = g.clone()
     if gg.srid != srid:
@@ -460,6 +503,7 @@ class RestricoesCreateAPIView(APIView):
         with transaction.atomic():
             r = Restricoes.objects.create(
                 project=proj,
+                version=None,  # numerada em Restricoes.save()
                 aoi_snapshot=aoi_snapshot,
                 label=label,
                 notes=notes,
@@ -471,38 +515,21 @@ class RestricoesCreateAPIView(APIView):
 
             # AV
             av_bulk = []
-            for feat in _iter_fc(av_fc):
-                geom = feat.get("geometry")
-                if not geom:
-                    continue
-                try:
-                    g = _ensure_mpoly_4674(_from_geojson(geom))
-                except Exception:
-                    continue
+            for _feat, g in _iter_fc_polys_4674(av_fc):
                 av_bulk.append(AreaVerdeV(restricoes=r, geom=g))
             if av_bulk:
                 AreaVerdeV.objects.bulk_create(av_bulk, batch_size=500)
 
             # CORTES
             corte_bulk = []
-            for feat in _iter_fc(corte_fc):
-                geom = feat.get("geometry")
-                if not geom:
-                    continue
-                try:
-                    g = _ensure_mpoly_4674(_from_geojson(geom))
-                except Exception:
-                    continue
+            for _feat, g in _iter_fc_polys_4674(corte_fc):
                 corte_bulk.append(CorteAreaVerdeV(restricoes=r, geom=g))
             if corte_bulk:
                 CorteAreaVerdeV.objects.bulk_create(corte_bulk, batch_size=500)
 
             # RUAS
             rua_bulk = []
-            for feat in _iter_fc(ruas_fc):
-                geom = feat.get("geometry")
-                if not geom:
-                    continue
+            for feat, eixo in _iter_fc_lines_4674(ruas_fc):
                 props = feat.get("properties") or {}
                 largura = _get_prop(props, "width_m", default_rua_width)
                 try:
@@ -510,34 +537,15 @@ class RestricoesCreateAPIView(APIView):
                         default_rua_width)
                 except Exception:
                     largura = float(default_rua_width or 12)
-                try:
-                    eixo_raw = _from_geojson(geom)
-                    eixo = _norm_line_4674(eixo_raw)
-                    if not getattr(eixo, "srid", None):
-                        eixo.srid = SRID_WGS
-                    _debug_geom("rua.eixo", eixo)
-                except Exception:
-                    continue
-                mask = _buffer_meters_stable_clip_aoi(
-                    eixo, largura/2.0, aoi_snapshot)
-                if mask:
-                    mask = _ensure_mpoly_4674(mask)
-                _debug_geom("rua.mask", mask)
-                try:
-                    rua_bulk.append(
-                        RuaV(restricoes=r, eixo=eixo, largura_m=largura, mask=mask))
-                except TypeError:
-                    rua_bulk.append(
-                        RuaV(restricoes=r, eixo=eixo, largura_m=largura))
+                # mask (buffer largura/2 recortado pela AOI) vem do trigger
+                rua_bulk.append(
+                    RuaV(restricoes=r, eixo=eixo, largura_m=largura))
             if rua_bulk:
                 RuaV.objects.bulk_create(rua_bulk, batch_size=500)
 
             # RIOS
             rio_bulk = []
-            for feat in _iter_fc(rios_fc):
-                geom = feat.get("geometry")
-                if not geom:
-                    continue
+            for feat, line in _iter_fc_lines_4674(rios_fc):
                 props = feat.get("properties") or {}
                 margem_val = _get_prop(props, "margem_m", def_margem_rio)
                 try:
@@ -545,30 +553,14 @@ class RestricoesCreateAPIView(APIView):
                         def_margem_rio)
                 except Exception:
                     margem = float(def_margem_rio)
-                try:
-                    line_raw = _from_geojson(geom)
-                    line = _norm_line_4674(line_raw)
-                    if not getattr(line, "srid", None):
-                        line.srid = SRID_WGS
-                    _debug_geom("rio.centerline", line)
-                except Exception:
-                    continue
-                faixa = _buffer_meters_stable_clip_aoi(
-                    line, margem, aoi_snapshot)
-                if faixa:
-                    faixa = _ensure_mpoly_4674(faixa)
-                _debug_geom("rio.faixa", faixa)
                 rio_bulk.append(MargemRioV(
-                    restricoes=r, centerline=line, margem_m=margem, faixa=faixa))
+                    restricoes=r, centerline=line, margem_m=margem))
             if rio_bulk:
                 MargemRioV.objects.bulk_create(rio_bulk, batch_size=500)
 
             # LT
             lt_bulk = []
-            for feat in _iter_fc(lt_fc):
-                geom = feat.get("geometry")
-                if not geom:
-                    continue
+            for feat, line in _iter_fc_lines_4674(lt_fc):
                 props = feat.get("properties") or {}
                 margem_val = _get_prop(props, "margem_m", def_margem_lt)
                 try:
@@ -576,30 +568,14 @@ class RestricoesCreateAPIView(APIView):
                         def_margem_lt)
                 except Exception:
                     margem = float(def_margem_lt)
-                try:
-                    line_raw = _from_geojson(geom)
-                    line = _norm_line_4674(line_raw)
-                    if not getattr(line, "srid", None):
-                        line.srid = SRID_WGS
-                    _debug_geom("lt.centerline", line)
-                except Exception:
-                    continue
-                faixa = _buffer_meters_stable_clip_aoi(
-                    line, margem, aoi_snapshot)
-                if faixa:
-                    faixa = _ensure_mpoly_4674(faixa)
-                _debug_geom("lt.faixa", faixa)
                 lt_bulk.append(
-                    MargemLTV(restricoes=r, centerline=line, margem_m=margem, faixa=faixa))
+                    MargemLTV(restricoes=r, centerline=line, margem_m=margem))
             if lt_bulk:
                 MargemLTV.objects.bulk_create(lt_bulk, batch_size=500)
 
             # FERROVIAS
             fer_bulk = []
-            for feat in _iter_fc(fer_fc):
-                geom = feat.get("geometry")
-                if not geom:
-                    continue
+            for feat, line in _iter_fc_lines_4674(fer_fc):
                 props = feat.get("properties") or {}
                 margem_val = _get_prop(props, "margem_m", def_margem_fer)
                 try:
@@ -607,55 +583,26 @@ class RestricoesCreateAPIView(APIView):
                         def_margem_fer)
                 except Exception:
                     margem = float(def_margem_fer)
-                try:
-                    line_raw = _from_geojson(geom)
-                    line = _norm_line_4674(line_raw)
-                    if not getattr(line, "srid", None):
-                        line.srid = SRID_WGS
-                    _debug_geom("fer.centerline", line)
-                except Exception:
-                    continue
-                faixa = _buffer_meters_stable_clip_aoi(
-                    line, margem, aoi_snapshot)
-                if faixa:
-                    faixa = _ensure_mpoly_4674(faixa)
-                _debug_geom("fer.faixa", faixa)
                 fer_bulk.append(MargemFerroviaV(
-                    restricoes=r, centerline=line, margem_m=margem, faixa=faixa))
+                    restricoes=r, centerline=line, margem_m=margem))
             if fer_bulk:
                 MargemFerroviaV.objects.bulk_create(fer_bulk, batch_size=500)
 
             # ---- MANUAIS (polígonos convertidos ou desenhados) ----
             manuais_bulk = []
-            for feat in _iter_fc(manuais_fc):
-                geom = feat.get("geometry")
+            for feat, g in _iter_fc_polys_4674(manuais_fc):
                 props = feat.get("properties") or {}
-                if not geom:
-                    continue
-                try:
-                    g = _ensure_mpoly_4674(_from_geojson(geom))
-                    nm = str(props.get("name") or props.get(
-                        "nome") or "").strip()
-                    manuais_bulk.append(ManualRestricaoV(
-                        restricoes=r, name=nm, geom=g))
-                except Exception:
-                    continue
+                nm = str(props.get("name") or props.get(
+                    "nome") or "").strip()
+                manuais_bulk.append(ManualRestricaoV(
+                    restricoes=r, name=nm, geom=g))
             if manuais_bulk:
                 ManualRestricaoV.objects.bulk_create(
                     manuais_bulk, batch_size=500)
 
             # ---------- ÁREA LOTEÁVEL ----------
             try:
-                masks_polys = []
-                masks_polys.extend(
-                    [row.mask for row in rua_bulk if getattr(row, "mask", None)])
-                masks_polys.extend(
-                    [row.faixa for row in rio_bulk if getattr(row, "faixa", None)])
-                masks_polys.extend(
-                    [row.faixa for row in lt_bulk if getattr(row, "faixa", None)])
-                masks_polys.extend(
-                    [row.faixa for row in fer_bulk if getattr(row, "faixa", None)])
-                union_masks = _union_mpolys_4674(masks_polys)
+                union_masks = _union_mpolys_4674(_restricao_masks(r))
 
                 av_polys = [row.geom for row in av_bulk]
                 corte_polys = [row.geom for row in corte_bulk]
@@ -703,13 +650,9 @@ class RestricoesCreateAPIView(APIView):
             qs = (
                 Restricoes.objects
                 .filter(pk=r.pk)
+                .select_related("project", "created_by")
                 .annotate(
-                    areas_verdes_count=djmodels.Count("areas_verdes"),
-                    cortes_av_count=djmodels.Count("cortes_av"),
-                    margens_rio_count=djmodels.Count("margens_rio"),
-                    margens_lt_count=djmodels.Count("margens_lt"),
-                    margens_ferrovia_count=djmodels.Count("margens_ferrovia"),
-                    ruas_count=djmodels.Count("ruas"),
+                    has_area_loteavel=_has_area_loteavel(),
                 )
                 .first()
             )
@@ -746,7 +689,6 @@ class RestricoesUpdateAPIView(APIView):
 
     def put(self, request, restricoes_id: int, *args, **kwargs):
         r = get_object_or_404(Restricoes, pk=restricoes_id)
-        proj = r.project  # projeto não muda
 
         label = request.data.get("label", "") or ""
         notes = request.data.get("notes", "") or ""
@@ -786,6 +728,8 @@ class RestricoesUpdateAPIView(APIView):
             r.percent_permitido = percent_permitido
             r.corte_pct_cache = corte_pct_cache
             r.source = source
+            # o trigger das faixas recorta pela aoi_snapshot do banco
+            r.save(update_fields=["aoi_snapshot"])
 
             # Limpar TODAS as geometrias antigas ligadas a esta restrição
             AreaVerdeV.objects.filter(restricoes=r).delete()
@@ -799,28 +743,14 @@ class RestricoesUpdateAPIView(APIView):
 
             # ---------- AV ----------
             av_bulk = []
-            for feat in _iter_fc(av_fc):
-                geom = feat.get("geometry")
-                if not geom:
-                    continue
-                try:
-                    g = _ensure_mpoly_4674(_from_geojson(geom))
-                except Exception:
-                    continue
+            for _feat, g in _iter_fc_polys_4674(av_fc):
                 av_bulk.append(AreaVerdeV(restricoes=r, geom=g))
             if av_bulk:
                 AreaVerdeV.objects.bulk_create(av_bulk, batch_size=500)
 
             # ---------- CORTES ----------
             corte_bulk = []
-            for feat in _iter_fc(corte_fc):
-                geom = feat.get("geometry")
-                if not geom:
-                    continue
-                try:
-                    g = _ensure_mpoly_4674(_from_geojson(geom))
-                except Exception:
-                    continue
+            for _feat, g in _iter_fc_polys_4674(corte_fc):
                 corte_bulk.append(CorteAreaVerdeV(restricoes=r, geom=g))
             if corte_bulk:
                 CorteAreaVerdeV.objects.bulk_create(corte_bulk, batch_size=500)
@@ -828,68 +758,34 @@ class RestricoesUpdateAPIView(APIView):
 
             # ---------- RUAS ----------
             rua_bulk = []
-            for feat in _iter_fc(ruas_fc):
-                geom = feat.get("geometry")
-                if not geom:
-                    continue
+            for feat, eixo in _iter_fc_lines_4674(ruas_fc):
                 props = feat.get("properties") or {}
                 largura_val = _get_prop(props, "width_m", 12)
                 try:
                     largura = float(largura_val) if largura_val is not None else 12.0
                 except Exception:
                     largura = 12.0
-                try:
-                    eixo_raw = _from_geojson(geom)
-                    eixo = _norm_line_4674(eixo_raw)
-                    if not getattr(eixo, "srid", None):
-                        eixo.srid = SRID_WGS
-                    _debug_geom("rua.eixo", eixo)
-                except Exception:
-                    continue
 
-                mask = _buffer_meters_stable_clip_aoi(eixo, largura / 2.0, aoi_g)
-                if mask:
-                    mask = _ensure_mpoly_4674(mask)
-                _debug_geom("rua.mask", mask)
-                try:
-                    rua_bulk.append(
-                        RuaV(restricoes=r, eixo=eixo, largura_m=largura, mask=mask)
-                    )
-                except TypeError:
-                    rua_bulk.append(
-                        RuaV(restricoes=r, eixo=eixo, largura_m=largura)
-                    )
+                rua_bulk.append(
+                    RuaV(restricoes=r, eixo=eixo, largura_m=largura)
+                )
             if rua_bulk:
                 RuaV.objects.bulk_create(rua_bulk, batch_size=500)
 
             # ---------- RIOS ----------
             rio_bulk = []
-            for feat in _iter_fc(rios_fc):
-                geom = feat.get("geometry")
-                if not geom:
-                    continue
+            for feat, line in _iter_fc_lines_4674(rios_fc):
                 props = feat.get("properties") or {}
                 margem_val = _get_prop(props, "margem_m", def_margem_rio)
                 try:
                     margem = float(margem_val) if margem_val is not None else float(def_margem_rio)
                 except Exception:
                     margem = float(def_margem_rio)
-                try:
-                    line_raw = _from_geojson(geom)
-                    line = _norm_line_4674(line_raw)
-                    if not getattr(line, "srid", None):
-                        line.srid = SRID_WGS
-                except Exception:
-                    continue
-                faixa = _buffer_meters_stable_clip_aoi(line, margem, aoi_g)
-                if faixa:
-                    faixa = _ensure_mpoly_4674(faixa)
                 rio_bulk.append(
                     MargemRioV(
                         restricoes=r,
                         centerline=line,
                         margem_m=margem,
-                        faixa=faixa,
                     )
                 )
             if rio_bulk:
@@ -897,32 +793,18 @@ class RestricoesUpdateAPIView(APIView):
 
             # ---------- LT ----------
             lt_bulk = []
-            for feat in _iter_fc(lt_fc):
-                geom = feat.get("geometry")
-                if not geom:
-                    continue
+            for feat, line in _iter_fc_lines_4674(lt_fc):
                 props = feat.get("properties") or {}
                 margem_val = _get_prop(props, "margem_m", def_margem_lt)
                 try:
                     margem = float(margem_val) if margem_val is not None else float(def_margem_lt)
                 except Exception:
                     margem = float(def_margem_lt)
-                try:
-                    line_raw = _from_geojson(geom)
-                    line = _norm_line_4674(line_raw)
-                    if not getattr(line, "srid", None):
-                        line.srid = SRID_WGS
-                except Exception:
-                    continue
-                faixa = _buffer_meters_stable_clip_aoi(line, margem, aoi_g)
-                if faixa:
-                    faixa = _ensure_mpoly_4674(faixa)
                 lt_bulk.append(
                     MargemLTV(
                         restricoes=r,
                         centerline=line,
                         margem_m=margem,
-                        faixa=faixa,
                     )
                 )
             if lt_bulk:
@@ -930,32 +812,18 @@ class RestricoesUpdateAPIView(APIView):
 
             # ---------- FERROVIAS ----------
             fer_bulk = []
-            for feat in _iter_fc(ferrovias_fc):
-                geom = feat.get("geometry")
-                if not geom:
-                    continue
+            for feat, line in _iter_fc_lines_4674(ferrovias_fc):
                 props = feat.get("properties") or {}
                 margem_val = _get_prop(props, "margem_m", def_margem_ferrovia)
                 try:
                     margem = float(margem_val) if margem_val is not None else float(def_margem_ferrovia)
                 except Exception:
                     margem = float(def_margem_ferrovia)
-                try:
-                    line_raw = _from_geojson(geom)
-                    line = _norm_line_4674(line_raw)
-                    if not getattr(line, "srid", None):
-                        line.srid = SRID_WGS
-                except Exception:
-                    continue
-                faixa = _buffer_meters_stable_clip_aoi(line, margem, aoi_g)
-                if faixa:
-                    faixa = _ensure_mpoly_4674(faixa)
                 fer_bulk.append(
                     MargemFerroviaV(
                         restricoes=r,
                         centerline=line,
                         margem_m=margem,
-                        faixa=faixa,
                     )
                 )
             if fer_bulk:
@@ -963,27 +831,16 @@ class RestricoesUpdateAPIView(APIView):
 
             # ---------- MANUAIS ----------
             manuais_bulk = []
-            for feat in _iter_fc(manuais_fc):
-                geom = feat.get("geometry")
-                if not geom:
-                    continue
+            for feat, g in _iter_fc_polys_4674(manuais_fc):
                 props = feat.get("properties") or {}
                 nm = (props.get("name") or props.get("label") or "").strip()
-                try:
-                    g = _ensure_mpoly_4674(_from_geojson(geom))
-                except Exception:
-                    continue
                 manuais_bulk.append(ManualRestricaoV(restricoes=r, name=nm, geom=g))
             if manuais_bulk:
                 ManualRestricaoV.objects.bulk_create(manuais_bulk, batch_size=500)
 
             # ---------- ÁREA LOTEÁVEL ----------
             try:
-                masks_polys = []
-                masks_polys.extend([row.mask for row in RuaV.objects.filter(restricoes=r).exclude(mask__isnull=True)])
-                masks_polys.extend([row.faixa for row in MargemRioV.objects.filter(restricoes=r).exclude(faixa__isnull=True)])
-                masks_polys.extend([row.faixa for row in MargemLTV.objects.filter(restricoes=r).exclude(faixa__isnull=True)])
-                masks_polys.extend([row.faixa for row in MargemFerroviaV.objects.filter(restricoes=r).exclude(faixa__isnull=True)])
+                masks_polys = _restricao_masks(r)
 
                 if masks_polys:
                     masks_gc = GeometryCollection(masks_polys, srid=aoi_g.srid)
@@ -1013,7 +870,7 @@ class RestricoesUpdateAPIView(APIView):
                 "id": r.id,
                 "version": r.version,
                 "label": r.label,
-                "project_id": proj.id,
+                "project_id": r.project_id,  # projeto não muda
             },
             status=status.HTTP_200_OK,
         )
@@ -1034,7 +891,57 @@ class RestricoesUpdateAPIView(APIView):
 # ---------- LIST ----------
 
 
-class RestricoesListByProjectAPIView(ListAPIView):
+# campos do RestricoesSerializer lidos direto das colunas na listagem
+RESTRICOES_LIST_FIELDS = (
+    "id", "project", "version", "label", "notes", "created_at",
+    "percent_permitido", "corte_pct_cache", "source", "is_active",
+    # contadores mantidos por trigger (migração 0008)
+    "areas_verdes_count", "cortes_av_count", "margens_rio_count",
+    "margens_lt_count", "margens_ferrovia_count", "ruas_count",
+)
+# campos do serializer que vêm de FK (JOIN no mesmo SELECT)
+RESTRICOES_LIST_RELATED = {
+    "project_name": "project__name",
+    "created_by_nome": "created_by__nome",
+    "created_by_email": "created_by__email",
+}
+
+
+class _RestricoesValuesListMixin:
+    """
+    list() via values(): mesmas chaves do RestricoesSerializer, mas os dicts
+    saem direto das linhas do banco (sem instanciar Restricoes nem rodar os
+    campos do DRF por linha). Respeita ?fields= como o serializer.
+    """
+
+    def list(self, request, *args, **kwargs):
+        requested = requested_fields(request)
+
+        def keep(name):
+            return not requested or name in requested
+
+        cols = [f for f in RESTRICOES_LIST_FIELDS if keep(f)]
+        # anotação do get_queryset
+        if keep("has_area_loteavel"):
+            cols.append("has_area_loteavel")
+        related = {k: djmodels.F(v)
+                   for k, v in RESTRICOES_LIST_RELATED.items() if keep(k)}
+
+        qs = self.filter_queryset(self.get_queryset())
+        if not (cols or related):
+            # nenhum campo conhecido pedido: values() vazio traria tudo
+            return Response([{} for _ in qs.values_list("pk", flat=True)])
+        rows = qs.values(*cols, **related)
+
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(list(page))
+        # orjson direto (datetimes em ISO com 'Z', como o renderer do DRF)
+        return HttpResponse(orjson.dumps(list(rows), option=orjson.OPT_UTC_Z),
+                            content_type="application/json")
+
+
+class RestricoesListByProjectAPIView(_RestricoesValuesListMixin, ListAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = RestricoesSerializer
 
@@ -1044,12 +951,7 @@ class RestricoesListByProjectAPIView(ListAPIView):
             Restricoes.objects
             .filter(project_id=project_id)
             .annotate(
-                areas_verdes_count=djmodels.Count("areas_verdes"),
-                cortes_av_count=djmodels.Count("cortes_av"),
-                margens_rio_count=djmodels.Count("margens_rio"),
-                margens_lt_count=djmodels.Count("margens_lt"),
-                margens_ferrovia_count=djmodels.Count("margens_ferrovia"),
-                ruas_count=djmodels.Count("ruas"),
+                has_area_loteavel=_has_area_loteavel(),
             )
             .order_by("-created_at")
         )
@@ -1057,137 +959,112 @@ class RestricoesListByProjectAPIView(ListAPIView):
 # ---------- DETAIL ----------
 
 
+def _fc_sql(table: str, geom_col: str, props_sql: str) -> str:
+    """FeatureCollection (json) de uma tabela filha, montada no PostGIS."""
+    return f"""(
+        SELECT json_build_object(
+            'type', 'FeatureCollection',
+            'features', COALESCE(json_agg(json_build_object(
+                'type', 'Feature',
+                'geometry', ST_AsGeoJSON(c.{geom_col})::json,
+                'properties', {props_sql}
+            ) ORDER BY c.id), '[]'::json))::text
+        FROM {table} c
+        WHERE c.restricoes_id = r.id
+          AND c.{geom_col} IS NOT NULL AND NOT ST_IsEmpty(c.{geom_col})
+    )"""
+
+
+# chave da resposta -> (tabela filha, coluna de geometria, properties)
+GEO_DETAIL_LAYERS = {
+    "av": ("restricoes_areaverdev", "geom", "'{}'::json"),
+    "corte_av": ("restricoes_corteareaverdev", "geom", "'{}'::json"),
+    "ruas_eixo": ("restricoes_ruav", "eixo",
+                  "json_build_object('width_m', c.largura_m)"),
+    "ruas_mask": ("restricoes_ruav", "mask",
+                  "json_build_object('width_m', c.largura_m)"),
+    "rios_centerline": ("restricoes_margemriov", "centerline",
+                        "json_build_object('margem_m', c.margem_m)"),
+    "rios_faixa": ("restricoes_margemriov", "faixa",
+                   "json_build_object('margem_m', c.margem_m)"),
+    "lt_centerline": ("restricoes_margemltv", "centerline",
+                      "json_build_object('margem_m', c.margem_m)"),
+    "lt_faixa": ("restricoes_margemltv", "faixa",
+                 "json_build_object('margem_m', c.margem_m)"),
+    "ferrovias_centerline": ("restricoes_margemferroviav", "centerline",
+                             "json_build_object('margem_m', c.margem_m)"),
+    "ferrovias_faixa": ("restricoes_margemferroviav", "faixa",
+                        "json_build_object('margem_m', c.margem_m)"),
+    "manuais": ("restricoes_manualrestricaov", "geom",
+                "json_build_object('name', COALESCE(c.name, ''))"),
+}
+
+GEO_DETAIL_SQL = f"""
+    SELECT r.id, r.project_id, r.version, r.label, r.notes, r.created_at,
+           ST_AsGeoJSON(r.aoi_snapshot),
+           {", ".join(_fc_sql(*spec) for spec in GEO_DETAIL_LAYERS.values())},
+           CASE WHEN r.area_loteavel IS NOT NULL
+                     AND NOT ST_IsEmpty(r.area_loteavel)
+                THEN ST_AsGeoJSON(r.area_loteavel) END,
+           ST_Area(ST_Transform(r.area_loteavel, 3857))
+    FROM restricoes_restricoes r
+    WHERE r.id = %s
+"""
+
+
 class RestricoesGeoDetailAPIView(APIView):
+    """
+    Geometrias de uma versão de restrições. Um único SELECT: cada camada
+    filha vira um FeatureCollection em json_agg no PostGIS, e o texto vai
+    para a resposta como está (orjson.Fragment), sem GEOS nem json.loads.
+    """
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request, restricoes_id: int, *args, **kwargs):
-        r = get_object_or_404(Restricoes, pk=restricoes_id)
+        with connection.cursor() as cur:
+            cur.execute(GEO_DETAIL_SQL, [restricoes_id])
+            row = cur.fetchone()
+        if row is None:
+            raise Http404
 
-        def fc(features):
-            return {"type": "FeatureCollection", "features": features}
-
-        def feat(g, props=None):
-            if not g:
-                return None
-            try:
-                return {"type": "Feature", "geometry": json.loads(g.geojson), "properties": props or {}}
-            except Exception:
-                return None
+        (rid, project_id, version, label, notes, created_at, aoi_gj,
+         *layers_gj) = row
+        loteavel_gj, loteavel_area = layers_gj[-2:]
+        layers_gj = layers_gj[:-2]
 
         print(
-            f"[restricoes.detail] GET restricoes_id={r.id} project={r.project_id} version={r.version}")
-        if r.aoi_snapshot:
-            _debug_geom("AOI", r.aoi_snapshot)
-
-        av_feats = [feat(row.geom) for row in r.areas_verdes.all()]
-        corte_feats = [feat(row.geom) for row in r.cortes_av.all()]
+            f"[restricoes.detail] GET restricoes_id={rid} project={project_id} version={version}")
 
-        rua_eixo_feats, rua_mask_feats = [], []
-        for row in r.ruas.all():
-            try:
-                if row.eixo:
-                    rua_eixo_feats.append({"type": "Feature", "geometry": json.loads(
-                        row.eixo.geojson), "properties": {"width_m": float(row.largura_m)}})
-                if getattr(row, "mask", None):
-                    rua_mask_feats.append(
-                        feat(row.mask, {"width_m": float(row.largura_m)}))
-            except Exception:
-                pass
-
-        rios_centerline_feats, rios_faixa_feats = [], []
-        for row in r.margens_rio.all():
-            try:
-                if row.centerline:
-                    rios_centerline_feats.append({"type": "Feature", "geometry": json.loads(
-                        row.centerline.geojson), "properties": {"margem_m": float(row.margem_m)}})
-                if row.faixa:
-                    rios_faixa_feats.append(
-                        feat(row.faixa, {"margem_m": float(row.margem_m)}))
-            except Exception:
-                pass
-
-        lt_centerline_feats, lt_faixa_feats = [], []
-        for row in r.margens_lt.all():
-            try:
-                if row.centerline:
-                    lt_centerline_feats.append({"type": "Feature", "geometry": json.loads(
-                        row.centerline.geojson), "properties": {"margem_m": float(row.margem_m)}})
-                if row.faixa:
-                    lt_faixa_feats.append(
-                        feat(row.faixa, {"margem_m": float(row.margem_m)}))
-            except Exception:
-                pass
-
-        fer_centerline_feats, fer_faixa_feats = [], []
-        for row in r.margens_ferrovia.all():
-            try:
-                if row.centerline:
-                    fer_centerline_feats.append({"type": "Feature", "geometry": json.loads(
-                        row.centerline.geojson), "properties": {"margem_m": float(row.margem_m)}})
-                if row.faixa:
-                    fer_faixa_feats.append(
-                        feat(row.faixa, {"margem_m": float(row.margem_m)}))
-            except Exception:
-                pass
-
-        # ---- MANUAIS
-        manuais_feats = []
-        for row in r.restricoes_manuais.all():
-            try:
-                manuais_feats.append({
-                    "type": "Feature",
-                    "geometry": json.loads(row.geom.geojson),
-                    "properties": {"name": row.name or ""},
-                })
-            except Exception:
-                pass
-
-        loteavel_geom = getattr(r, "area_loteavel", None)
-        loteavel_fc = {"type": "FeatureCollection", "features": []}
-        if loteavel_geom and not loteavel_geom.empty:
-            try:
-                loteavel_fc["features"].append({
-                    "type": "Feature",
-                    "geometry": json.loads(loteavel_geom.geojson),
-                    "properties": {"area_m2": round(_area_m2(loteavel_geom), 2)},
-                })
-            except Exception:
-                pass
+        loteavel_features = []
+        if loteavel_gj:
+            loteavel_features.append({
+                "type": "Feature",
+                "geometry": orjson.Fragment(loteavel_gj),
+                "properties": {"area_m2": round(float(loteavel_area or 0.0), 2)},
+            })
 
         data = {
-            "restricoes_id": r.id,
-            "project_id": r.project_id,
-            "version": r.version,
-            "label": r.label,
-            "notes": r.notes,
-            "created_at": r.created_at,
+            "restricoes_id": rid,
+            "project_id": project_id,
+            "version": version,
+            "label": label,
+            "notes": notes,
+            "created_at": created_at,
             "srid": SRID_WGS,
 
-            "aoi": json.loads(r.aoi_snapshot.geojson) if r.aoi_snapshot else None,
-
-            "av": fc([x for x in av_feats if x]),
-            "corte_av": fc([x for x in corte_feats if x]),
-
-            "ruas_eixo": fc([x for x in rua_eixo_feats if x]),
-            "ruas_mask": fc([x for x in rua_mask_feats if x]),
-
-            "rios_centerline": fc([x for x in rios_centerline_feats if x]),
-            "rios_faixa": fc([x for x in rios_faixa_feats if x]),
+            "aoi": orjson.Fragment(aoi_gj) if aoi_gj else None,
 
-            "lt_centerline": fc([x for x in lt_centerline_feats if x]),
-            "lt_faixa": fc([x for x in lt_faixa_feats if x]),
+            **{key: orjson.Fragment(gj)
+               for key, gj in zip(GEO_DETAIL_LAYERS, layers_gj)},
 
-            "ferrovias_centerline": fc([x for x in fer_centerline_feats if x]),
-            "ferrovias_faixa": fc([x for x in fer_faixa_feats if x]),
-
-            "manuais": fc([x for x in manuais_feats if x]),  # ---- MANUAIS
-
-            "area_loteavel": loteavel_fc,
+            "area_loteavel": {"type": "FeatureCollection",
+                              "features": loteavel_features},
         }
-        return Response(data, status=status.HTTP_200_OK)
+        return HttpResponse(orjson.dumps(data, option=orjson.OPT_UTC_Z),
+                            content_type="application/json")
 
 
-class RestricoesListByDonoAPIView(ListAPIView):
+class RestricoesListByDonoAPIView(_RestricoesValuesListMixin, ListAPIView):
     """
     Lista TODAS as versões de restrições de TODOS os projetos
     pertencentes ao mesmo 'dono' (tenant) do usuário logado.
@@ -1211,14 +1088,8 @@ class RestricoesListByDonoAPIView(ListAPIView):
         return (
             Restricoes.objects
             .filter(project__dono=dono)
-            .select_related("project", "created_by")
             .annotate(
-                areas_verdes_count=djmodels.Count("areas_verdes"),
-                cortes_av_count=djmodels.Count("cortes_av"),
-                margens_rio_count=djmodels.Count("margens_rio"),
-                margens_lt_count=djmodels.Count("margens_lt"),
-                margens_ferrovia_count=djmodels.Count("margens_ferrovia"),
-                ruas_count=djmodels.Count("ruas"),
+                has_area_loteavel=_has_area_loteavel(),
             )
             .order_by("-created_at")
         )
@@ -1226,14 +1097,15 @@ class RestricoesListByDonoAPIView(ListAPIView):
 class RestricoesExportKmzAPIView(APIView):
     """
     Exporta um KMZ de uma versão de restrições usando o mesmo builder de
-    projetos (build_kmz_from_payload), para abrir no Google Earth com
+    projetos (write_kmz_from_payload), para abrir no Google Earth com
     camadas (AOI, rios, LT, ferrovias, áreas de overlays de projeto, etc.).
     """
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request, restricoes_id: int, *args, **kwargs):
         # Carrega a versão de restrições
-        r = get_object_or_404(Restricoes, pk=restricoes_id)
+        r = get_object_or_404(
+            Restricoes.objects.select_related("project"), pk=restricoes_id)
         project = r.project
 
         if project is None:
@@ -1273,7 +1145,11 @@ class RestricoesExportKmzAPIView(APIView):
         simplify = None
 
         # Usa o mesmo builder central que já gera o KMZ bonito em Projetos
-        kmz_bytes, filename, mimetype = build_kmz_from_payload(
+        # escrito direto num arquivo temporário (em memória até
+        # KMZ_SPOOL_MAX_BYTES), que a resposta lê em streaming
+        kmz_file = tempfile.SpooledTemporaryFile(max_size=KMZ_SPOOL_MAX_BYTES)
+        filename, mimetype = write_kmz_from_payload(
+            kmz_file,
             project=project,
             aoi_geojson=aoi_geojson,
             layer_flags=layer_flags,
@@ -1291,9 +1167,9 @@ class RestricoesExportKmzAPIView(APIView):
             .replace("\\", "_")
         )
 
-        response = HttpResponse(kmz_bytes, content_type=mimetype)
-        response["Content-Disposition"] = f'attachment; filename="{safe_name}.kmz"'
-        return response
+        kmz_file.seek(0)
+        return FileResponse(kmz_file, content_type=mimetype,
+                            as_attachment=True, filename=f"{safe_name}.kmz")
 
 
     
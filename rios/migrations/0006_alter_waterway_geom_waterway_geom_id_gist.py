@@ -0,0 +1,24 @@
+# Generated by Django 4.2 on 2026-10-17 10:00
+
+import django.contrib.gis.db.models.fields
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rios', '0005_alter_waterway_options_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='waterway',
+            name='geom',
+            field=django.contrib.gis.db.models.fields.MultiLineStringField(spatial_index=False, srid=4326),
+        ),
+        migrations.AddIndex(
+            model_name='waterway',
+            index=django.contrib.postgres.indexes.GistIndex(fields=['geom'], include=('id',), name='waterway_geom_id_gist'),
+        ),
+    ]
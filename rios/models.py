@@ -1,10 +1,11 @@
 # rios/models.py
 from django.contrib.gis.db import models
+from django.contrib.postgres.indexes import GistIndex
 
 
 class Waterway(models.Model):
     # geometria única para todo o Brasil (WGS84)
-    geom = models.MultiLineStringField(srid=4326, spatial_index=True)
+    geom = models.MultiLineStringField(srid=4326, spatial_index=False)
     # campos opcionais (ajuste conforme seu geojson)
     name = models.CharField(max_length=255, null=True, blank=True)
     source = models.CharField(max_length=64, null=True, blank=True)
@@ -12,6 +13,9 @@ class Waterway(models.Model):
     class Meta:
         indexes = [
             models.Index(fields=["name"]),
+            # GiST cobrindo id: o recorte pela AOI sai só do índice
+            GistIndex(fields=["geom"], include=["id"],
+                      name="waterway_geom_id_gist"),
         ]
         verbose_name = "Rio"
         verbose_name_plural = "Rios"
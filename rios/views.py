@@ -3,14 +3,15 @@ import io
 import json
 import zipfile
 
+import orjson
+
 from django.contrib.gis.db.models import GeometryField
-from django.contrib.gis.db.models.functions import (AsGeoJSON, Intersection,
-                                                    MakeValid)
+from django.contrib.gis.db.models.functions import AsGeoJSON
 from django.contrib.gis.geos import GEOSGeometry, MultiPolygon
 from django.contrib.gis.geos import Polygon
 from django.contrib.gis.geos import Polygon as GEOSPolygon
-from django.db.models import F, Func, Value
-from django.http import HttpResponse, JsonResponse
+from django.db.models.expressions import RawSQL
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
@@ -29,6 +30,31 @@ except ImportError:
 # Helpers
 # ---------------------------
 
+# início do texto do ST_AsGeoJSON das geometrias servidas pelo GeoJSON de rios
+_LINE_GEOJSON_PREFIXES = tuple(
+    '{"type":"%s"' % t
+    for t in ("LineString", "MultiLineString", "GeometryCollection"))
+
+
+def _clip_valid_simplify_sql(aoi_ewkb, tol):
+    """
+    ST_SimplifyPreserveTopology(ST_MakeValid(ST_Intersection(geom, AOI)), tol)
+    como UMA expressão (AOI ligada uma vez como EWKB); sem AOI, só
+    MakeValid + Simplify sobre a geometria original.
+    """
+    geom_sql = f'"{Waterway._meta.db_table}"."geom"'
+    params = []
+    if aoi_ewkb is not None:
+        geom_sql = f"ST_Intersection({geom_sql}, ST_GeomFromEWKB(%s))"
+        params.append(aoi_ewkb)
+    params.append(float(tol))
+    return RawSQL(
+        f"ST_SimplifyPreserveTopology(ST_MakeValid({geom_sql}), %s)",
+        params,
+        output_field=GeometryField(srid=4326),
+    )
+
+
 def _close_rings_inplace(coords):
     """
     Fecha anéis de Polygon/MultiPolygon (lista de rings) in-place.
@@ -195,51 +221,41 @@ def rios_geojson(request):
             return JsonResponse({"detail": "aoi inválido."}, status=400)
 
     qs = Waterway.objects.all()
-
     if aoi is not None:
-        qs = qs.filter(geom__intersects=aoi).annotate(
-            clipped=Intersection("geom", Value(
-                aoi, output_field=GeometryField(srid=4326)))
-        )
-        geom_expr = F("clipped")
-    else:
-        geom_expr = F("geom")
+        qs = qs.filter(geom__intersects=aoi)
 
-    # MakeValid + ST_SimplifyPreserveTopology
+    # Intersection + MakeValid + ST_SimplifyPreserveTopology numa expressão só
+    # (calculada uma vez, no SELECT; o tipo é checado no texto do GeoJSON)
     qs = (
-        qs.annotate(geom_valid=MakeValid(geom_expr))
-          .annotate(
-              geom_simpl=Func(
-                  F("geom_valid"),
-                  Value(simplify_tol),
-                  function="ST_SimplifyPreserveTopology",
-                  output_field=GeometryField(srid=4326),
-              )
-        )
+        qs.annotate(geom_simpl=_clip_valid_simplify_sql(
+            bytes(aoi.ewkb) if aoi is not None else None, simplify_tol))
         .annotate(geojson=AsGeoJSON("geom_simpl"))
-        .values("id", "name", "source", "geojson")[:max(1, limit)]
+        .values_list("id", "name", "source", "geojson")[:max(1, limit)]
     )
 
-    features = []
-    for row in qs:
-        try:
-            geom = json.loads(row["geojson"])
-        except Exception:
-            continue
-        # só exporta linhas
-        if geom.get("type") not in ("LineString", "MultiLineString", "GeometryCollection"):
-            continue
-        features.append({
-            "type": "Feature",
-            "id": row["id"],
-            "properties": {
-                "name": row.get("name"),
-                "source": row.get("source"),
-            },
-            "geometry": geom,
-        })
+    def _stream():
+        # cursor server-side (iterator): o GeoJSON do PostGIS vai direto
+        # para a resposta, em janelas, sem json.loads nem lista de features
+        yield '{"type":"FeatureCollection","features":['
+        parts = []
+        sep = ""
+        for pk, name, source, gj in qs.iterator(chunk_size=2000):
+            # só exporta linhas
+            if not gj or not gj.startswith(_LINE_GEOJSON_PREFIXES):
+                continue
+            parts.append('{"type":"Feature","id":' + str(pk)
+                         + ',"properties":'
+                         + orjson.dumps({"name": name, "source": source}).decode()
+                         + ',"geometry":' + gj + "}")
+            if len(parts) >= 2000:
+                yield sep + ",".join(parts)
+                parts.clear()
+                sep = ","
+        if parts:
+            yield sep + ",".join(parts)
+        yield "]}"
 
-    return JsonResponse({"type": "FeatureCollection", "features": features}, status=200)
+    return StreamingHttpResponse(_stream(), content_type="application/json")
 
 
 # ---------------------------
@@ -327,16 +343,9 @@ def export_rios_kmz(request):
         Waterway.objects
         .filter(geom__intersects=aoi))
     qs = qs.annotate(
-        clipped=Intersection('geom', Value(
-            aoi, output_field=GeometryField(srid=4326)))
-    ).annotate(
-        clipped_valid=MakeValid(F('clipped'))
-    ).annotate(
-        clipped_simpl=Func(
-            F('clipped_valid'),
-            Value(0.00002),  # ajuste se quiser mais/menos detalhado
-            function='ST_SimplifyPreserveTopology',
-            output_field=GeometryField(srid=4326),
+        clipped_simpl=_clip_valid_simplify_sql(
+            bytes(aoi.ewkb),
+            0.00002,  # ajuste se quiser mais/menos detalhado
         )
     ).only('id')
 
@@ -135,6 +135,11 @@ DATABASES = {
         "HOST": DB_HOST,
         "PORT": os.getenv("DB_PORT", "5432"),
         "CONN_MAX_AGE": 0 if PGBOUNCER else 60,  # 0 com pgbouncer; 60 sem
+        # cursores server-side não sobrevivem ao pooling por transação do
+        # pgbouncer. O Django só consulta isto em QuerySet.iterator(); SQL
+        # cru que usa connection.chunked_cursor() precisa checar por conta
+        # própria (projetos.utils._iter_sql_rows)
+        "DISABLE_SERVER_SIDE_CURSORS": PGBOUNCER,
         "OPTIONS": {
             # Em produção com provider (Neon/Render/RDS etc): use 'require'
             # Em localhost: use 'prefer' (ou remova) para não quebrar
@@ -213,6 +218,9 @@ IAPARCELAMENTO_RAG_DIR = os.path.join(BASE_DIR, "iaparcelamento_rag")
 
 IAPARCELAMENTO_MODEL = "gpt-4.1-mini"
 
+# log detalhado (attempts/created_ids) do preview incremental de quarteirões
+PARCELAMENTO_DEBUG = os.getenv("PARCELAMENTO_DEBUG", "0") == "1"
+
 
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=20),